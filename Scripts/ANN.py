@@ -108,17 +108,20 @@ def ann(train_generator,test_generator):
 
 # Sequential model to classify project data in to multiple classes
 
-def ann(train_generator,test_generator):
-    model = tf.keras.models.Sequential([
-        tf.keras.layers.Flatten(input_shape=(224, 224, 3)),
+def build_ann(input_shape=(224, 224, 3), num_classes=5):
+    return tf.keras.models.Sequential([
+        tf.keras.layers.Flatten(input_shape=input_shape),
         tf.keras.layers.Dense(512, activation='relu'),
         tf.keras.layers.Dropout(0.2),
         tf.keras.layers.Dense(256, activation='relu'),
         tf.keras.layers.Dropout(0.2),
         tf.keras.layers.Dense(128, activation='relu'),
-        tf.keras.layers.Dense(5, activation='softmax')  # Assuming 5 output classes
+        tf.keras.layers.Dense(num_classes, activation='softmax', dtype="float32")  # Assuming 5 output classes
     ])
 
+def ann(train_generator,test_generator):
+    model = build_ann()
+
     model.compile(loss="sparse_categorical_crossentropy", optimizer="adam", metrics=["accuracy"])
 
     history = model.fit(
@@ -30,10 +30,9 @@ import tensorflow as tf
 from tensorflow.python.keras import regularizers
 
 
-def cnn(train_generator,test_generator):
-
-    model = tf.keras.models.Sequential([
-        tf.keras.layers.Conv2D(128, (3, 3), activation='relu', input_shape=(224, 224, 3),kernel_regularizer=regularizers.l2(0.01)),
+def build_cnn(input_shape=(224, 224, 3), num_classes=1):
+    return tf.keras.models.Sequential([
+        tf.keras.layers.Conv2D(128, (3, 3), activation='relu', input_shape=input_shape,kernel_regularizer=regularizers.l2(0.01)),
         tf.keras.layers.BatchNormalization(),
         tf.keras.layers.Conv2D(128, (3, 3), kernel_regularizer=regularizers.l2(0.01)),
         tf.keras.layers.BatchNormalization(),
@@ -44,9 +43,14 @@ def cnn(train_generator,test_generator):
         tf.keras.layers.Dropout(0.2),
         tf.keras.layers.Dense(64, activation="relu"),
         tf.keras.layers.Dense(32, activation="tanh"),
-        tf.keras.layers.Dense(1, activation="softmax")
+        tf.keras.layers.Dense(num_classes, activation="softmax", dtype="float32")
     ])
 
+
+def cnn(train_generator,test_generator):
+
+    model = build_cnn()
+
     model.compile(loss="categorical_crossentropy", optimizer="adam", metrics=["accuracy"])
 
     history = model.fit(
@@ -0,0 +1,124 @@
+import os
+import sys
+import json
+import time
+import types
+import argparse
+import resource
+import subprocess
+
+import numpy as np
+import tensorflow as tf
+
+
+def _slice(data, start, size):
+    return tf.nest.map_structure(lambda t: t[start:start + size], data)
+
+
+# Gradients of one micro-batch, scaled by its share of the logical batch so the sum over
+# micro-batches equals the gradient of the mean loss over the whole batch
+def _micro_step(model, x, y, sample_weight, batch_size):
+    with tf.GradientTape() as tape:
+        y_pred = model(x, training=True)
+        loss = model.compute_loss(x, y, y_pred, sample_weight)
+        loss *= tf.cast(tf.shape(y_pred)[0], loss.dtype) / tf.cast(batch_size, loss.dtype)
+    grads = tape.gradient(loss, model.trainable_variables,
+                          unconnected_gradients=tf.UnconnectedGradients.ZERO)
+    model.compute_metrics(x, y, y_pred, sample_weight)
+    return grads
+
+
+# Replacement train_step: runs the logical batch as sequential micro-batches and applies the summed
+# gradients once. Only one micro-batch of activations is alive at a time, so peak memory follows
+# micro_batch_size while the optimizer still sees the full batch.
+def _accumulating_train_step(self, data):
+    x, y, sample_weight = tf.keras.utils.unpack_x_y_sample_weight(data)
+    mb = self.micro_batch_size
+    batch_size = tf.shape(tf.nest.flatten(x)[0])[0]
+    steps = (batch_size + mb - 1) // mb
+
+    # The first micro-batch runs outside the loop so lazily built weights and metrics are created there
+    grads = _micro_step(self, _slice(x, 0, mb), _slice(y, 0, mb),
+                        None if sample_weight is None else _slice(sample_weight, 0, mb), batch_size)
+
+    def body(i, grads):
+        start = i * mb
+        micro = _micro_step(self, _slice(x, start, mb), _slice(y, start, mb),
+                            None if sample_weight is None else _slice(sample_weight, start, mb), batch_size)
+        return i + 1, [g + m for g, m in zip(grads, micro)]
+
+    _, grads = tf.while_loop(lambda i, _: i < steps, body, (tf.constant(1), grads), parallel_iterations=1)
+    self.optimizer.apply_gradients(zip(grads, self.trainable_variables))
+    return self.get_metrics_result()
+
+
+# Makes fit() accumulate gradients over micro-batches of micro_batch_size.
+# The batch size given to the dataset/fit stays the effective batch size. The model object is kept,
+# so compile, fit, evaluate and save work as before. micro_batch_size=None restores the normal step.
+def accumulate_gradients(model, micro_batch_size):
+    if micro_batch_size:
+        model.micro_batch_size = int(micro_batch_size)
+        model.train_step = types.MethodType(_accumulating_train_step, model)
+    elif "train_step" in vars(model):
+        del model.train_step
+    model.train_function = None
+    return model
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# One benchmark configuration, run in its own process since peak RSS only ever grows
+def _bench_run(arch, image_size, batch_size, micro_batch_size, steps, num_classes=2):
+    from architectures import build_model, compile_model
+
+    x = np.random.default_rng(0).random((batch_size * steps, *image_size, 3), dtype=np.float32)
+    y = np.random.default_rng(1).integers(0, num_classes, batch_size * steps).astype(np.int32)
+    ds = tf.data.Dataset.from_tensor_slices((x, y)).batch(batch_size)
+
+    kwargs = {"weights": None} if arch.startswith("vgg") else {}
+    model = compile_model(build_model(arch, (*image_size, 3), num_classes, **kwargs),
+                          micro_batch_size=micro_batch_size)
+    model.fit(ds.take(1), verbose=0)
+    before = peak_rss_mb()
+    start = time.perf_counter()
+    model.fit(ds, verbose=0)
+    elapsed = time.perf_counter() - start
+    return {"micro_batch_size": micro_batch_size or batch_size, "accumulating": bool(micro_batch_size),
+            "peak_rss_mb": peak_rss_mb(), "rss_before_fit_mb": before,
+            "images_per_sec": batch_size * steps / elapsed}
+
+
+# Peak RSS and throughput at a fixed effective batch size for several micro-batch sizes,
+# against plain fit() at the full batch
+def benchmark(arch, image_size=(224, 224), batch_size=32, micro_batch_sizes=(16, 8, 4), steps=4):
+    results = []
+    for mb in (None, *micro_batch_sizes):
+        cmd = [sys.executable, os.path.abspath(__file__), "run", arch, "--size", str(image_size[0]),
+               "--batch-size", str(batch_size), "--steps", str(steps), "--micro-batch-size", str(mb or 0)]
+        out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(out.strip().splitlines()[-1]))
+
+    print(f"\n{arch} at {image_size[0]}x{image_size[1]}, effective batch {batch_size}")
+    for r in results:
+        label = f"micro {r['micro_batch_size']:>3}" if r["accumulating"] else "no accumulation"
+        print(f"{label:>16}: peak RSS {r['peak_rss_mb']:8.1f} MB, {r['images_per_sec']:7.1f} img/s")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Gradient accumulation peak memory and throughput benchmark")
+    parser.add_argument('command', choices=["benchmark", "run"])
+    parser.add_argument('arch')
+    parser.add_argument('--size', type=int, default=224)
+    parser.add_argument('--batch-size', type=int, default=32, help="effective batch size")
+    parser.add_argument('--micro-batch-size', type=int, nargs='+', default=[16, 8, 4], help="0 runs plain fit()")
+    parser.add_argument('--steps', type=int, default=4)
+    args = parser.parse_args()
+
+    size = (args.size, args.size)
+    if args.command == "run":
+        print(json.dumps(_bench_run(args.arch, size, args.batch_size, args.micro_batch_size[0], args.steps)))
+    else:
+        benchmark(args.arch, size, args.batch_size, args.micro_batch_size, args.steps)
@@ -0,0 +1,28 @@
+from ANN import build_ann
+from CNN import build_cnn
+from vgNet import build_vgnet
+from VGG16_2 import build_vgg16
+from accumulation import accumulate_gradients
+
+# Model builders of the Scripts/ architectures by name.
+# Each takes (input_shape, num_classes) and returns an uncompiled model. The softmax output layer
+# is pinned to float32 so it stays exact under the mixed_bfloat16 policy of precision.py.
+ARCHITECTURES = {
+    "ann": build_ann,
+    "cnn": build_cnn,
+    "vgg16": build_vgg16,
+    "vgg19": build_vgnet,
+}
+
+
+def build_model(name, input_shape=(224, 224, 3), num_classes=2, **kwargs):
+    if name not in ARCHITECTURES:
+        raise ValueError(f"Unknown architecture '{name}', expected one of {sorted(ARCHITECTURES)}")
+    return ARCHITECTURES[name](input_shape=input_shape, num_classes=num_classes, **kwargs)
+
+
+# get_ds_splits() yields integer labels, hence the sparse loss.
+# micro_batch_size turns on gradient accumulation, see accumulation.py
+def compile_model(model, optimizer="adam", micro_batch_size=None):
+    model.compile(loss="sparse_categorical_crossentropy", optimizer=optimizer, metrics=["accuracy"])
+    return accumulate_gradients(model, micro_batch_size)
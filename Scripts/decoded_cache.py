@@ -0,0 +1,84 @@
+import os
+import re
+import numpy as np
+
+from image_loader import decode_image, list_images
+
+# Kept outside datasets/ so structure_datasets() and the loaders never see it
+CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache")
+
+
+# Bumped whenever decode_image changes its output, so entries from an older decoder are never reused
+DECODER_VERSION = 2
+
+
+# Directory holding the decoded uint8 arrays of one dataset at one input size
+def cache_dir(dataset, img_size, channels=3):
+    return os.path.join(CACHE_DIR, dataset, f"decoded_v{DECODER_VERSION}_{img_size[0]}x{img_size[1]}x{channels}")
+
+
+# Every (img_size, channels) a dataset has been cached at
+def cached_variants(dataset):
+    variants = []
+    root = os.path.join(CACHE_DIR, dataset)
+    if os.path.isdir(root):
+        for name in sorted(os.listdir(root)):
+            m = re.fullmatch(rf"decoded_v{DECODER_VERSION}_(\d+)x(\d+)x(\d+)", name)
+            if m:
+                variants.append(((int(m[1]), int(m[2])), int(m[3])))
+    return variants
+
+
+# relpath is relative to the dataset directory, e.g. Train/Stroke/58 (1).jpg
+def entry_path(dataset, img_size, channels, relpath):
+    return os.path.join(cache_dir(dataset, img_size, channels), relpath + ".npy")
+
+
+# Entries carry the mtime of the file they were decoded from, so a file replaced in place with
+# an older mtime (shutil.copy2 keeps the source's) still misses the cache
+def _write_entry(path, arr, source):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp.npy"
+    np.save(tmp, arr)
+    mtime = os.stat(source).st_mtime_ns
+    os.utime(tmp, ns=(mtime, mtime))
+    os.replace(tmp, path)
+
+
+def _is_fresh(entry, source):
+    return os.path.exists(entry) and os.stat(entry).st_mtime_ns == os.stat(source).st_mtime_ns
+
+
+# (Re)decodes only the given files into the cache
+def update_entries(ds_path, dataset, relpaths, img_size, channels=3):
+    for rel in relpaths:
+        source = os.path.join(ds_path, rel)
+        _write_entry(entry_path(dataset, img_size, channels, rel), decode_image(source, img_size, channels), source)
+
+
+def remove_entries(dataset, relpaths, img_size, channels=3):
+    for rel in relpaths:
+        path = entry_path(dataset, img_size, channels, rel)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+# Loads a whole split as (images uint8 [n, h, w, c], labels, class_names) from the cache,
+# decoding only the files that are missing or changed since their cache entry was written
+def load_split(ds_path, split, img_size, channels=3):
+    dataset = os.path.basename(os.path.normpath(ds_path))
+    paths, labels, class_names = list_images(os.path.join(ds_path, split))
+
+    images = np.empty((len(paths), img_size[0], img_size[1], channels), dtype=np.uint8)
+    misses = 0
+    for i, path in enumerate(paths):
+        entry = entry_path(dataset, img_size, channels, os.path.relpath(path, ds_path))
+        if _is_fresh(entry, path):
+            images[i] = np.load(entry)
+        else:
+            images[i] = decode_image(path, img_size, channels)
+            _write_entry(entry, images[i], path)
+            misses += 1
+    if misses:
+        print(f"Decoded {misses} of {len(paths)} {split} images into the cache")
+    return images, np.array(labels, dtype=np.int32), class_names
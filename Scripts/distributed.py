@@ -0,0 +1,212 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import subprocess
+import tensorflow as tf
+
+from model_catalog import DATASET_DIRS, MODEL_PATHS
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+# Records epoch wall time and validation accuracy on the chief, for the scaling benchmark
+class EpochLog(tf.keras.callbacks.Callback):
+    def __init__(self, path, images_per_epoch):
+        super().__init__()
+        self.path = path
+        self.images_per_epoch = images_per_epoch
+        self.epochs = []
+
+    def on_train_begin(self, logs=None):
+        self.start = time.perf_counter()
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_start = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        now = time.perf_counter()
+        self.epochs.append({
+            "epoch": epoch + 1,
+            "seconds": now - self.epoch_start,
+            "elapsed": now - self.start,
+            "images_per_sec": self.images_per_epoch / (now - self.epoch_start),
+            "val_accuracy": float(logs.get("val_accuracy", 0.)),
+        })
+        if self.path:
+            with open(self.path, "w") as f:
+                json.dump(self.epochs, f)
+
+
+# Split the best model is picked on, the same one training.train validates on
+def validation_split(ds_path):
+    return "Valid" if os.path.isdir(os.path.join(ds_path, "Valid")) else "Test"
+
+
+# One worker of the cluster described by TF_CONFIG. Every worker builds its own input
+# pipeline over a disjoint shard of the files and a copy of the model, gradients are
+# all-reduced by MultiWorkerMirroredStrategy after every step.
+# With a run_dir the run goes through training.fit_resumable: the chief (worker 0) checkpoints
+# there and writes the best model to <run_dir>/best.h5, the other workers resume from it but
+# write their share of every save to a scratch directory.
+def train_worker(arch, ds_name, base_dir, image_size=(224, 224), batch_size=32, epochs=5, threads=None, log_path=None,
+                 run_dir=None, patience=5):
+    if threads:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+    strategy = tf.distribute.MultiWorkerMirroredStrategy()
+
+    from preprocess import get_ds_splits, process
+    from image_loader import image_dataset, list_images
+    from architectures import build_model, compile_model
+
+    task = json.loads(os.environ.get("TF_CONFIG", "{}")).get("task", {"index": 0})["index"]
+    global_batch = batch_size * strategy.num_replicas_in_sync
+    ds_path = os.path.join(base_dir, ds_name)
+    val_split = validation_split(ds_path)
+    n_train = len(list_images(os.path.join(ds_path, "Train"))[0])
+    n_val = len(list_images(os.path.join(ds_path, val_split))[0])
+    num_classes = len(list_images(os.path.join(ds_path, "Train"))[2])
+
+    # Shards can differ by a file, a fixed step count keeps the all-reduce in lockstep
+    steps = max(1, n_train // global_batch)
+    val_steps = max(1, n_val // global_batch)
+
+    def dataset_fn(split):
+        def fn(ctx):
+            shard = (ctx.num_input_pipelines, ctx.input_pipeline_id)
+            per_replica = ctx.get_per_replica_batch_size(global_batch)
+            if split == "Train":
+                return get_ds_splits(ds_name, base_dir, image_size, per_replica, shard)[0].repeat()
+            ds = image_dataset(os.path.join(ds_path, split), image_size, per_replica, shuffle=False, shard=shard)
+            return process(ds, per_replica, image_size, 1).repeat()
+        return tf.keras.utils.experimental.DatasetCreator(fn)
+
+    with strategy.scope():
+        kwargs = {"weights": None} if arch.startswith("vgg") else {}
+        model = compile_model(build_model(arch, (*image_size, 3), num_classes, **kwargs))
+
+    log = EpochLog(log_path if task == 0 else None, steps * global_batch)
+    fit_kwargs = {"steps_per_epoch": steps, "validation_steps": val_steps, "verbose": 2 if task == 0 else 0}
+    if run_dir is None:
+        model.fit(dataset_fn("Train"), epochs=epochs, validation_data=dataset_fn(val_split), callbacks=[log],
+                  **fit_kwargs)
+        return model
+
+    from training import fit_resumable
+    with tempfile.TemporaryDirectory() as scratch:
+        write_dir = run_dir if task == 0 else scratch
+        fit_resumable(model, dataset_fn("Train"), dataset_fn(val_split), epochs, run_dir, patience=patience,
+                      best_path=os.path.join(write_dir, "best.h5"), callbacks=[log], write_dir=write_dir, **fit_kwargs)
+    return model
+
+
+# Starts num_workers local worker processes wired together through TF_CONFIG and waits for them.
+# The cores are split evenly between the workers.
+def launch(num_workers, arch, ds_name, base_dir, image_size=(224, 224), batch_size=32, epochs=5, log_path=None,
+           run_dir=None, patience=5):
+    threads = max(1, (os.cpu_count() or 1) // num_workers)
+    cluster = {"worker": [f"localhost:{free_port()}" for _ in range(num_workers)]}
+    procs = []
+    for i in range(num_workers):
+        env = dict(os.environ, TF_CONFIG=json.dumps({"cluster": cluster, "task": {"type": "worker", "index": i}}))
+        cmd = [sys.executable, os.path.abspath(__file__), "worker", arch, ds_name, "--base-dir", base_dir,
+               "--size", str(image_size[0]), "--batch-size", str(batch_size), "--epochs", str(epochs),
+               "--threads", str(threads), "--patience", str(patience)]
+        if log_path:
+            cmd += ["--log", log_path]
+        if run_dir:
+            cmd += ["--run-dir", run_dir]
+        procs.append(subprocess.Popen(cmd, env=env))
+
+    codes = [p.wait() for p in procs]
+    if any(codes):
+        raise RuntimeError(f"Distributed training failed, worker exit codes {codes}")
+
+
+# Resumable distributed counterpart of training.train: trains in run_dir with num_workers local
+# workers, then replaces the served model of the dataset's test type with the run's best model
+# if that beats it on the validation split. Returns the path of the best model.
+def train(num_workers, arch, ds_name, base_dir, image_size=(224, 224), batch_size=32, epochs=5, patience=5,
+          run_dir=None, export=True, log_path=None):
+    from training import RUNS_DIR, promote_model
+    from preprocess import process
+    from image_loader import image_dataset
+
+    run_dir = run_dir or os.path.join(RUNS_DIR, f"{arch}_{ds_name.replace(' ', '_')}_{image_size[0]}_distributed")
+    os.makedirs(run_dir, exist_ok=True)
+    launch(num_workers, arch, ds_name, base_dir, image_size, batch_size, epochs, log_path, run_dir, patience)
+
+    best_path = os.path.join(run_dir, "best.h5")
+    test_type = next((t for t, d in DATASET_DIRS.items() if d == ds_name), None)
+    if export and test_type and os.path.exists(best_path):
+        ds_path = os.path.join(base_dir, ds_name)
+        val_ds = process(image_dataset(os.path.join(ds_path, validation_split(ds_path)), image_size, batch_size,
+                                       shuffle=False), batch_size, image_size, 1)
+        promote_model(best_path, MODEL_PATHS[test_type], val_ds)
+    return best_path
+
+
+# Images/sec and time to reach target_accuracy at each worker count, with a fixed per worker batch
+def benchmark(arch, ds_name, base_dir, worker_counts=(1, 2, 4), image_size=(224, 224), batch_size=32,
+              epochs=5, target_accuracy=0.8):
+    results = []
+    for n in worker_counts:
+        with tempfile.TemporaryDirectory() as tmp:
+            log_path = os.path.join(tmp, "log.json")
+            launch(n, arch, ds_name, base_dir, image_size, batch_size, epochs, log_path)
+            with open(log_path) as f:
+                epochs_log = json.load(f)
+
+        # The first epoch includes graph tracing and cache fill, leave it out of the throughput
+        steady = epochs_log[1:] or epochs_log
+        throughput = sum(e["images_per_sec"] for e in steady) / len(steady)
+        reached = next((e["elapsed"] for e in epochs_log if e["val_accuracy"] >= target_accuracy), None)
+        results.append({"workers": n, "images_per_sec": throughput, "time_to_accuracy": reached,
+                        "best_val_accuracy": max(e["val_accuracy"] for e in epochs_log)})
+
+    base = results[0]["images_per_sec"]
+    print(f"\n{arch} on {ds_name}, batch {batch_size}/worker, target val_accuracy {target_accuracy}")
+    for r in results:
+        tta = f"{r['time_to_accuracy']:.1f}s" if r["time_to_accuracy"] is not None else "not reached"
+        print(f"{r['workers']} workers: {r['images_per_sec']:8.1f} img/s ({r['images_per_sec'] / base:.2f}x), "
+              f"time to accuracy {tta}, best val_accuracy {r['best_val_accuracy']:.3f}")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Data parallel CPU training with MultiWorkerMirroredStrategy")
+    parser.add_argument('command', choices=["train", "worker", "benchmark"])
+    parser.add_argument('arch')
+    parser.add_argument('dataset')
+    parser.add_argument('--base-dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "datasets"))
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--size', type=int, default=224)
+    parser.add_argument('--batch-size', type=int, default=32, help="per worker batch size")
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--threads', type=int)
+    parser.add_argument('--target-accuracy', type=float, default=0.8)
+    parser.add_argument('--log')
+    parser.add_argument('--patience', type=int, default=5)
+    parser.add_argument('--run-dir', help="checkpoint and resume here, runs/<arch>_<dataset>_<size>_distributed by default")
+    parser.add_argument('--no-export', action='store_true', help="do not replace the served model with a better one")
+    args = parser.parse_args()
+
+    size = (args.size, args.size)
+    if args.command == "worker":
+        train_worker(args.arch, args.dataset, args.base_dir, size, args.batch_size, args.epochs, args.threads, args.log,
+                     args.run_dir, args.patience)
+    elif args.command == "train":
+        path = train(args.workers[0], args.arch, args.dataset, args.base_dir, size, args.batch_size, args.epochs,
+                     args.patience, args.run_dir, not args.no_export, args.log)
+        print(f"Best model: {path}")
+    else:
+        benchmark(args.arch, args.dataset, args.base_dir, args.workers, size, args.batch_size, args.epochs,
+                  args.target_accuracy)
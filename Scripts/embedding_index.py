@@ -0,0 +1,239 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INDEX_DIR = os.path.join(ROOT_DIR, ".cache", "index")
+DATASETS_DIR = os.path.join(ROOT_DIR, "datasets")
+
+
+def index_path(test_type):
+    return os.path.join(INDEX_DIR, test_type.replace("'", "").replace(" ", "_").lower())
+
+
+# Model giving the classifier's penultimate layer output, for encoded image bytes or, with
+# pixels=True, float 0-255 images. Shares the weights of the serving model.
+def embedding_model(serving_model, pixels=False):
+    import tensorflow as tf
+
+    classifier = serving_model.layers[-1]
+    features = tf.keras.Model(classifier.inputs, classifier.layers[-2].output, name=f"{classifier.name}_features")
+    rescale = serving_model.get_layer("resize_and_rescale")
+    if pixels:
+        inputs = tf.keras.Input(shape=classifier.input_shape[1:])
+        return tf.keras.Model(inputs, features(rescale(inputs)))
+    decode = serving_model.get_layer("decode_image")
+    return tf.keras.Model(serving_model.inputs, features(rescale(decode(serving_model.inputs[0]))))
+
+
+# Embeds every image of one split with the model's penultimate layer, batch by batch from the
+# decoded cache so the split is never converted to float as a whole
+def compute_embeddings(serving_model, ds_path, split="Train", batch_size=64):
+    from decoded_cache import load_split
+    from image_loader import list_images
+
+    embedder = embedding_model(serving_model, pixels=True)
+    h, w, channels = embedder.input_shape[1:]
+    paths, _, _ = list_images(os.path.join(ds_path, split))
+    images, labels, class_names = load_split(ds_path, split, (h, w), channels)
+    vectors = np.concatenate([embedder.predict_on_batch(images[i:i + batch_size].astype(np.float32))
+                              for i in range(0, len(images), batch_size)])
+    return vectors.reshape(len(vectors), -1), paths, labels, class_names
+
+
+def normalize(x):
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.maximum(np.linalg.norm(x, axis=-1, keepdims=True), 1e-12)
+
+
+def nearest_centroid(x, centroids):
+    d = (centroids ** 2).sum(1) - 2 * x @ centroids.T
+    return d.argmin(1)
+
+
+# Plain Lloyd's k-means, used for the IVF lists
+def kmeans(x, k, iters=20, seed=0):
+    x = np.asarray(x, dtype=np.float32)
+    k = min(k, len(x))
+    centroids = x[np.random.default_rng(seed).choice(len(x), k, replace=False)].copy()
+    for _ in range(iters):
+        assign = nearest_centroid(x, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        counts = np.bincount(assign, minlength=k)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+    return centroids, nearest_centroid(x, centroids)
+
+
+def top_k(scores, k):
+    k = min(k, len(scores))
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+# Default number of IVF lists, about sqrt(n): with nprobe lists scanned a query reads roughly
+# nprobe / sqrt(n) of the index, and the centroids it compares against first stay few
+def default_nlist(n):
+    return max(1, int(round(np.sqrt(n))))
+
+
+# Writes an index directory: unit vectors stored as float32, grouped into nlist IVF lists (sqrt(n)
+# by default, 0 for a flat index) so a query only scans the lists nearest to it.
+# Entries holds one {"path", "label"} per vector.
+def write_index(out_dir, vectors, entries, class_names, nlist=None, **meta):
+    vectors = normalize(vectors)
+    n, dim = vectors.shape
+    nlist = default_nlist(n) if nlist is None else min(nlist, n)
+    tmp_dir = out_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    ids = np.arange(n, dtype=np.int32)
+    if nlist:
+        centroids, assign = kmeans(vectors, nlist)
+        ids = np.argsort(assign, kind="stable").astype(np.int32)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=len(centroids)))])
+        np.save(os.path.join(tmp_dir, "centroids.npy"), normalize(centroids))
+        np.save(os.path.join(tmp_dir, "offsets.npy"), offsets.astype(np.int64))
+    np.save(os.path.join(tmp_dir, "ids.npy"), ids)
+    np.save(os.path.join(tmp_dir, "vectors.npy"), vectors[ids])
+
+    meta.update(dim=dim, size=n, nlist=nlist or None, class_names=class_names, entries=entries)
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp_dir, out_dir)
+    return out_dir
+
+
+# Read only view of an index directory. The arrays are memory mapped, as plain ndarrays so
+# slicing them per query does not go through np.memmap.
+class EmbeddingIndex:
+    def __init__(self, directory):
+        with open(os.path.join(directory, "meta.json")) as f:
+            self.meta = json.load(f)
+        load = lambda name: np.asarray(np.load(os.path.join(directory, name), mmap_mode="r"))
+        self.ids = load("ids.npy")
+        self.vectors = load("vectors.npy")
+        self.centroids = None if self.meta["nlist"] is None else np.array(load("centroids.npy"))
+        self.offsets = None if self.meta["nlist"] is None else np.array(load("offsets.npy"))
+
+    def __len__(self):
+        return self.meta["size"]
+
+    # Top k entries by cosine similarity as (scores, entry indices).
+    # With IVF only the nprobe lists closest to the query are scanned.
+    def search(self, query, k=5, nprobe=8):
+        q = normalize(np.ravel(query))
+        if self.centroids is None or nprobe >= len(self.centroids):
+            scores = self.vectors @ q
+            top = top_k(scores, k)
+            return scores[top], self.ids[top]
+
+        lists = np.sort(np.argpartition(-(self.centroids @ q), nprobe - 1)[:nprobe])
+        rows = np.concatenate([np.arange(self.offsets[l], self.offsets[l + 1]) for l in lists])
+        scores = self.vectors[rows] @ q
+        top = top_k(scores, k)
+        return scores[top], self.ids[rows[top]]
+
+    # Search results as dicts with the image path, class name and similarity
+    def similar(self, query, k=5, nprobe=8):
+        scores, ids = self.search(query, k, nprobe)
+        results = []
+        for score, i in zip(scores, ids):
+            entry = self.meta["entries"][i]
+            results.append({"path": entry["path"], "label": self.meta["class_names"][entry["label"]],
+                            "score": float(score)})
+        return results
+
+
+def load_index(test_type):
+    path = index_path(test_type)
+    return EmbeddingIndex(path) if os.path.exists(os.path.join(path, "meta.json")) else None
+
+
+# Builds the index of one served model over the Train split of its dataset
+def build_index(test_type, base_dir=DATASETS_DIR, nlist=None, model_paths=None):
+    from serving import MODEL_PATHS, DATASET_DIRS, load_serving_models
+
+    model_paths = model_paths or MODEL_PATHS
+    model = load_serving_models({test_type: model_paths[test_type]})[test_type]
+    start = time.perf_counter()
+    vectors, paths, labels, class_names = compute_embeddings(model, os.path.join(base_dir, DATASET_DIRS[test_type]))
+    entries = [{"path": os.path.abspath(p), "label": int(l)} for p, l in zip(paths, labels)]
+    out_dir = write_index(index_path(test_type), vectors, entries, class_names, nlist,
+                          test_type=test_type, model=model_paths[test_type])
+    print(f"{test_type}: indexed {len(entries)} images ({vectors.shape[1]} dims) in "
+          f"{time.perf_counter() - start:.1f}s -> {out_dir}")
+    return out_dir
+
+
+# Query latency and recall@k of the flat and IVF indexes against exact float32 search
+def benchmark(vectors, queries, k=5, nlist=None, nprobe=8):
+    exact_vectors, queries = normalize(vectors), normalize(queries)
+    truth = [set(top_k(exact_vectors @ q, k)) for q in queries]
+
+    # The naive per request approach, comparing against every image as float32
+    start = time.perf_counter()
+    for q in queries:
+        top_k(exact_vectors @ q, k)
+    print(f"{'exact float32':>22}: {(time.perf_counter() - start) / len(queries) * 1e3:7.3f} ms/query, recall@{k} 1.000")
+
+    nlist = default_nlist(len(vectors)) if nlist is None else nlist
+    entries = [{"path": "", "label": 0}] * len(vectors)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, lists in (("flat", 0), (f"IVF{nlist}, nprobe {nprobe}", nlist)):
+            index_dir = write_index(os.path.join(tmp, str(lists)), vectors, entries, ["0"], lists)
+            index = EmbeddingIndex(index_dir)
+            start = time.perf_counter()
+            found = [index.search(q, k, nprobe)[1] for q in queries]
+            latency = (time.perf_counter() - start) / len(queries) * 1e3
+            recall = np.mean([len(t & set(f)) / k for t, f in zip(truth, found)])
+            results.append({"index": name, "ms_per_query": latency, "recall": float(recall)})
+            print(f"{name:>22}: {latency:7.3f} ms/query, recall@{k} {recall:.3f}")
+    return results
+
+
+# Clustered, low rank, mostly non negative stand in embeddings, shaped like the penultimate
+# ReLU activations of a classifier, for benchmarking without trained models
+def synthetic_vectors(n=7000, dim=128, clusters=40, rank=16, queries=200, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, rank))
+    z = centers[rng.integers(0, clusters, n + queries)] + 0.5 * rng.normal(size=(n + queries, rank))
+    x = np.maximum(z @ rng.normal(size=(rank, dim)), 0) + 0.1 * rng.normal(size=(n + queries, dim))
+    return x[:n].astype(np.float32), x[n:].astype(np.float32)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Similar case retrieval index over model embeddings")
+    parser.add_argument('command', choices=["build", "benchmark"])
+    parser.add_argument('test_types', nargs='*', help="served models to index, all of them by default")
+    parser.add_argument('--base-dir', default=DATASETS_DIR)
+    parser.add_argument('--nlist', type=int, help="number of IVF lists, about sqrt(n) by default, 0 for a flat index")
+    parser.add_argument('--nprobe', type=int, default=8)
+    parser.add_argument('-k', type=int, default=5)
+    parser.add_argument('--synthetic', action='store_true', help="benchmark on clustered random embeddings")
+    args = parser.parse_args()
+
+    from serving import MODEL_PATHS, DATASET_DIRS, load_serving_models
+
+    test_types = args.test_types or list(DATASET_DIRS)
+    if args.command == "build":
+        for test_type in test_types:
+            build_index(test_type, args.base_dir, args.nlist)
+    elif args.synthetic:
+        benchmark(*synthetic_vectors(), args.k, args.nlist, args.nprobe)
+    else:
+        for test_type in test_types:
+            model = load_serving_models({test_type: MODEL_PATHS[test_type]})[test_type]
+            ds_path = os.path.join(args.base_dir, DATASET_DIRS[test_type])
+            train, _, _, _ = compute_embeddings(model, ds_path, "Train")
+            test, _, _, _ = compute_embeddings(model, ds_path, "Test")
+            print(f"\n{test_type}: {len(train)} indexed, {len(test)} queries")
+            benchmark(train, test, args.k, args.nlist, args.nprobe)
@@ -0,0 +1,206 @@
+import os
+import time
+import hashlib
+import argparse
+import tempfile
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import layers
+
+from serving import preprocessing_layers
+
+METHODS = ("mean", "vote")
+
+
+# Combines the class probabilities of the members: "mean" is a (weighted) average of the
+# probabilities, "vote" a (weighted) majority vote over the members' top classes
+@tf.keras.utils.register_keras_serializable(package="brain")
+class CombinePredictions(layers.Layer):
+    def __init__(self, method="mean", member_weights=None, **kwargs):
+        super().__init__(**kwargs)
+        if method not in METHODS:
+            raise ValueError(f"Unknown ensemble method '{method}', expected one of {METHODS}")
+        self.method = method
+        self.member_weights = None if member_weights is None else [float(w) for w in member_weights]
+
+    def call(self, inputs):
+        probs = tf.stack(inputs, axis=1)
+        w = tf.constant(self.member_weights or [1.] * len(inputs), dtype=probs.dtype)
+        w = w / tf.reduce_sum(w)
+        if self.method == "vote":
+            probs = tf.one_hot(tf.argmax(probs, axis=-1), tf.shape(probs)[-1], dtype=probs.dtype)
+        return tf.einsum("bmc,m->bc", probs, w)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({"method": self.method, "member_weights": self.member_weights})
+        return config
+
+
+# The classifier inside a serving model (bytes input), or the model itself
+def classifier_of(model):
+    if model.inputs[0].dtype == tf.string:
+        return model.layers[-1]
+    return model
+
+
+# Pixel scale a member expects: the Rescaling of a serving model's preprocessing (1 for models
+# exported with --raw-pixels), or default for a bare classifier
+def input_scale(model, default=1./255):
+    if model.inputs[0].dtype == tf.string:
+        return float(model.get_layer("resize_and_rescale").layers[-1].scale)
+    return default
+
+
+def weights_fingerprint(model):
+    h = hashlib.sha1(f"{type(model).__name__}{model.input_shape}".encode())
+    for w in model.weights:
+        h.update(w.numpy().tobytes())
+    return h.hexdigest()
+
+
+# Splits a Sequential whose first layer is a nested model (VGG16/VGG19 base) into that backbone
+# and the layers after it. Members without one are run whole.
+def split_backbone(model):
+    if isinstance(model, tf.keras.Sequential) and isinstance(model.layers[0], tf.keras.Model):
+        return model.layers[0], model.layers[1:]
+    return None, None
+
+
+# One graph running every member on the same batch. Inputs are float 0-255 images of the largest
+# member input size, each distinct input size and scale is resized and rescaled once, and members
+# whose backbones have identical weights (e.g. the frozen imagenet VGG16 of VGG16.py and VGG16_2.py)
+# run it once and only branch into their own heads. scale is used for members that are not serving
+# models, serving models keep their own.
+def build_ensemble(members, method="mean", member_weights=None, scale=1./255):
+    scales = [input_scale(m, scale) for m in members]
+    members = [classifier_of(m) for m in members]
+    num_classes = {m.output_shape[-1] for m in members}
+    channels = {m.input_shape[-1] for m in members}
+    if len(num_classes) > 1 or len(channels) > 1:
+        raise ValueError(f"Members disagree on classes {num_classes} or channels {channels}")
+    if member_weights is not None and len(member_weights) != len(members):
+        raise ValueError(f"{len(member_weights)} weights given for {len(members)} members")
+
+    shapes = [tuple(m.input_shape[1:]) for m in members]
+    inputs = tf.keras.Input(shape=max(shapes, key=lambda s: s[0] * s[1]), name="images")
+    resized, backbones, outputs = {}, {}, []
+    for i, (member, shape, member_scale) in enumerate(zip(members, shapes, scales)):
+        if (shape, member_scale) not in resized:
+            resized[shape, member_scale] = preprocessing_layers(
+                shape[0], shape[1], member_scale, name=f"resize_{shape[0]}x{shape[1]}_{len(resized)}")(inputs)
+        x = resized[shape, member_scale]
+
+        backbone, head = split_backbone(member)
+        if backbone is None:
+            outputs.append(tf.keras.Sequential([member], name=f"member_{i}")(x))
+            continue
+        key = (shape, member_scale, weights_fingerprint(backbone))
+        if key not in backbones:
+            backbones[key] = tf.keras.Sequential([backbone], name=f"backbone_{len(backbones)}")(x)
+        outputs.append(tf.keras.Sequential(head, name=f"member_{i}_head")(backbones[key]))
+
+    combined = CombinePredictions(method, member_weights, name="combine")(outputs)
+    model = tf.keras.Model(inputs, combined, name="ensemble")
+    # Backbone passes the ensemble skips compared with running the members one by one
+    model.shared_backbones = sum(split_backbone(m)[0] is not None for m in members) - len(backbones)
+    return model
+
+
+def load_members(paths):
+    return [tf.keras.models.load_model(p, compile=False) for p in paths]
+
+
+def _median_seconds(fn, repeats):
+    fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+# Median batch latency of the ensemble against running every member separately, each member
+# getting its own resize of the same batch
+def benchmark_latency(ensemble, members, images, repeats=5, scale=1./255):
+    scales = [input_scale(m, scale) for m in members]
+    members = [classifier_of(m) for m in members]
+    images = tf.constant(images, dtype=tf.float32)
+    member_inputs = [tf.image.resize(images, m.input_shape[1:3]) * s for m, s in zip(members, scales)]
+    member_times = [_median_seconds(lambda: m.predict_on_batch(x), repeats) for m, x in zip(members, member_inputs)]
+    ensemble_time = _median_seconds(lambda: ensemble.predict_on_batch(images), repeats)
+
+    for i, (m, t) in enumerate(zip(members, member_times)):
+        print(f"member {i} ({m.name}): {t * 1e3:8.1f} ms")
+    print(f"sum of members: {sum(member_times) * 1e3:8.1f} ms")
+    print(f"ensemble      : {ensemble_time * 1e3:8.1f} ms ({sum(member_times) / ensemble_time:.2f}x faster, "
+          f"{ensemble.shared_backbones} backbone passes saved) for a batch of {len(images)}")
+    return {"members_ms": [t * 1e3 for t in member_times], "sum_ms": sum(member_times) * 1e3,
+            "ensemble_ms": ensemble_time * 1e3}
+
+
+# Accuracy of every member and of the ensemble on a split, read through the decoded cache
+def evaluate(ensemble, members, ds_path, split="Test", batch_size=32, scale=1./255):
+    from decoded_cache import load_split
+
+    scales = [input_scale(m, scale) for m in members]
+    members = [classifier_of(m) for m in members]
+    h, w, channels = ensemble.input_shape[1:]
+    images, labels, class_names = load_split(ds_path, split, (h, w), channels)
+    models = members + [ensemble]
+    correct = np.zeros(len(models))
+    for i in range(0, len(images), batch_size):
+        x = tf.constant(images[i:i + batch_size], dtype=tf.float32)
+        y = labels[i:i + batch_size]
+        for j, m in enumerate(models):
+            inputs = x if m is ensemble else tf.image.resize(x, m.input_shape[1:3]) * scales[j]
+            correct[j] += (np.argmax(m.predict_on_batch(inputs), axis=1) == y).sum()
+
+    accuracy = correct / len(images)
+    for j, m in enumerate(members):
+        print(f"member {j} ({m.name}) {split} accuracy: {accuracy[j]:.4f}")
+    print(f"ensemble ({ensemble.get_layer('combine').method}) {split} accuracy: {accuracy[-1]:.4f}")
+    return accuracy.tolist()
+
+
+# Untrained stand in members: two VGG16 heads over the same frozen backbone (like VGG16.py and
+# VGG16_2.py with imagenet weights), a CNN and an ANN
+def synthetic_members(directory, input_shape=(124, 124, 3), num_classes=2):
+    from architectures import build_model
+
+    vgg_a = build_model("vgg16", input_shape, num_classes, weights=None)
+    vgg_b = build_model("vgg16", input_shape, num_classes, weights=None)
+    vgg_b.layers[0].set_weights(vgg_a.layers[0].get_weights())
+    paths = []
+    for name, model in (("vgg16_a", vgg_a), ("vgg16_b", vgg_b), ("cnn", build_model("cnn", input_shape, num_classes)),
+                        ("ann", build_model("ann", input_shape, num_classes))):
+        paths.append(os.path.join(directory, f"{name}.h5"))
+        model.save(paths[-1])
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Multi-head ensemble sharing backbone computation between members")
+    parser.add_argument('models', nargs='*', help="member .h5 models")
+    parser.add_argument('--method', choices=METHODS, default="mean")
+    parser.add_argument('--weights', type=float, nargs='+', help="one weight per member")
+    parser.add_argument('--dataset', help="dataset folder to report Test accuracy on")
+    parser.add_argument('--split', default="Test")
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--export', help="save the ensemble graph to this .h5")
+    parser.add_argument('--synthetic', action='store_true', help="benchmark with untrained stand in members")
+    parser.add_argument('--raw-pixels', action='store_true',
+                        help="members that are not serving models were trained on 0-255 inputs")
+    args = parser.parse_args()
+    scale = 1. if args.raw_pixels else 1./255
+
+    with tempfile.TemporaryDirectory() as tmp:
+        members = load_members(synthetic_members(tmp) if args.synthetic else args.models)
+        ensemble = build_ensemble(members, args.method, args.weights, scale)
+        images = np.random.default_rng(0).uniform(0, 255, (args.batch_size, *ensemble.input_shape[1:]))
+        benchmark_latency(ensemble, members, images, scale=scale)
+        if args.dataset:
+            evaluate(ensemble, members, args.dataset, args.split, scale=scale)
+        if args.export:
+            ensemble.save(args.export)
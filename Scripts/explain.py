@@ -0,0 +1,192 @@
+import io
+import os
+import time
+import hashlib
+import argparse
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache", "gradcam")
+
+
+def image_hash(contents):
+    return hashlib.sha1(contents).hexdigest()
+
+
+# Jet colour map as a 256 entry lookup table, 0-255 per channel
+def _jet():
+    x = np.linspace(0, 1, 256)[:, None]
+    return np.clip(1.5 - np.abs(4 * x - np.array([3, 2, 1])), 0, 1) * 255
+
+
+JET = _jet()
+
+
+# Grad-CAM graph of a serving model: encoded bytes in, (last 4D feature map, logits, probabilities) out.
+# The classifier is replayed layer by layer, so a nested VGG16/VGG19 base counts as the feature map.
+# The final softmax is split off so gradients are taken on the logits, which do not saturate.
+def gradcam_model(serving_model):
+    import tensorflow as tf
+    from tensorflow.keras import layers
+
+    classifier = serving_model.layers[-1]
+    if not isinstance(classifier, tf.keras.Sequential):
+        raise ValueError(f"{classifier.name} is not a Sequential classifier")
+    inputs = tf.keras.Input(shape=(), dtype=tf.string, name="image_bytes")
+    x = serving_model.get_layer("resize_and_rescale")(serving_model.get_layer("decode_image")(inputs))
+    features = None
+    for layer in classifier.layers[:-1]:
+        x = layer(x)
+        if len(x.shape) == 4:
+            features = x
+    if features is None:
+        raise ValueError(f"{classifier.name} has no convolutional layer to explain")
+
+    last = classifier.layers[-1]
+    logits_layer = layers.Dense.from_config({**last.get_config(), "activation": "linear", "name": f"{last.name}_logits"})
+    logits = logits_layer(x)
+    logits_layer.set_weights(last.get_weights())
+    return tf.keras.Model(inputs, [features, logits, layers.Softmax()(logits)])
+
+
+# Grad-CAM for batches of encoded images with one tape pass per batch. Results are cached by image
+# hash under the model's weights fingerprint, in memory and in .cache/gradcam, so reruns of the
+# classify page and repeated uploads never recompute.
+class Explainer:
+    def __init__(self, serving_model, cache_dir=CACHE_DIR, memory_items=256):
+        import tensorflow as tf
+        from ensemble import weights_fingerprint
+
+        self.model = gradcam_model(serving_model)
+        self.fingerprint = weights_fingerprint(serving_model.layers[-1])[:16]
+        self.cache_dir = os.path.join(cache_dir, self.fingerprint) if cache_dir else None
+        self.memory = OrderedDict()
+        self.memory_items = memory_items
+        self._batch = tf.function(self._gradcam)
+
+    def _gradcam(self, images):
+        import tensorflow as tf
+
+        with tf.GradientTape() as tape:
+            features, logits, probs = self.model(images, training=False)
+            # Each image's score only depends on its own features, so one gradient call covers the batch
+            score = tf.reduce_max(logits, axis=-1)
+        grads = tape.gradient(score, features)
+        cams = tf.nn.relu(tf.einsum("bhwc,bc->bhw", features, tf.reduce_mean(grads, axis=(1, 2))))
+        return cams / (tf.reduce_max(cams, axis=(1, 2), keepdims=True) + 1e-8), probs
+
+    def _lookup(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        if self.cache_dir and os.path.exists(os.path.join(self.cache_dir, key + ".npz")):
+            with np.load(os.path.join(self.cache_dir, key + ".npz")) as f:
+                result = (f["cam"].astype(np.float32), f["probs"])
+            self._remember(key, result)
+            return result
+        return None
+
+    def _remember(self, key, result):
+        self.memory[key] = result
+        if len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def _store(self, key, result):
+        self._remember(key, result)
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp = os.path.join(self.cache_dir, key + ".tmp.npz")
+            np.savez(tmp, cam=result[0].astype(np.float16), probs=result[1])
+            os.replace(tmp, os.path.join(self.cache_dir, key + ".npz"))
+
+    # images is a list of encoded image bytes, returns a (heatmap 0-1 at feature map resolution,
+    # class probabilities) pair per image
+    def explain(self, images):
+        import tensorflow as tf
+
+        images = [bytes(b) for b in images]
+        keys = [image_hash(b) for b in images]
+        results = [self._lookup(k) for k in keys]
+        missing = [i for i, r in enumerate(results) if r is None]
+        if missing:
+            cams, probs = self._batch(tf.constant([images[i] for i in missing]))
+            for j, i in enumerate(missing):
+                results[i] = (cams[j].numpy(), probs[j].numpy())
+                self._store(keys[i], results[i])
+        return results
+
+
+# Blends a heatmap over the image for display. The image is decoded straight at display size
+# (JPEG draft mode) and only the small heatmap is upscaled.
+def overlay(contents, cam, max_size=384, alpha=0.4):
+    with Image.open(io.BytesIO(contents)) as img:
+        img.draft("RGB", (max_size, max_size))
+        img = img.convert("RGB")
+        img.thumbnail((max_size, max_size), Image.BILINEAR)
+        base = np.asarray(img, dtype=np.float32)
+    heat = Image.fromarray(np.uint8(np.clip(cam, 0, 1) * 255)).resize(img.size, Image.BILINEAR)
+    return np.uint8((1 - alpha) * base + alpha * JET[np.asarray(heat)])
+
+
+# Added latency per explanation over a plain predict: batched single tape pass, the naive
+# per image tape loop, and cache hits
+def benchmark(serving_model, images, batch_size=8, repeats=3, name=None):
+    import tensorflow as tf
+
+    explainer = Explainer(serving_model, cache_dir=None)
+    batches = [images[i:i + batch_size] for i in range(0, len(images), batch_size)]
+
+    def timed(fn):
+        fn(batches[0])
+        start = time.perf_counter()
+        for _ in range(repeats):
+            for batch in batches:
+                fn(batch)
+        return (time.perf_counter() - start) / (repeats * len(images)) * 1e3
+
+    def batched(batch):
+        explainer.memory.clear()
+        explainer.explain(batch)
+
+    def naive(batch):
+        for contents in batch:
+            with tf.GradientTape() as tape:
+                features, logits, _ = explainer.model(tf.constant([contents]), training=False)
+                score = tf.reduce_max(logits)
+            grads = tape.gradient(score, features)
+            tf.nn.relu(tf.reduce_sum(features * tf.reduce_mean(grads, axis=(1, 2), keepdims=True), axis=-1))
+
+    predict = timed(lambda batch: serving_model.predict_on_batch(tf.constant(batch)))
+    results = {"predict": predict, "batched": timed(batched), "naive": timed(naive),
+               "cached": timed(explainer.explain)}
+    print(f"{name or serving_model.layers[-1].name}, batch {batch_size}: predict {predict:.2f} ms/image")
+    for name in ("batched", "naive", "cached"):
+        print(f"{name:>8} Grad-CAM: {results[name]:8.2f} ms/image ({results[name] - predict:+8.2f} ms over predict)")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Grad-CAM latency benchmark")
+    parser.add_argument('test_types', nargs='*', help="served models to benchmark, all of them by default")
+    parser.add_argument('--images', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "datasets"))
+    parser.add_argument('--limit', type=int, default=32)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--synthetic', action='store_true', help="use untrained CNN/VGG16/VGG19 stand ins")
+    args = parser.parse_args()
+
+    from image_loader import sample_images
+    images = [open(p, "rb").read() for p in sample_images(args.images, args.limit)]
+    if args.synthetic:
+        from architectures import build_model
+        from serving import build_serving_model
+        models = {}
+        for name in ("cnn", "vgg16", "vgg19"):
+            kwargs = {} if name == "cnn" else {"weights": None}
+            models[name] = build_serving_model(build_model(name, (124, 124, 3), 2, **kwargs))
+    else:
+        from serving import MODEL_PATHS, load_serving_models
+        models = load_serving_models({t: MODEL_PATHS[t] for t in args.test_types or MODEL_PATHS})
+    for name, model in models.items():
+        benchmark(model, images, args.batch_size, name=name)
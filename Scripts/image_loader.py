@@ -0,0 +1,187 @@
+import os
+import time
+import argparse
+import functools
+import numpy as np
+import tensorflow as tf
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif')
+
+# Per dataset list of files to leave out, see validate.py. Kept under .cache/<dataset>/ with the
+# other derived data, so structure_datasets() never mistakes it for a class folder.
+QUARANTINE_FILE = "quarantine.txt"
+CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache")
+
+# JPEG can be decoded directly at 1/2, 1/4 or 1/8 of its size in the DCT domain
+JPEG_RATIOS = (8, 4, 2, 1)
+
+
+# Decodes encoded bytes inside the graph to float32 in 0-255 like image_dataset_from_directory.
+# For JPEGs much larger than the target, libjpeg decodes at 1/2, 1/4 or 1/8 scale (fast=False always
+# decodes at full size), other formats fall back to a full decode. Grayscale, palette, RGBA and CMYK
+# all come out with the requested channel count. The JPEG ratio has to be a constant, so pick it with
+# a switch.
+def decode_bytes(contents, target_size, channels=3, fast=True):
+    ratios = JPEG_RATIOS if fast else JPEG_RATIOS[-1:]
+
+    def decode_jpeg():
+        shape = tf.image.extract_jpeg_shape(contents)
+        fits = [tf.logical_and(shape[0] // r >= target_size[0], shape[1] // r >= target_size[1])
+                for r in ratios[:-1]] + [tf.constant(True)]
+        branch = tf.argmax(tf.cast(tf.stack(fits), tf.int32), output_type=tf.int32)
+        return tf.switch_case(branch, [
+            lambda r=r: tf.image.decode_jpeg(contents, channels=channels, ratio=r) for r in ratios
+        ])
+
+    def decode_other():
+        return tf.image.decode_image(contents, channels=channels, expand_animations=False)
+
+    img = tf.cond(tf.image.is_jpeg(contents), decode_jpeg, decode_other)
+    img.set_shape([None, None, channels])
+    return tf.image.resize(img, target_size)
+
+
+# decode_bytes traced once per output size, for decoding single files outside of tf.data
+@functools.lru_cache(maxsize=None)
+def _decoder(target_size, channels, fast):
+    return tf.function(lambda contents: decode_bytes(contents, target_size, channels, fast),
+                       input_signature=[tf.TensorSpec([], tf.string)])
+
+
+# Decodes an image (path or file object) to a uint8 (h, w, channels) array of the target size.
+# Same decoder as the serving graph and the tf.data loaders, only rounded to uint8 for the caches,
+# so cached pixels never differ from what production sees by more than half a gray level.
+def decode_image(source, target_size, channels=3, fast=True):
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            contents = f.read()
+    else:
+        contents = source.read()
+    img = _decoder(tuple(target_size), channels, fast)(tf.constant(contents)).numpy()
+    return np.clip(np.rint(img), 0, 255).astype(np.uint8)
+
+
+# decode_bytes for a file path, used by the tf.data loaders
+def tf_decode_image(path, target_size, channels=3):
+    return decode_bytes(tf.io.read_file(path), target_size, channels)
+
+
+def quarantine_path(dataset):
+    return os.path.join(CACHE_DIR, dataset, QUARANTINE_FILE)
+
+
+# Files listed in a dataset's quarantine.txt (written by validate.py), as normalized paths.
+# Looked up for the directory and its parent, so a dataset or one of its splits can be passed.
+def load_quarantine(directory):
+    quarantined = set()
+    for root in (directory, os.path.dirname(os.path.normpath(directory))):
+        path = quarantine_path(os.path.basename(os.path.normpath(root)))
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    rel = line.split("\t")[0].strip()
+                    if rel and not rel.startswith("#"):
+                        quarantined.add(os.path.normpath(os.path.join(root, rel)))
+    return quarantined
+
+
+# Lists the images of a <class>/<image> directory with integer labels from the sorted class names,
+# leaving out quarantined files
+def list_images(directory):
+    class_names = sorted(d for d in os.listdir(directory) if os.path.isdir(os.path.join(directory, d)))
+    quarantined = load_quarantine(directory)
+    paths, labels = [], []
+    skipped = 0
+    for label, class_name in enumerate(class_names):
+        class_dir = os.path.join(directory, class_name)
+        for name in sorted(os.listdir(class_dir)):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                if os.path.normpath(os.path.join(class_dir, name)) in quarantined:
+                    skipped += 1
+                    continue
+                paths.append(os.path.join(class_dir, name))
+                labels.append(label)
+    if skipped:
+        print(f"Skipped {skipped} quarantined files in {directory}")
+    return paths, labels, class_names
+
+
+# Drop in for image_dataset_from_directory (int labels, batched, class_names attribute)
+# that goes through the reduced resolution decode. shard=(num_shards, index) keeps every
+# num_shards-th file, before decoding, so workers never decode files they throw away.
+def image_dataset(directory, image_size=(256, 256), batch_size=32, channels=3, shuffle=True, seed=21, shard=None):
+    paths, labels, class_names = list_images(directory)
+    print(f"Found {len(paths)} files belonging to {len(class_names)} classes.")
+
+    ds = tf.data.Dataset.from_tensor_slices((paths, labels))
+    if shard is not None:
+        ds = ds.shard(*shard)
+        paths = paths[shard[1]::shard[0]]
+    if shuffle:
+        ds = ds.shuffle(len(paths), seed=seed)
+    ds = ds.map(lambda p, y: (tf_decode_image(p, image_size, channels), y),
+                num_parallel_calls=tf.data.AUTOTUNE)
+    ds = ds.batch(batch_size)
+    ds.class_names = class_names
+    return ds
+
+
+# Collects up to limit images from every dataset under base_dir
+def sample_images(base_dir, limit=None):
+    paths = []
+    for root, _, files in os.walk(base_dir):
+        paths.extend(os.path.join(root, f) for f in sorted(files) if f.lower().endswith(IMAGE_EXTENSIONS))
+    return paths[:limit] if limit else paths
+
+
+# Times full and reduced resolution decoding over the same files
+def benchmark_decode(paths, target_size=(124, 124), channels=3):
+    results = {}
+    for fast in (False, True):
+        start = time.perf_counter()
+        for p in paths:
+            decode_image(p, target_size, channels, fast=fast)
+        results['draft' if fast else 'full'] = (time.perf_counter() - start) / len(paths) * 1000
+
+    start = time.perf_counter()
+    for _ in tf.data.Dataset.from_tensor_slices(paths).map(
+            lambda p: tf_decode_image(p, target_size, channels), num_parallel_calls=tf.data.AUTOTUNE):
+        pass
+    results['tf.data'] = (time.perf_counter() - start) / len(paths) * 1000
+
+    for name, ms in results.items():
+        print(f"{name:>8}: {ms:.3f} ms/image")
+    print(f"speedup : {results['full'] / results['draft']:.2f}x")
+    return results
+
+
+# Checks that the fast path barely changes what a model predicts
+def compare_predictions(model, paths, batch_size=32):
+    target_size = tuple(model.input_shape[1:3])
+    channels = model.input_shape[-1]
+    full, fast = [], []
+    for i in range(0, len(paths), batch_size):
+        chunk = paths[i:i + batch_size]
+        full.append(model.predict(np.stack([decode_image(p, target_size, channels, fast=False) for p in chunk]), verbose=0))
+        fast.append(model.predict(np.stack([decode_image(p, target_size, channels) for p in chunk]), verbose=0))
+    full, fast = np.concatenate(full), np.concatenate(fast)
+
+    max_diff = float(np.abs(full - fast).max())
+    agreement = float((full.argmax(axis=1) == fast.argmax(axis=1)).mean())
+    print(f"max |p_full - p_fast| = {max_diff:.4f}, top-1 agreement = {agreement:.2%}")
+    return max_diff, agreement
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Decode latency benchmark for the reduced resolution JPEG path")
+    parser.add_argument('--data', default=os.path.join(os.path.dirname(__file__), '..', 'datasets'))
+    parser.add_argument('--size', type=int, default=124)
+    parser.add_argument('--limit', type=int, default=1000)
+    parser.add_argument('--model', help="optional .h5 model to compare predictions with")
+    args = parser.parse_args()
+
+    paths = sample_images(args.data)
+    paths = [paths[i] for i in np.random.default_rng(21).permutation(len(paths))[:args.limit]]
+    benchmark_decode(paths, (args.size, args.size))
+    if args.model:
+        compare_predictions(tf.keras.models.load_model(args.model), paths)
@@ -0,0 +1,151 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import argparse
+
+import decoded_cache
+from image_loader import IMAGE_EXTENSIONS
+
+# structure_datasets() splits 60/40 into Train and Test. Datasets that also have a Valid split keep the
+# same 60% for training and divide the other 40% into Test and Valid, again 60/40.
+SPLITS_WITH_VALID = (("Train", .6), ("Test", .24), ("Valid", .16))
+SPLITS = (("Train", .6), ("Test", .4))
+
+
+def manifest_path(dataset):
+    return os.path.join(decoded_cache.CACHE_DIR, dataset, "manifest.json")
+
+
+def load_manifest(dataset):
+    path = manifest_path(dataset)
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def save_manifest(dataset, manifest):
+    path = manifest_path(dataset)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# Deterministic split for a new file: depends only on its class and name, never on the other files,
+# so adding or removing files elsewhere never moves an existing assignment
+def assign_split(relpath, splits):
+    u = int(hashlib.sha1(relpath.encode()).hexdigest()[:8], 16) / 16 ** 8
+    total = 0.
+    for name, ratio in splits:
+        total += ratio
+        if u < total:
+            return name
+    return splits[-1][0]
+
+
+# Landing files are the <class>/<image> files next to the split directories
+def scan_landing(ds_path, split_names):
+    files = {}
+    for class_name in sorted(os.listdir(ds_path)):
+        class_dir = os.path.join(ds_path, class_name)
+        if class_name in split_names or class_name.startswith(".") or not os.path.isdir(class_dir):
+            continue
+        for name in os.listdir(class_dir):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                st = os.stat(os.path.join(class_dir, name))
+                files[f"{class_name}/{name}"] = (st.st_size, st.st_mtime)
+    return files
+
+
+# Split an already structured file was copied to, used to adopt the existing layout on the first run
+def existing_split(ds_path, relpath, split_names):
+    for split in split_names:
+        if os.path.exists(os.path.join(ds_path, split, relpath)):
+            return split
+    return None
+
+
+# Brings one dataset up to date with its landing folders.
+# New files get a split, changed files are recopied into the split they already have, and decoded
+# caches are patched for just those files. structure_datasets() deletes the landing folders after
+# splitting, so a file missing from them is only deleted from its split with prune=True.
+def ingest_dataset(ds_path, dry_run=False, prune=False):
+    start = time.perf_counter()
+    dataset = os.path.basename(os.path.normpath(ds_path))
+    splits = SPLITS_WITH_VALID if os.path.isdir(os.path.join(ds_path, "Valid")) else SPLITS
+    split_names = [name for name, _ in splits]
+
+    manifest = load_manifest(dataset)
+    landing = scan_landing(ds_path, split_names)
+    added, changed, removed = [], [], []
+
+    for rel, (size, mtime) in landing.items():
+        entry = manifest.get(rel)
+        if entry is not None and entry["size"] == size and entry["mtime"] == mtime:
+            continue
+        digest = file_hash(os.path.join(ds_path, rel))
+        if entry is None:
+            split = existing_split(ds_path, rel, split_names)
+            if split is None:
+                split = assign_split(rel, splits)
+                added.append(f"{split}/{rel}")
+            manifest[rel] = {"size": size, "mtime": mtime, "sha1": digest, "split": split}
+        else:
+            if entry["sha1"] != digest:
+                changed.append(f"{entry['split']}/{rel}")
+            entry.update(size=size, mtime=mtime, sha1=digest)
+
+    missing = [rel for rel in manifest if rel not in landing]
+    if prune:
+        for rel in missing:
+            removed.append(f"{manifest.pop(rel)['split']}/{rel}")
+
+    if not dry_run:
+        for rel in added + changed:
+            os.makedirs(os.path.dirname(os.path.join(ds_path, rel)), exist_ok=True)
+            shutil.copy2(os.path.join(ds_path, rel.split("/", 1)[1]), os.path.join(ds_path, rel))
+        for rel in removed:
+            if os.path.exists(os.path.join(ds_path, rel)):
+                os.remove(os.path.join(ds_path, rel))
+        update_caches(ds_path, dataset, added + changed, removed)
+        save_manifest(dataset, manifest)
+
+    elapsed = time.perf_counter() - start
+    print(f"{dataset}: {len(landing)} files, +{len(added)} new, ~{len(changed)} changed, "
+          f"-{len(removed)} removed in {elapsed:.2f}s")
+    if missing and not prune:
+        print(f"{dataset}: kept {len(missing)} files that are no longer in the landing folders, "
+              f"use --prune to delete them from their splits")
+    return added, changed, removed
+
+
+# Patches every cache built for the dataset, only for the files that moved
+def update_caches(ds_path, dataset, updated, removed):
+    for img_size, channels in decoded_cache.cached_variants(dataset):
+        decoded_cache.update_entries(ds_path, dataset, updated, img_size, channels)
+        decoded_cache.remove_entries(dataset, removed, img_size, channels)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Incrementally ingest new, changed or removed scans")
+    parser.add_argument('base_dir', nargs='?', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "datasets"))
+    parser.add_argument('datasets', nargs='*', help="dataset folder names, all of them by default")
+    parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--prune', action='store_true',
+                        help="delete files that are no longer in the landing folders from their splits")
+    args = parser.parse_args()
+
+    for dataset in args.datasets or sorted(os.listdir(args.base_dir)):
+        if os.path.isdir(os.path.join(args.base_dir, dataset)):
+            ingest_dataset(os.path.join(args.base_dir, dataset), args.dry_run, args.prune)
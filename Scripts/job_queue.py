@@ -0,0 +1,312 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import argparse
+import threading
+import multiprocessing as mp
+
+DEFAULT_DB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "jobs.sqlite")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    test_type TEXT NOT NULL,
+    image BLOB NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    result TEXT,
+    error TEXT,
+    worker TEXT,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+CREATE TABLE IF NOT EXISTS workers (
+    name TEXT PRIMARY KEY,
+    pid INTEGER,
+    started REAL,
+    heartbeat REAL,
+    busy_seconds REAL DEFAULT 0,
+    jobs_done INTEGER DEFAULT 0
+);
+"""
+
+# A worker that has not checked in for this long is considered dead
+HEARTBEAT_TIMEOUT = 30
+
+# How often a worker checks in, whatever it is doing
+HEARTBEAT_INTERVAL = 5
+
+
+# Opens the queue database. WAL lets the page poll while workers write,
+# transactions are explicit (BEGIN IMMEDIATE) so claiming jobs is atomic across processes.
+# check_same_thread=False lets one connection serve the threads of web.py's sessions.
+def connect(db_path=DEFAULT_DB, check_same_thread=True):
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=check_same_thread)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def enqueue(conn, test_type, image_bytes):
+    cur = conn.execute(
+        "INSERT INTO jobs (test_type, image, created) VALUES (?, ?, ?)",
+        (test_type, sqlite3.Binary(image_bytes), time.time())
+    )
+    return cur.lastrowid
+
+
+def get_job(conn, job_id):
+    row = conn.execute(
+        "SELECT id, test_type, status, result, error, created, started, finished FROM jobs WHERE id = ?",
+        (job_id,)
+    ).fetchone()
+    if row is None:
+        return None
+    job = dict(row)
+    job["result"] = json.loads(job["result"]) if job["result"] else None
+    return job
+
+
+# Number of queued jobs ahead of this one
+def queue_position(conn, job_id):
+    return conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND id < ?", (job_id,)).fetchone()[0]
+
+
+# Claims up to limit of the oldest queued jobs for one model, so a batch goes through a single predict call
+def claim_batch(conn, worker, limit):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        first = conn.execute("SELECT test_type FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1").fetchone()
+        if first is None:
+            conn.execute("COMMIT")
+            return None, []
+        rows = conn.execute(
+            "SELECT id, image FROM jobs WHERE status = 'queued' AND test_type = ? ORDER BY id LIMIT ?",
+            (first["test_type"], limit)
+        ).fetchall()
+        conn.executemany(
+            "UPDATE jobs SET status = 'running', worker = ?, started = ? WHERE id = ?",
+            [(worker, time.time(), row["id"]) for row in rows]
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return first["test_type"], rows
+
+
+# Finished jobs drop their image, only queued and running jobs need it
+def complete(conn, results):
+    now = time.time()
+    conn.executemany(
+        "UPDATE jobs SET status = 'done', result = ?, finished = ?, image = X'' WHERE id = ?",
+        [(json.dumps(probs), now, job_id) for job_id, probs in results]
+    )
+
+
+def fail(conn, job_ids, error):
+    now = time.time()
+    conn.executemany(
+        "UPDATE jobs SET status = 'failed', error = ?, finished = ?, image = X'' WHERE id = ?",
+        [(error, now, job_id) for job_id in job_ids]
+    )
+
+
+# Clears images still held by finished jobs, e.g. from before complete() and fail() dropped them
+def clear_finished_images(conn):
+    cur = conn.execute("UPDATE jobs SET image = X'' WHERE status IN ('done', 'failed') AND length(image) > 0")
+    return cur.rowcount
+
+
+# Puts jobs claimed by dead workers back in the queue, this is what makes jobs survive restarts
+def recover_jobs(conn, timeout=HEARTBEAT_TIMEOUT):
+    cutoff = time.time() - timeout
+    cur = conn.execute(
+        """UPDATE jobs SET status = 'queued', worker = NULL, started = NULL
+           WHERE status = 'running' AND worker NOT IN (SELECT name FROM workers WHERE heartbeat >= ?)""",
+        (cutoff,)
+    )
+    return cur.rowcount
+
+
+def register_worker(conn, worker, pid=None):
+    now = time.time()
+    conn.execute(
+        "INSERT OR REPLACE INTO workers (name, pid, started, heartbeat) VALUES (?, ?, ?, ?)",
+        (worker, pid or os.getpid(), now, now)
+    )
+
+
+def heartbeat(conn, worker, busy_seconds=0, jobs_done=0):
+    conn.execute(
+        "UPDATE workers SET heartbeat = ?, busy_seconds = busy_seconds + ?, jobs_done = jobs_done + ? WHERE name = ?",
+        (time.time(), busy_seconds, jobs_done, worker)
+    )
+
+
+# Checks the worker in every interval seconds from a thread with its own connection, so a batch
+# that runs longer than HEARTBEAT_TIMEOUT (say one retried job by job) neither gets its jobs
+# requeued by recover_jobs nor makes the pool look dead to web.py. Set the returned event to stop.
+def start_heartbeat(db_path, worker, interval=HEARTBEAT_INTERVAL):
+    stop = threading.Event()
+
+    def beat():
+        conn = connect(db_path)
+        try:
+            while not stop.wait(interval):
+                heartbeat(conn, worker)
+        finally:
+            conn.close()
+
+    threading.Thread(target=beat, name=f"heartbeat {worker}", daemon=True).start()
+    return stop
+
+
+def workers_alive(conn, timeout=HEARTBEAT_TIMEOUT):
+    return conn.execute("SELECT COUNT(*) FROM workers WHERE heartbeat >= ?", (time.time() - timeout,)).fetchone()[0]
+
+
+# Queue depth and per worker utilization (busy time / time alive), used to size the pool
+def queue_metrics(conn, timeout=HEARTBEAT_TIMEOUT):
+    now = time.time()
+    depth = dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+    oldest = conn.execute("SELECT MIN(created) FROM jobs WHERE status = 'queued'").fetchone()[0]
+    recent = conn.execute(
+        "SELECT COUNT(*), AVG(finished - created), AVG(finished - started) FROM jobs WHERE status = 'done' AND finished >= ?",
+        (now - 60,)
+    ).fetchone()
+
+    workers = []
+    for row in conn.execute("SELECT * FROM workers WHERE heartbeat >= ? ORDER BY name", (now - timeout,)):
+        alive = max(row["heartbeat"] - row["started"], 1e-6)
+        workers.append({
+            "name": row["name"],
+            "jobs_done": row["jobs_done"],
+            "utilization": row["busy_seconds"] / alive,
+        })
+
+    return {
+        "queued": depth.get("queued", 0),
+        "running": depth.get("running", 0),
+        "done": depth.get("done", 0),
+        "failed": depth.get("failed", 0),
+        "oldest_queued_seconds": now - oldest if oldest else 0.,
+        "jobs_last_minute": recent[0],
+        "mean_latency_seconds": recent[1] or 0.,
+        "mean_service_seconds": recent[2] or 0.,
+        "workers": workers,
+        "mean_utilization": sum(w["utilization"] for w in workers) / len(workers) if workers else 0.,
+    }
+
+
+# Runs claimed jobs through a model. A batch that raises (one corrupt upload fails the decode of the
+# whole batch) is retried job by job, so only the jobs that also fail on their own are failed.
+# Returns ([(job_id, probs)], [(job_id, error)]).
+def predict_jobs(model, rows):
+    import tensorflow as tf
+
+    images = [bytes(row["image"]) for row in rows]
+    try:
+        probs = model.predict(tf.constant(images), batch_size=len(images), verbose=0)
+        return [(row["id"], p) for row, p in zip(rows, probs.tolist())], []
+    except Exception as e:
+        if len(rows) == 1:
+            return [], [(rows[0]["id"], f"{type(e).__name__}: {e}")]
+
+    results, failures = [], []
+    for row, image in zip(rows, images):
+        try:
+            results.append((row["id"], model.predict(tf.constant([image]), batch_size=1, verbose=0)[0].tolist()))
+        except Exception as e:
+            failures.append((row["id"], f"{type(e).__name__}: {e}"))
+    return results, failures
+
+
+# Claims and processes one batch, returns the number of jobs handled
+def process_batch(conn, name, models, batch_size=16):
+    test_type, rows = claim_batch(conn, name, batch_size)
+    if not rows:
+        return 0
+
+    start = time.perf_counter()
+    if test_type not in models:
+        fail(conn, [row["id"] for row in rows], f"KeyError: model '{test_type}' is not loaded")
+    else:
+        results, failures = predict_jobs(models[test_type], rows)
+        complete(conn, results)
+        for job_id, error in failures:
+            fail(conn, [job_id], error)
+    heartbeat(conn, name, time.perf_counter() - start, len(rows))
+    return len(rows)
+
+
+# Worker process: loads the models once and drains the queue in batches, checking in from start_heartbeat
+def worker_loop(db_path=DEFAULT_DB, batch_size=16, poll_interval=0.2, threads=None):
+    import tensorflow as tf
+    from serving import load_serving_models
+
+    if threads:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    name = f"{socket.gethostname()}:{os.getpid()}"
+    conn = connect(db_path)
+    models = load_serving_models(on_error=lambda model, e: print(f"[{name}] could not load '{model}': {e}"))
+    register_worker(conn, name)
+    start_heartbeat(db_path, name)
+
+    while True:
+        if not process_batch(conn, name, models, batch_size):
+            time.sleep(poll_interval)
+
+
+# Starts the worker pool. Workers are spawned, not forked, since TensorFlow is not fork safe.
+def start_workers(num_workers, db_path=DEFAULT_DB, batch_size=16, threads=None):
+    conn = connect(db_path)
+    print(f"Requeued {recover_jobs(conn)} interrupted jobs")
+    clear_finished_images(conn)
+    conn.close()
+
+    ctx = mp.get_context("spawn")
+    procs = [ctx.Process(target=worker_loop, args=(db_path, batch_size, 0.2, threads), daemon=True)
+             for _ in range(num_workers)]
+    for p in procs:
+        p.start()
+    return procs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Classification job queue workers")
+    parser.add_argument('--db', default=DEFAULT_DB)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--threads', type=int, default=max(1, os.cpu_count() // 2), help="TF threads per worker")
+    parser.add_argument('--metrics', action='store_true', help="print queue metrics and exit")
+    args = parser.parse_args()
+
+    if args.metrics:
+        print(json.dumps(queue_metrics(connect(args.db)), indent=2))
+    else:
+        procs = start_workers(args.workers, args.db, args.batch_size, args.threads)
+        conn = connect(args.db)
+        try:
+            while True:
+                time.sleep(10)
+                # Restart crashed workers and hand their jobs to the rest of the pool
+                for i, p in enumerate(procs):
+                    if not p.is_alive():
+                        procs[i] = mp.get_context("spawn").Process(
+                            target=worker_loop, args=(args.db, args.batch_size, 0.2, args.threads), daemon=True)
+                        procs[i].start()
+                recover_jobs(conn)
+                m = queue_metrics(conn)
+                print(f"queued={m['queued']} running={m['running']} workers={len(m['workers'])} "
+                      f"utilization={m['mean_utilization']:.0%} latency={m['mean_latency_seconds']:.2f}s")
+        except KeyboardInterrupt:
+            for p in procs:
+                p.terminate()
@@ -0,0 +1,187 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from sklearn.model_selection import StratifiedKFold
+
+import decoded_cache
+from image_loader import list_images
+
+SPLIT_NAMES = ("Train", "Test", "Valid")
+
+
+# Identifies the labelled files of the given splits by relative path, label, size and mtime.
+# Catches files added, removed, quarantined or replaced in place (ingest.py recopies changed scans
+# over the old path with their source mtime), none of which has to touch a directory mtime.
+def files_fingerprint(ds_path, splits):
+    h = hashlib.sha1()
+    for split in splits:
+        paths, labels, _ = list_images(os.path.join(ds_path, split))
+        for path, label in zip(paths, labels):
+            st = os.stat(path)
+            h.update(f"{os.path.relpath(path, ds_path)}\t{label}\t{st.st_size}\t{st.st_mtime_ns}\n".encode())
+    return h.hexdigest()
+
+
+# Decodes every labelled image of a dataset once into a single .npy that fold processes memory map
+# read-only, so all of them share the same page cache instead of holding private copies.
+# Per file decoding goes through decoded_cache, so a rebuild after ingestion only decodes the delta.
+# splits picks the splits merged into it, each choice is cached under its own name.
+def build_shared_cache(ds_path, img_size=(224, 224), channels=3, splits=SPLIT_NAMES):
+    dataset = os.path.basename(os.path.normpath(ds_path))
+    root = decoded_cache.cache_dir(dataset, img_size, channels)
+    name = "kfold" if tuple(splits) == SPLIT_NAMES else "kfold_" + "_".join(s.lower() for s in splits)
+    images_path = os.path.join(root, f"{name}_images.npy")
+    labels_path = os.path.join(root, f"{name}_labels.npy")
+    meta_path = os.path.join(root, f"{name}_meta.json")
+
+    splits = [s for s in splits if os.path.isdir(os.path.join(ds_path, s))]
+    fingerprint = files_fingerprint(ds_path, splits)
+    if os.path.exists(meta_path) and os.path.exists(images_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get("fingerprint") == fingerprint:
+            return images_path, labels_path, meta
+
+    start = time.perf_counter()
+    parts, labels, class_names = [], [], None
+    for split in splits:
+        x, y, names = decoded_cache.load_split(ds_path, split, img_size, channels)
+        if class_names is not None and names != class_names:
+            raise ValueError(f"{split} classes {names} do not match {class_names}")
+        class_names = names
+        parts.append(x)
+        labels.append(y)
+
+    os.makedirs(root, exist_ok=True)
+    np.save(images_path, np.concatenate(parts))
+    np.save(labels_path, np.concatenate(labels))
+    meta = {"class_names": class_names, "splits": splits, "fingerprint": fingerprint,
+            "decode_seconds": time.perf_counter() - start}
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+    return images_path, labels_path, meta
+
+
+# Gives each fold process its share of the cores, has to run before TensorFlow starts
+def _init_worker(threads):
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+# Batches are gathered from the memory mapped cache, indices sorted so reads stay sequential
+def fold_dataset(images, labels, indices, batch_size, shuffle=False, seed=43):
+    import tensorflow as tf
+    from serving import preprocessing_layers
+
+    def gather(idx):
+        idx = np.sort(idx)
+        return images[idx], labels[idx]
+
+    shape = images.shape[1:]
+    rescale = preprocessing_layers(shape[0], shape[1])
+    ds = tf.data.Dataset.from_tensor_slices(indices)
+    if shuffle:
+        ds = ds.shuffle(len(indices), seed=seed)
+    ds = ds.batch(batch_size).map(
+        lambda idx: tf.numpy_function(gather, [idx], (tf.uint8, tf.int32)),
+        num_parallel_calls=tf.data.AUTOTUNE)
+    ds = ds.map(lambda x, y: (rescale(tf.ensure_shape(tf.cast(x, tf.float32), (None, *shape))),
+                              tf.ensure_shape(y, (None,))))
+    return ds.prefetch(tf.data.AUTOTUNE)
+
+
+def train_fold(arch, images_path, labels_path, fold, train_idx, val_idx, num_classes, epochs, batch_size, weights):
+    import tensorflow as tf
+    from architectures import build_model, compile_model
+
+    images = np.load(images_path, mmap_mode="r")
+    labels = np.load(labels_path, mmap_mode="r")
+
+    tf.keras.utils.set_random_seed(43 + fold)
+    kwargs = {"weights": weights} if arch.startswith("vgg") else {}
+    model = compile_model(build_model(arch, images.shape[1:], num_classes, **kwargs))
+
+    start = time.perf_counter()
+    history = model.fit(
+        fold_dataset(images, labels, train_idx, batch_size, shuffle=True, seed=43 + fold),
+        epochs=epochs,
+        validation_data=fold_dataset(images, labels, val_idx, batch_size),
+        verbose=0
+    )
+    train_seconds = time.perf_counter() - start
+
+    return {
+        "fold": fold,
+        "train_size": len(train_idx),
+        "val_size": len(val_idx),
+        "val_accuracy": float(history.history["val_accuracy"][-1]),
+        "val_loss": float(history.history["val_loss"][-1]),
+        "best_val_accuracy": float(max(history.history["val_accuracy"])),
+        "train_seconds": train_seconds,
+    }
+
+
+# Runs k stratified folds of one architecture in a process pool and aggregates the results
+def run_kfold(arch, ds_path, k=5, processes=2, epochs=5, batch_size=32, img_size=(224, 224), weights=None):
+    images_path, labels_path, meta = build_shared_cache(ds_path, img_size)
+    labels = np.load(labels_path)
+    folds = StratifiedKFold(n_splits=k, shuffle=True, random_state=43).split(np.zeros(len(labels)), labels)
+
+    processes = min(processes, k)
+    threads = max(1, (os.cpu_count() or 1) // processes)
+    start = time.perf_counter()
+    with ProcessPoolExecutor(processes, mp_context=mp.get_context("spawn"),
+                             initializer=_init_worker, initargs=(threads,)) as pool:
+        futures = [pool.submit(train_fold, arch, images_path, labels_path, i, train_idx, val_idx,
+                               len(meta["class_names"]), epochs, batch_size, weights)
+                   for i, (train_idx, val_idx) in enumerate(folds)]
+        results = [f.result() for f in futures]
+
+    acc = np.array([r["val_accuracy"] for r in results])
+    summary = {
+        "arch": arch,
+        "dataset": os.path.basename(os.path.normpath(ds_path)),
+        "k": k,
+        "processes": processes,
+        "threads_per_process": threads,
+        "images": len(labels),
+        "decode_seconds": meta["decode_seconds"],
+        "wall_seconds": time.perf_counter() - start,
+        "val_accuracy_mean": float(acc.mean()),
+        "val_accuracy_std": float(acc.std()),
+        "folds": results,
+    }
+    for r in results:
+        print(f"fold {r['fold']}: val_accuracy {r['val_accuracy']:.4f} "
+              f"(best {r['best_val_accuracy']:.4f}) in {r['train_seconds']:.1f}s")
+    print(f"{arch}: {summary['val_accuracy_mean']:.4f} +/- {summary['val_accuracy_std']:.4f} over {k} folds, "
+          f"{summary['wall_seconds']:.1f}s wall with {processes} processes x {threads} threads")
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Parallel k-fold cross-validation over a shared decoded cache")
+    parser.add_argument('arch')
+    parser.add_argument('dataset')
+    parser.add_argument('--base-dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "datasets"))
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--processes', type=int, default=2)
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--size', type=int, default=224)
+    parser.add_argument('--imagenet', action='store_true', help="start VGG backbones from imagenet weights")
+    parser.add_argument('--out', help="write the summary as json")
+    args = parser.parse_args()
+
+    summary = run_kfold(args.arch, os.path.join(args.base_dir, args.dataset), args.folds, args.processes,
+                        args.epochs, args.batch_size, (args.size, args.size), "imagenet" if args.imagenet else None)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(summary, f, indent=2)
@@ -0,0 +1,35 @@
+import os
+
+# Served models and their classes. Kept free of TensorFlow so web workers behind a model host
+# and the report writer can import it.
+
+# Models served by web.py and the job queue workers, keyed by test type
+MODEL_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODEL_PATHS = {
+    "Brain Stroke": os.path.join(MODEL_DIR, "brain_stroke.h5"),
+    "Alzheimer's": os.path.join(MODEL_DIR, "alzheimer.h5"),
+    "Tumor": os.path.join(MODEL_DIR, "tumor.h5")
+}
+
+
+# Dataset folder under datasets/ each served model is trained on
+DATASET_DIRS = {
+    "Brain Stroke": "Brain Stroke",
+    "Alzheimer's": "Alzheimer_s Dataset",
+    "Tumor": "Tumor"
+}
+
+
+# Output classes of each model, in the sorted directory order the loaders assign labels in
+CLASS_NAMES = {
+    "Brain Stroke": ["Normal", "Stroke"],
+    "Alzheimer's": ["MildDemented", "ModerateDemented", "NonDemented", "VeryMildDemented"],
+    "Tumor": ["glioma", "meningioma", "notumor", "pituitary"]
+}
+
+# The class that means no finding for each test type
+NEGATIVE_CLASS = {
+    "Brain Stroke": "Normal",
+    "Alzheimer's": "NonDemented",
+    "Tumor": "notumor"
+}
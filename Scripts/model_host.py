@@ -0,0 +1,241 @@
+import os
+import time
+import secrets
+import tempfile
+import argparse
+import threading
+import multiprocessing as mp
+from multiprocessing.managers import BaseManager
+
+import numpy as np
+
+DEFAULT_ADDRESS = "127.0.0.1:6006"
+KEY_ENV = "BRAIN_MODEL_HOST_KEY"
+
+
+# Shared secret of the host and the web workers. The manager connection exchanges pickles, so
+# whoever holds the key can run code in the host: there is no default, it has to be set.
+def authkey():
+    key = os.environ.get(KEY_ENV)
+    if not key:
+        raise RuntimeError(f"Set {KEY_ENV} to the same random secret for the model host and the web workers, "
+                           "e.g. python -c 'import secrets; print(secrets.token_hex(32))'")
+    return key.encode()
+
+
+def parse_address(address):
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+# Lives in the host process and owns the only copy of the weights.
+# Each client connection is served on its own thread, a lock per model keeps predict calls serialized.
+class ModelService:
+    def __init__(self, model_paths=None):
+        from serving import MODEL_PATHS, load_serving_models, image_model
+
+        self.models = load_serving_models(model_paths or MODEL_PATHS, on_error=lambda name, e: print(f"could not load '{name}': {e}"))
+        self.pixel_models = {name: image_model(m) for name, m in self.models.items()}
+        self.embedders = {}
+        self.explainers = {}
+        self.locks = {name: threading.Lock() for name in self.models}
+
+    def names(self):
+        return list(self.models)
+
+    def input_shape(self, test_type):
+        return self.pixel_models[test_type].input_shape
+
+    # images is a list of encoded image bytes
+    def predict(self, test_type, images):
+        import tensorflow as tf
+        with self.locks[test_type]:
+            return self.models[test_type].predict(tf.constant(images), batch_size=len(images), verbose=0)
+
+    # images is a float 0-255 pixel batch, e.g. slices from volumes.py
+    def predict_pixels(self, test_type, images):
+        with self.locks[test_type]:
+            return self.pixel_models[test_type].predict(images, verbose=0)
+
+    # Penultimate layer embeddings of encoded images, for embedding_index.py
+    def embed(self, test_type, images):
+        import tensorflow as tf
+        from embedding_index import embedding_model
+        with self.locks[test_type]:
+            if test_type not in self.embedders:
+                self.embedders[test_type] = embedding_model(self.models[test_type])
+            return self.embedders[test_type].predict(tf.constant(images), batch_size=len(images), verbose=0)
+
+    # Grad-CAM heatmaps and probabilities of encoded images, see explain.py
+    def explain(self, test_type, images):
+        from explain import Explainer
+        with self.locks[test_type]:
+            if test_type not in self.explainers:
+                self.explainers[test_type] = Explainer(self.models[test_type])
+            return self.explainers[test_type].explain(images)
+
+
+class ModelHostManager(BaseManager):
+    pass
+
+
+_service = None
+
+
+def _get_service():
+    return _service
+
+
+ModelHostManager.register("service", callable=_get_service)
+
+
+# Runs the host in this process: loads the models once, then serves every web worker
+def serve(address=DEFAULT_ADDRESS, model_paths=None, ready=None):
+    global _service
+    _service = ModelService(model_paths)
+    manager = ModelHostManager(address=parse_address(address), authkey=authkey())
+    server = manager.get_server()
+    print(f"Serving {_service.names()} on {address}")
+    if ready is not None:
+        ready.set()
+    server.serve_forever()
+
+
+# Keras like stand in for a model held by the host, only exposes what web.py and volumes.py call
+# plus embed() and explain() for the similar case index and Grad-CAM.
+# Needs no TensorFlow on the client side.
+class RemoteModel:
+    def __init__(self, service, test_type, pixels=False):
+        self.service = service
+        self.test_type = test_type
+        self.pixels = pixels
+
+    @property
+    def input_shape(self):
+        return self.service.input_shape(self.test_type) if self.pixels else (None,)
+
+    def predict(self, images, verbose=0, **kwargs):
+        if self.pixels:
+            return self.service.predict_pixels(self.test_type, np.asarray(images, dtype=np.float32))
+        if hasattr(images, "numpy"):
+            images = images.numpy()
+        return self.service.predict(self.test_type, [bytes(b) for b in images])
+
+    def embed(self, images):
+        if hasattr(images, "numpy"):
+            images = images.numpy()
+        return self.service.embed(self.test_type, [bytes(b) for b in images])
+
+    def explain(self, images):
+        return self.service.explain(self.test_type, [bytes(b) for b in images])
+
+    # Pixel input view, the remote counterpart of serving.image_model()
+    def pixel_view(self):
+        return RemoteModel(self.service, self.test_type, pixels=True)
+
+
+# Connects to a running host and returns {test_type: RemoteModel}
+def connect_models(address=DEFAULT_ADDRESS, retries=30, delay=1.):
+    manager = ModelHostManager(address=parse_address(address), authkey=authkey())
+    for attempt in range(retries):
+        try:
+            manager.connect()
+            break
+        except ConnectionRefusedError:
+            if attempt == retries - 1:
+                raise
+            time.sleep(delay)
+    service = manager.service()
+    return {name: RemoteModel(service, name) for name in service.names()}
+
+
+def rss_mb(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.
+
+
+# Benchmark worker: holds models like a web worker would (private copy or host proxies) and waits
+def _bench_worker(mode, model_paths, address, image_path, loaded, stop):
+    if mode == "private":
+        from serving import MODEL_PATHS, load_serving_models
+        models = load_serving_models(model_paths or MODEL_PATHS)
+    else:
+        models = connect_models(address)
+    with open(image_path, "rb") as f:
+        image = np.array([f.read()], dtype=object)
+    for model in models.values():
+        model.predict(image)
+    loaded.set()
+    stop.wait()
+
+
+# Measures the total resident memory of N web workers with private models vs one shared host
+def benchmark_rss(model_paths, worker_counts=(1, 2, 4), address="127.0.0.1:6017"):
+    # Spawned processes inherit the environment, a throwaway key covers a benchmark run
+    os.environ.setdefault(KEY_ENV, secrets.token_hex(32))
+    ctx = mp.get_context("spawn")
+    image_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "brain1.jpg")
+    results = []
+    for mode in ("private", "shared"):
+        host = None
+        if mode == "shared":
+            ready = ctx.Event()
+            host = ctx.Process(target=serve, args=(address, model_paths, ready), daemon=True)
+            host.start()
+            ready.wait()
+
+        for n in worker_counts:
+            stop = ctx.Event()
+            events = [ctx.Event() for _ in range(n)]
+            procs = [ctx.Process(target=_bench_worker, args=(mode, model_paths, address, image_path, e, stop), daemon=True)
+                     for e in events]
+            for p in procs:
+                p.start()
+            for e in events:
+                e.wait()
+
+            workers = sum(rss_mb(p.pid) for p in procs)
+            host_mb = rss_mb(host.pid) if host else 0.
+            results.append((mode, n, workers + host_mb))
+            print(f"{mode:>8} x{n}: workers {workers:8.1f} MB + host {host_mb:8.1f} MB = {workers + host_mb:8.1f} MB "
+                  f"({(workers + host_mb) / n:7.1f} MB/worker)")
+
+            stop.set()
+            for p in procs:
+                p.join()
+        if host:
+            host.terminate()
+    return results
+
+
+# Stand in models the size of the VGG16 based classifiers, for benchmarking without trained weights
+def synthetic_model_paths(directory):
+    import tensorflow as tf
+    from serving import MODEL_PATHS
+
+    paths = {}
+    for name, path in MODEL_PATHS.items():
+        base = tf.keras.applications.VGG16(include_top=False, weights=None, input_shape=(124, 124, 3))
+        model = tf.keras.Sequential([base, tf.keras.layers.Flatten(), tf.keras.layers.Dense(128, activation="relu"),
+                                     tf.keras.layers.Dense(4, activation="softmax")])
+        paths[name] = os.path.join(directory, os.path.basename(path))
+        model.save(paths[name])
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Hosts the served models once for every web worker process")
+    parser.add_argument('command', choices=["serve", "benchmark"])
+    parser.add_argument('--address', default=DEFAULT_ADDRESS)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--synthetic', action='store_true', help="benchmark with VGG16 sized stand in models")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve(args.address)
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            benchmark_rss(synthetic_model_paths(tmp) if args.synthetic else None, args.workers)
@@ -0,0 +1,158 @@
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+import numpy as np
+import tensorflow as tf
+
+PRECISIONS = ("float32", "mixed_bfloat16", "auto")
+
+# Layers whose output stays float32 under mixed precision, probabilities lose too much in bf16
+FLOAT32_ACTIVATIONS = ("softmax", "sigmoid")
+
+
+# oneDNN only runs bf16 natively with AVX512_BF16 or AMX, elsewhere it is emulated and slower than float32
+def bf16_supported():
+    if os.environ.get("TF_ENABLE_ONEDNN_OPTS") == "0":
+        return False
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = next((line.split(":", 1)[1].split() for line in f if line.startswith("flags")), [])
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+# Resolves "auto" and falls back to float32 when the CPU has no fast bf16
+def resolve_precision(precision="auto"):
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision '{precision}', expected one of {PRECISIONS}")
+    if precision == "float32":
+        return precision
+    if bf16_supported():
+        return "mixed_bfloat16"
+    if precision == "mixed_bfloat16":
+        print("This CPU has no native bf16 support (AVX512_BF16/AMX), falling back to float32")
+    return "float32"
+
+
+# Sets the Keras global policy for models built afterwards, returns the policy applied
+def set_precision(precision="auto"):
+    policy = resolve_precision(precision)
+    tf.keras.mixed_precision.set_global_policy(policy)
+    return policy
+
+
+def _rewrite_dtypes(config, policy):
+    if isinstance(config, list):
+        return [_rewrite_dtypes(c, policy) for c in config]
+    if not isinstance(config, dict):
+        return config
+    config = {k: _rewrite_dtypes(v, policy) for k, v in config.items()}
+    layer_config = config.get("config")
+    if "class_name" in config and isinstance(layer_config, dict) and "dtype" in layer_config \
+            and config["class_name"] != "InputLayer":
+        keep = config["class_name"] == "Softmax" or layer_config.get("activation") in FLOAT32_ACTIVATIONS
+        layer_config["dtype"] = "float32" if keep else policy
+    return config
+
+
+# Rebuilds a loaded model (plain or serving graph, nested models included) under another policy
+# with the same weights. Softmax/sigmoid outputs stay float32.
+def convert_model(model, precision="auto"):
+    policy = resolve_precision(precision)
+    config = _rewrite_dtypes({"class_name": type(model).__name__, "config": model.get_config()}, policy)["config"]
+    converted = type(model).from_config(config)
+    converted.set_weights(model.get_weights())
+    return converted
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# One benchmark configuration in a fresh process, the policy is global and peak RSS only grows
+def _bench_run(arch, precision, image_size, batch_size, steps, num_classes=2):
+    from architectures import build_model, compile_model
+
+    policy = set_precision(precision)
+    rng = np.random.default_rng(0)
+    x = rng.uniform(0, 1, (batch_size * steps, *image_size, 3)).astype(np.float32)
+    y = rng.integers(0, num_classes, batch_size * steps).astype(np.int32)
+    ds = tf.data.Dataset.from_tensor_slices((x, y)).batch(batch_size)
+
+    kwargs = {"weights": None} if arch.startswith("vgg") else {}
+    model = compile_model(build_model(arch, (*image_size, 3), num_classes, **kwargs))
+    model.fit(ds.take(1), verbose=0)
+    start = time.perf_counter()
+    model.fit(ds, verbose=0)
+    train = batch_size * steps / (time.perf_counter() - start)
+
+    model.predict(ds.take(1), verbose=0)
+    start = time.perf_counter()
+    model.predict(ds, verbose=0)
+    infer = batch_size * steps / (time.perf_counter() - start)
+    return {"arch": arch, "policy": policy, "train_images_per_sec": train, "infer_images_per_sec": infer,
+            "peak_rss_mb": peak_rss_mb()}
+
+
+def benchmark(archs=("cnn", "vgg16", "vgg19"), image_size=(224, 224), batch_size=16, steps=4):
+    results = []
+    for arch in archs:
+        for precision in ("float32", "mixed_bfloat16"):
+            cmd = [sys.executable, os.path.abspath(__file__), "run", "--archs", arch, "--precision", precision,
+                   "--size", str(image_size[0]), "--batch-size", str(batch_size), "--steps", str(steps)]
+            out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+            results.append(json.loads(out.strip().splitlines()[-1]))
+
+    print(f"\n{image_size[0]}x{image_size[1]}, batch {batch_size}")
+    for r in results:
+        print(f"{r['arch']:>6} {r['policy']:>15}: train {r['train_images_per_sec']:7.1f} img/s, "
+              f"inference {r['infer_images_per_sec']:7.1f} img/s, peak RSS {r['peak_rss_mb']:7.1f} MB")
+    return results
+
+
+# Test accuracy of a trained .h5 in float32 and converted to bf16, and how often they agree
+def compare_accuracy(model_path, ds_path, split="Test", batch_size=32):
+    from decoded_cache import load_split
+
+    model = tf.keras.models.load_model(model_path, compile=False)
+    converted = convert_model(model, "mixed_bfloat16")
+    h, w, channels = model.input_shape[1:]
+    images, labels, _ = load_split(ds_path, split, (h, w), channels)
+    preds = []
+    for m in (model, converted):
+        preds.append(np.concatenate([m.predict_on_batch(images[i:i + batch_size].astype(np.float32) / 255.)
+                                     for i in range(0, len(images), batch_size)]))
+
+    acc32, acc16 = [(p.argmax(1) == labels).mean() for p in preds]
+    agreement = (preds[0].argmax(1) == preds[1].argmax(1)).mean()
+    print(f"{os.path.basename(model_path)}: {split} accuracy float32 {acc32:.4f}, bf16 {acc16:.4f}, "
+          f"top-1 agreement {agreement:.2%}, max |p32 - p16| {np.abs(preds[0] - preds[1]).max():.4f}")
+    return acc32, acc16, agreement
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="bf16 mixed precision benchmarks")
+    parser.add_argument('command', choices=["benchmark", "accuracy", "run"])
+    parser.add_argument('--archs', nargs='+', default=["cnn", "vgg16", "vgg19"])
+    parser.add_argument('--precision', choices=PRECISIONS, default="auto")
+    parser.add_argument('--size', type=int, default=224)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--steps', type=int, default=4)
+    parser.add_argument('--models', nargs='+', help="trained .h5 models for the accuracy comparison")
+    parser.add_argument('--dataset', help="dataset folder the models were trained on")
+    args = parser.parse_args()
+
+    print(f"native bf16: {bf16_supported()}")
+    size = (args.size, args.size)
+    if args.command == "run":
+        print(json.dumps(_bench_run(args.archs[0], args.precision, size, args.batch_size, args.steps)))
+    elif args.command == "benchmark":
+        benchmark(args.archs, size, args.batch_size, args.steps)
+    else:
+        for path in args.models:
+            compare_accuracy(path, args.dataset)
@@ -6,7 +6,9 @@ import shutil
 import tensorflow as tf
 from tensorflow.keras import layers
 import matplotlib.pyplot as plt
-from tensorflow.keras.utils import image_dataset_from_directory
+from image_loader import image_dataset
+from serving import preprocessing_layers
+from volumes import contains_volumes, volume_dataset
 
 # Divides the dataset into 3 classes Train, Test, Valid.
 def structure_datasets(base_dir):
@@ -54,10 +56,7 @@ def structure_datasets(base_dir):
 def process(ds, batch_size, img_size, mode=1):
   h, w = img_size[0], img_size[1]
 
-  resize_and_rescale = tf.keras.Sequential([
-    layers.Resizing(h, w),
-    layers.Rescaling(1./255)
-  ])
+  resize_and_rescale = preprocessing_layers(h, w)
 
   augment = tf.keras.Sequential([
       layers.RandomFlip("horizontal_and_vertical"),
@@ -82,9 +81,16 @@ def process(ds, batch_size, img_size, mode=1):
   return ds
 
 
+# image_dataset for a split of images, volume_dataset (one example per selected slice) for a split of 3D volumes
+def split_dataset(directory, **kwargs):
+  load = volume_dataset if contains_volumes(directory) else image_dataset
+  return load(directory, **kwargs)
+
+
 # It returns the datasets Train, Test, Valid
-def get_ds_splits(ds_name, base_dir):
-  IMAGE_SIZE = (224, 224)
+# shard=(num_shards, index) gives each distributed worker a disjoint part of the files
+def get_ds_splits(ds_name, base_dir, image_size=(224, 224), batch_size=32, shard=None):
+  IMAGE_SIZE = image_size
   ds_path = os.path.join(base_dir, ds_name)
 
   conts = os.listdir(ds_path)
@@ -95,24 +101,27 @@ def get_ds_splits(ds_name, base_dir):
   test_dir = os.path.join(ds_path, "Test")
 
 
-  train_ds = image_dataset_from_directory(
+  train_ds = split_dataset(
       train_dir,
       image_size = IMAGE_SIZE,
+      batch_size = batch_size,
       shuffle=True,
-      seed = 21
+      seed = 21,
+      shard = shard
   )
-  train_ds = process(train_ds, 32, IMAGE_SIZE, 2)
+  train_ds = process(train_ds, batch_size, IMAGE_SIZE, 2)
 
 
-  test_ds = image_dataset_from_directory(
+  test_ds = split_dataset(
       test_dir,
       image_size = IMAGE_SIZE,
-      batch_size = 32,
+      batch_size = batch_size,
       shuffle=True,
-      seed = 21
+      seed = 21,
+      shard = shard
   )
 
-  test_ds = process(test_ds, 32, IMAGE_SIZE, 1)
+  test_ds = process(test_ds, batch_size, IMAGE_SIZE, 1)
   # for i in train_ds.take(1):
   #   print(np.array(i).shape)
 
@@ -0,0 +1,169 @@
+import os
+import re
+import csv
+import json
+import zipfile
+import argparse
+import numpy as np
+
+from model_catalog import CLASS_NAMES, NEGATIVE_CLASS
+
+# One probability column per class of every model, fixed up front so the CSV can be streamed
+PROBABILITY_COLUMNS = [f"p_{c}" for names in CLASS_NAMES.values() for c in names]
+CSV_COLUMNS = ["patient_id", "patient_name", "patient_age", "test_type", "prediction",
+               "condition", "confidence"] + PROBABILITY_COLUMNS
+
+
+# Turns a prediction record (patient metadata + class probabilities) into the report fields.
+# A model whose output does not match the classes listed for its test type (say one retrained with
+# another class count) gets index labels and an unknown condition instead of a wrong lookup.
+def summarize(record):
+    test_type = record["test_type"]
+    probs = [float(p) for p in record["probabilities"]]
+    names = CLASS_NAMES.get(test_type)
+    top = int(np.argmax(probs))
+    if names is None or len(names) != len(probs):
+        names = [str(i) for i in range(len(probs))]
+        condition = "Condition Unknown"
+    else:
+        condition = "Condition Negative" if names[top] == NEGATIVE_CLASS.get(test_type) else "Condition Positive"
+    return names, probs, names[top], condition, probs[top]
+
+
+# Same layout as the report on the classify page, with the class probabilities added
+def format_report(record):
+    names, probs, prediction, condition, confidence = summarize(record)
+    lines = "\n".join(f"      {name:<18} {p:6.1%}" for name, p in zip(names, probs))
+    patient_id = f"\n    Patient ID: {record['patient_id']}" if record.get("patient_id") else ""
+    return f"""
+    Medical Report
+    --------------{patient_id}
+    Patient Name: {record.get("patient_name", "")}
+    Patient Age: {record.get("patient_age", "")}
+    Test Type: {record["test_type"]}
+    Prediction: {condition} ({prediction}, {confidence:.1%})
+
+    Class probabilities:
+{lines}
+
+    Note: This is a preliminary assessment and not a definitive diagnosis.
+    """
+
+
+def report_name(record, index):
+    patient = record.get("patient_id") or record.get("patient_name") or f"patient_{index}"
+    name = re.sub(r"[^A-Za-z0-9_.-]+", "_", f"{patient}_{record['test_type']}")
+    return f"{index:06d}_{name}.txt"
+
+
+# Writes reports for a stream of records one at a time: a text report per patient under
+# out_dir/reports, rows appended to results.csv and results.jsonl, and every report added to
+# reports.zip as it is produced. Nothing is accumulated, memory stays flat however long the stream is.
+def write_bulk_reports(records, out_dir, bundle=True, flush_every=500):
+    report_dir = os.path.join(out_dir, "reports")
+    os.makedirs(report_dir, exist_ok=True)
+    csv_path = os.path.join(out_dir, "results.csv")
+    jsonl_path = os.path.join(out_dir, "results.jsonl")
+
+    count = 0
+    zf = zipfile.ZipFile(os.path.join(out_dir, "reports.zip"), "w", zipfile.ZIP_DEFLATED) if bundle else None
+    try:
+        with open(csv_path, "w", newline="") as csv_file, open(jsonl_path, "w") as jsonl_file:
+            # Index labelled probabilities have no column, they are kept in results.jsonl only
+            writer = csv.DictWriter(csv_file, fieldnames=CSV_COLUMNS, extrasaction="ignore")
+            writer.writeheader()
+
+            for count, record in enumerate(records, 1):
+                names, probs, prediction, condition, confidence = summarize(record)
+                report = format_report(record)
+                name = report_name(record, count)
+
+                with open(os.path.join(report_dir, name), "w") as f:
+                    f.write(report)
+                if zf is not None:
+                    zf.writestr(f"reports/{name}", report)
+
+                row = {
+                    "patient_id": record.get("patient_id", ""),
+                    "patient_name": record.get("patient_name", ""),
+                    "patient_age": record.get("patient_age", ""),
+                    "test_type": record["test_type"],
+                    "prediction": prediction,
+                    "condition": condition,
+                    "confidence": round(confidence, 6),
+                }
+                writer.writerow({**row, **{f"p_{n}": round(p, 6) for n, p in zip(names, probs)}})
+
+                row["probabilities"] = dict(zip(names, probs))
+                row["report"] = f"reports/{name}"
+                jsonl_file.write(json.dumps(row) + "\n")
+
+                if count % flush_every == 0:
+                    csv_file.flush()
+                    jsonl_file.flush()
+
+        # The consolidated files are copied into the bundle from disk, not from memory
+        if zf is not None:
+            zf.write(csv_path, "results.csv")
+            zf.write(jsonl_path, "results.jsonl")
+    finally:
+        if zf is not None:
+            zf.close()
+    return count
+
+
+# Lazily predicts a stream of patient rows that carry an image_path, batching per test type.
+# Rows that already have probabilities are passed through untouched.
+def predict_records(rows, models, batch_size=32):
+    import tensorflow as tf
+
+    pending = {}
+
+    def flush(test_type):
+        batch = pending.pop(test_type)
+        images = tf.constant([tf.io.read_file(r["image_path"]).numpy() for r in batch])
+        for r, probs in zip(batch, models[test_type].predict(images, batch_size=len(batch), verbose=0)):
+            yield dict(r, probabilities=probs.tolist())
+
+    for row in rows:
+        if "probabilities" in row:
+            yield row
+            continue
+        pending.setdefault(row["test_type"], []).append(row)
+        if len(pending[row["test_type"]]) >= batch_size:
+            yield from flush(row["test_type"])
+    for test_type in list(pending):
+        yield from flush(test_type)
+
+
+# Streams rows from a .csv or .jsonl file of patients
+def read_rows(path):
+    with open(path, newline="") as f:
+        if path.endswith(".jsonl"):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            for row in csv.DictReader(f):
+                if isinstance(row.get("probabilities"), str):
+                    row["probabilities"] = json.loads(row["probabilities"])
+                yield row
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Bulk report generation for screening runs")
+    parser.add_argument('patients', help=".csv or .jsonl with patient_id, patient_name, patient_age, test_type "
+                                         "and either image_path or probabilities")
+    parser.add_argument('out_dir')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--no-bundle', action='store_true')
+    args = parser.parse_args()
+
+    records = read_rows(args.patients)
+    first = next(records, None)
+    if first is not None:
+        records = (r for rs in ([first], records) for r in rs)
+        if "probabilities" not in first:
+            from serving import load_serving_models
+            records = predict_records(records, load_serving_models(), args.batch_size)
+    print(f"Wrote {write_bulk_reports(records, args.out_dir, not args.no_bundle)} reports to {args.out_dir}")
@@ -0,0 +1,134 @@
+import os
+import argparse
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import layers
+
+from image_loader import decode_bytes, tf_decode_image, sample_images
+from model_catalog import MODEL_DIR, MODEL_PATHS, DATASET_DIRS, CLASS_NAMES, NEGATIVE_CLASS
+
+
+# Resize and rescale applied to every decoded batch. process() uses it during training and the
+# serving graph uses the very same layers, so both sides compute identical tensors.
+def preprocessing_layers(h, w, scale=1./255, name="resize_and_rescale"):
+    return tf.keras.Sequential([
+        layers.Resizing(h, w),
+        layers.Rescaling(scale)
+    ], name=name)
+
+
+# Decodes a batch of encoded images (JPEG/PNG/...) inside the graph, handling channels and resize
+@tf.keras.utils.register_keras_serializable(package="brain")
+class DecodeImage(layers.Layer):
+    def __init__(self, img_size, channels=3, **kwargs):
+        super().__init__(**kwargs)
+        self.img_size = tuple(img_size)
+        self.channels = channels
+
+    def call(self, inputs):
+        return tf.map_fn(
+            lambda contents: decode_bytes(contents, self.img_size, self.channels),
+            inputs,
+            fn_output_signature=tf.TensorSpec((*self.img_size, self.channels), tf.float32)
+        )
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({"img_size": self.img_size, "channels": self.channels})
+        return config
+
+
+# Leading layers of the serving graph: encoded bytes in, model ready tensor out
+def serving_preprocessor(img_size, channels=3, scale=1./255):
+    inputs = tf.keras.Input(shape=(), dtype=tf.string, name="image_bytes")
+    x = DecodeImage(img_size, channels, name="decode_image")(inputs)
+    x = preprocessing_layers(img_size[0], img_size[1], scale)(x)
+    return inputs, x
+
+
+# Wraps a trained model so it takes raw encoded image bytes, the input size and channel
+# count are read from the model. scale=1 keeps models trained on raw 0-255 pixels working.
+def build_serving_model(model, scale=1./255):
+    img_size = tuple(model.input_shape[1:3])
+    channels = model.input_shape[-1]
+    inputs, x = serving_preprocessor(img_size, channels, scale)
+    return tf.keras.Model(inputs, model(x), name=f"{model.name}_serving")
+
+
+# Pixel input view of a serving model (float 0-255 images), sharing its weights.
+# Used for inputs that are not encoded images, like slices from volumes.py
+def image_model(serving_model):
+    classifier = serving_model.layers[-1]
+    rescale = serving_model.get_layer("resize_and_rescale")
+    inputs = tf.keras.Input(shape=classifier.input_shape[1:])
+    return tf.keras.Model(inputs, classifier(rescale(inputs)))
+
+
+# Exported file name next to the original, e.g. tumor.h5 -> tumor_serving.h5
+def serving_path(model_path):
+    root, ext = os.path.splitext(model_path)
+    return f"{root}_serving{ext}"
+
+
+# Serving precision: "float32", "mixed_bfloat16" or "auto" (bf16 only where the CPU runs it natively)
+PRECISION = os.environ.get("BRAIN_PRECISION", "float32")
+
+
+# Loads every served model. Prefers the exported graph with the preprocessing baked in,
+# otherwise wraps the .h5 at load time. Failures are reported through on_error and skipped.
+def load_serving_models(model_paths=MODEL_PATHS, on_error=None, precision=None):
+    precision = precision or PRECISION
+    models = {}
+    for name, path in model_paths.items():
+        try:
+            if os.path.exists(serving_path(path)):
+                models[name] = tf.keras.models.load_model(serving_path(path), compile=False)
+            else:
+                with tf.keras.utils.CustomObjectScope({'GlorotUniform': tf.keras.initializers.glorot_uniform}):
+                    models[name] = build_serving_model(tf.keras.models.load_model(path))
+            if precision != "float32":
+                from precision import convert_model
+                models[name] = convert_model(models[name], precision)
+        except Exception as e:
+            if on_error is None:
+                raise
+            on_error(name, e)
+    return models
+
+
+# Export step: bakes the preprocessing into a saved model
+def export_serving_model(model_path, out_path=None, scale=1./255):
+    model = tf.keras.models.load_model(model_path, compile=False)
+    serving_model = build_serving_model(model, scale)
+    out_path = out_path or serving_path(model_path)
+    serving_model.save(out_path)
+    return out_path
+
+
+# Compares the tensors the training pipeline feeds the model with the ones the serving graph does
+def check_preprocessing_parity(paths, img_size=(224, 224), channels=3):
+    train_ds = tf.data.Dataset.from_tensor_slices(paths) \
+        .map(lambda p: tf_decode_image(p, img_size, channels)).batch(len(paths))
+    train_x = preprocessing_layers(*img_size)(next(iter(train_ds))).numpy()
+
+    inputs, x = serving_preprocessor(img_size, channels)
+    serve_x = tf.keras.Model(inputs, x).predict(tf.constant([tf.io.read_file(p).numpy() for p in paths]), verbose=0)
+
+    max_diff = float(np.abs(train_x - serve_x).max())
+    print(f"{len(paths)} images, {img_size}x{channels}: max |train - serve| = {max_diff}")
+    return np.array_equal(train_x, serve_x)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export models with the preprocessing baked in")
+    parser.add_argument('models', nargs='*', help=".h5 models to export as <name>_serving.h5")
+    parser.add_argument('--raw-pixels', action='store_true', help="models were trained on 0-255 inputs")
+    parser.add_argument('--check', help="image directory to verify train/serve preprocessing parity on")
+    args = parser.parse_args()
+
+    for path in args.models:
+        print(f"{path} -> {export_serving_model(path, scale=1. if args.raw_pixels else 1./255)}")
+    if args.check:
+        paths = sample_images(args.check, 64)
+        for size, channels in (((224, 224), 3), ((124, 124), 1)):
+            assert check_preprocessing_parity(paths, size, channels), "train and serve preprocessing differ"
@@ -0,0 +1,312 @@
+import os
+import json
+import math
+import time
+import sqlite3
+import argparse
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+from sklearn.model_selection import train_test_split
+
+from kfold import build_shared_cache, fold_dataset, _init_worker
+
+SWEEPS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "runs", "sweeps")
+
+# Splits trials are trained and validated on. Test is left out so it still scores the chosen setting
+# without having taken part in choosing it.
+SWEEP_SPLITS = ("Train", "Valid")
+
+# Lists are sampled uniformly, ("log", low, high) log-uniformly. width scales the hidden dense layers
+# of the head, dropout replaces the rate of every Dropout layer.
+DEFAULT_SPACE = {
+    "optimizer": ["adam", "sgd", "rmsprop"],
+    "learning_rate": ["log", 1e-4, 1e-2],
+    "dropout": [0.0, 0.2, 0.4],
+    "width": [0.5, 1.0, 2.0],
+    "image_size": [124, 224],
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS study (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS trials (
+    id INTEGER PRIMARY KEY,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'running',
+    rung INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created REAL NOT NULL,
+    finished REAL
+);
+CREATE TABLE IF NOT EXISTS results (
+    trial INTEGER NOT NULL,
+    rung INTEGER NOT NULL,
+    epochs INTEGER NOT NULL,
+    val_accuracy REAL NOT NULL,
+    val_loss REAL,
+    seconds REAL NOT NULL,
+    PRIMARY KEY (trial, rung)
+);
+"""
+
+
+# Study store, one database per study next to the trial checkpoints. Only the scheduler writes to it.
+# A trial is 'running' while a worker trains it towards rung, 'paused' while it waits for promotion.
+def connect(study_dir):
+    os.makedirs(study_dir, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(study_dir, "study.sqlite"), timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+# Stores the study settings on first use. A resumed study must keep the search space and rungs,
+# otherwise results recorded so far would not be comparable.
+def init_study(conn, settings):
+    stored = {row["key"]: json.loads(row["value"]) for row in conn.execute("SELECT key, value FROM study")}
+    if not stored:
+        conn.executemany("INSERT INTO study (key, value) VALUES (?, ?)",
+                         [(k, json.dumps(v)) for k, v in settings.items()])
+        return settings
+    fixed = ("arch", "dataset", "space", "rungs", "eta", "seed", "splits")
+    changed = [k for k in fixed if json.loads(json.dumps(settings[k])) != stored.get(k)]
+    if changed:
+        raise ValueError(f"Study was created with different {', '.join(changed)}: {[stored.get(k) for k in changed]}")
+    return stored
+
+
+# Epoch budgets of the rungs: min_epochs, min_epochs * eta, ... up to max_epochs
+def rung_epochs(min_epochs, max_epochs, eta):
+    rungs = [min_epochs]
+    while rungs[-1] * eta < max_epochs:
+        rungs.append(rungs[-1] * eta)
+    if rungs[-1] != max_epochs:
+        rungs.append(max_epochs)
+    return rungs
+
+
+# Parameters of a trial only depend on the study seed and the trial id, so they survive a restart
+def sample_params(space, seed, trial_id):
+    rng = np.random.default_rng([seed, trial_id])
+    params = {}
+    for name, choices in space.items():
+        if choices and choices[0] == "log":
+            params[name] = float(math.exp(rng.uniform(math.log(choices[1]), math.log(choices[2]))))
+        else:
+            params[name] = choices[int(rng.integers(len(choices)))]
+    return params
+
+
+# Asynchronous successive halving: a trial paused at a rung moves on as soon as it ranks in the top
+# 1/eta of everything recorded at that rung, higher rungs first. Otherwise a new trial is started.
+# Nothing waits for a rung to fill up, so workers never idle. Returns (trial id, rung) or None.
+def next_job(conn, rungs, eta, max_trials, seed, space):
+    for rung in range(len(rungs) - 2, -1, -1):
+        rows = conn.execute("SELECT trial, val_accuracy FROM results WHERE rung = ? ORDER BY val_accuracy DESC, trial",
+                            (rung,)).fetchall()
+        top = {row["trial"] for row in rows[:len(rows) // eta]}
+        paused = conn.execute("SELECT id FROM trials WHERE status = 'paused' AND rung = ? ORDER BY id",
+                              (rung,)).fetchall()
+        for row in paused:
+            if row["id"] in top:
+                conn.execute("UPDATE trials SET status = 'running', rung = ? WHERE id = ?", (rung + 1, row["id"]))
+                return row["id"], rung + 1
+
+    started = conn.execute("SELECT COUNT(*) FROM trials").fetchone()[0]
+    if started >= max_trials:
+        return None
+    conn.execute("INSERT INTO trials (id, params, rung, created) VALUES (?, ?, 0, ?)",
+                 (started, json.dumps(sample_params(space, seed, started)), time.time()))
+    return started, 0
+
+
+# Sets the dropout rate and scales the hidden dense layers of a freshly built model. The model is
+# rebuilt from its config, pretrained backbones keep their weights.
+def apply_params(model, dropout=None, width=1.):
+    import tensorflow as tf
+
+    config = model.get_config()
+    layers = config["layers"]
+    dense = [i for i, layer in enumerate(layers) if layer["class_name"] == "Dense"]
+    for i in dense[:-1]:
+        layers[i]["config"]["units"] = max(1, int(round(layers[i]["config"]["units"] * width)))
+    if dropout is not None:
+        for layer in layers:
+            if layer["class_name"] == "Dropout":
+                layer["config"]["rate"] = dropout
+    rebuilt = tf.keras.Sequential.from_config(config)
+    for old, new in zip(model.layers, rebuilt.layers):
+        if isinstance(old, tf.keras.Model):
+            new.set_weights(old.get_weights())
+    return rebuilt
+
+
+# Trains one trial up to `epochs` in a worker. Every trial starts from its own fresh initialisation
+# and checkpoints in its own directory, so a promotion continues where the last rung stopped.
+def run_trial(arch, trial_dir, trial_id, params, epochs, images_path, labels_path, train_idx, val_idx,
+              num_classes, batch_size, weights, seed):
+    import tensorflow as tf
+    from architectures import build_model, compile_model
+    from training import fit_resumable
+
+    images = np.load(images_path, mmap_mode="r")
+    labels = np.load(labels_path, mmap_mode="r")
+
+    tf.keras.utils.set_random_seed(seed + trial_id)
+    kwargs = {"weights": weights} if arch.startswith("vgg") else {}
+    model = apply_params(build_model(arch, images.shape[1:], num_classes, **kwargs), params["dropout"], params["width"])
+    optimizer = tf.keras.optimizers.get({"class_name": params["optimizer"],
+                                         "config": {"learning_rate": params["learning_rate"]}})
+    model = compile_model(model, optimizer)
+
+    start = time.perf_counter()
+    history = fit_resumable(model, fold_dataset(images, labels, train_idx, batch_size, shuffle=True, seed=seed + trial_id),
+                            fold_dataset(images, labels, val_idx, batch_size), epochs, trial_dir,
+                            patience=None, max_to_keep=1, callbacks=[tf.keras.callbacks.TerminateOnNaN()],
+                            verbose=0)
+    latest = tf.train.latest_checkpoint(trial_dir)
+    val_loss = None
+    if history is not None and history.history.get("val_loss"):
+        val_loss = float(history.history["val_loss"][-1])
+    return {
+        "trial": trial_id,
+        # Best val_accuracy so far, also known when a restarted job finds the epochs already done
+        "val_accuracy": float(tf.train.load_variable(latest, "best/.ATTRIBUTES/VARIABLE_VALUE")),
+        "val_loss": val_loss,
+        "epochs": int(tf.train.load_variable(latest, "epoch/.ATTRIBUTES/VARIABLE_VALUE")),
+        "seconds": time.perf_counter() - start,
+    }
+
+
+# Runs (or resumes) a study with `processes` parallel trials on the shared decoded cache
+def run_sweep(study, arch, ds_path, trials=12, processes=2, min_epochs=1, max_epochs=9, eta=3, space=None,
+              batch_size=32, val_fraction=0.2, weights=None, seed=43):
+    study_dir = os.path.join(SWEEPS_DIR, study)
+    conn = connect(study_dir)
+    settings = init_study(conn, {
+        "arch": arch, "dataset": os.path.basename(os.path.normpath(ds_path)), "space": space or DEFAULT_SPACE,
+        "rungs": rung_epochs(min_epochs, max_epochs, eta), "eta": eta, "seed": seed, "weights": weights,
+        "batch_size": batch_size, "splits": list(SWEEP_SPLITS),
+    })
+    space, rungs = settings["space"], settings["rungs"]
+
+    # One cache per image size, decoded before the pool starts so workers only memory map it
+    caches = {}
+    for size in sorted(set(space.get("image_size", [224]))):
+        images_path, labels_path, meta = build_shared_cache(ds_path, (size, size), splits=SWEEP_SPLITS)
+        labels = np.load(labels_path)
+        train_idx, val_idx = train_test_split(np.arange(len(labels)), test_size=val_fraction,
+                                              stratify=labels, random_state=seed)
+        caches[size] = (images_path, labels_path, train_idx, val_idx, len(meta["class_names"]))
+
+    # Jobs cut short by a crash are picked up again from their last checkpoint
+    resumed = [(row["id"], row["rung"]) for row in conn.execute("SELECT id, rung FROM trials WHERE status = 'running'")]
+    threads = max(1, (os.cpu_count() or 1) // processes)
+    start = time.perf_counter()
+    running = {}
+    with ProcessPoolExecutor(processes, mp_context=mp.get_context("spawn"),
+                             initializer=_init_worker, initargs=(threads,)) as pool:
+        def submit(trial_id, rung):
+            params = json.loads(conn.execute("SELECT params FROM trials WHERE id = ?", (trial_id,)).fetchone()[0])
+            images_path, labels_path, train_idx, val_idx, num_classes = caches[params.get("image_size", 224)]
+            future = pool.submit(run_trial, arch, os.path.join(study_dir, f"trial_{trial_id:03d}"), trial_id, params,
+                                 rungs[rung], images_path, labels_path, train_idx, val_idx, num_classes,
+                                 batch_size, weights, seed)
+            running[future] = (trial_id, rung)
+
+        def fill():
+            while len(running) < processes:
+                job = resumed.pop() if resumed else next_job(conn, rungs, eta, trials, seed, space)
+                if job is None:
+                    return
+                submit(*job)
+
+        fill()
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                trial_id, rung = running.pop(future)
+                try:
+                    r = future.result()
+                except Exception as e:
+                    conn.execute("UPDATE trials SET status = 'failed', error = ?, finished = ? WHERE id = ?",
+                                 (repr(e), time.time(), trial_id))
+                    print(f"trial {trial_id} failed: {e!r}")
+                    continue
+                final = rung == len(rungs) - 1
+                conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                             (trial_id, rung, r["epochs"], r["val_accuracy"], r["val_loss"], r["seconds"]))
+                conn.execute("UPDATE trials SET status = ?, finished = ? WHERE id = ?",
+                             ("completed" if final else "paused", time.time() if final else None, trial_id))
+                print(f"trial {trial_id} rung {rung} ({r['epochs']} epochs): val_accuracy {r['val_accuracy']:.4f} "
+                      f"in {r['seconds']:.1f}s")
+            fill()
+
+    summary = summarize(conn, rungs, trials)
+    summary.update({"study": study, "processes": processes, "threads_per_process": threads,
+                    "wall_seconds": time.perf_counter() - start})
+    print(f"{summary['wall_seconds']:.1f}s wall with {processes} processes x {threads} threads")
+    return summary
+
+
+# Best trial and how much of the full budget (every trial trained to max_epochs) was spent
+def summarize(conn, rungs, trials=None):
+    rows = conn.execute(
+        "SELECT t.id, t.params, t.status, r.rung, r.val_accuracy FROM trials t JOIN results r ON r.trial = t.id "
+        "WHERE r.rung = (SELECT MAX(rung) FROM results WHERE trial = t.id) "
+        "ORDER BY r.rung DESC, r.val_accuracy DESC").fetchall()
+    epochs = sum(rungs[row["rung"]] for row in rows)
+    budget = len(rows) * rungs[-1]
+    for row in rows:
+        state = row["status"] if row["rung"] == len(rungs) - 1 or row["status"] != "paused" else "pruned"
+        print(f"trial {row['id']:3d} {state:>9} at {rungs[row['rung']]:3d} epochs: "
+              f"val_accuracy {row['val_accuracy']:.4f} {row['params']}")
+    best = dict(rows[0]) if rows else None
+    if best:
+        best["params"] = json.loads(best["params"])
+        print(f"best: trial {best['id']} with val_accuracy {best['val_accuracy']:.4f}, {best['params']}")
+    if budget:
+        print(f"{epochs} of {budget} epochs trained ({epochs / budget:.0%} of the budget without pruning)")
+    return {"best": best, "trials": len(rows), "epochs_trained": epochs, "epochs_without_pruning": budget}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Parallel hyperparameter sweep with asynchronous successive halving")
+    parser.add_argument('command', choices=["run", "show"])
+    parser.add_argument('study')
+    parser.add_argument('--arch')
+    parser.add_argument('--dataset')
+    parser.add_argument('--base-dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "datasets"))
+    parser.add_argument('--trials', type=int, default=12)
+    parser.add_argument('--processes', type=int, default=2)
+    parser.add_argument('--min-epochs', type=int, default=1)
+    parser.add_argument('--max-epochs', type=int, default=9)
+    parser.add_argument('--eta', type=int, default=3, help="keep the top 1/eta of each rung")
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--space', help="json file with the search space, see DEFAULT_SPACE")
+    parser.add_argument('--imagenet', action='store_true', help="start VGG backbones from imagenet weights")
+    parser.add_argument('--out', help="write the summary as json")
+    args = parser.parse_args()
+
+    if args.command == "show":
+        conn = connect(os.path.join(SWEEPS_DIR, args.study))
+        rungs = json.loads(conn.execute("SELECT value FROM study WHERE key = 'rungs'").fetchone()[0])
+        summary = summarize(conn, rungs)
+    else:
+        if not args.arch or not args.dataset:
+            parser.error("run needs --arch and --dataset")
+        space = None
+        if args.space:
+            with open(args.space) as f:
+                space = json.load(f)
+        summary = run_sweep(args.study, args.arch, os.path.join(args.base_dir, args.dataset), args.trials,
+                            args.processes, args.min_epochs, args.max_epochs, args.eta, space, args.batch_size,
+                            weights="imagenet" if args.imagenet else None)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(summary, f, indent=2)
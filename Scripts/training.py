@@ -0,0 +1,200 @@
+import os
+import json
+import shutil
+import argparse
+import numpy as np
+import tensorflow as tf
+
+from serving import MODEL_PATHS, DATASET_DIRS, serving_path, export_serving_model
+from precision import PRECISIONS, set_precision, convert_model
+
+RUNS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "runs")
+DATASETS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "datasets")
+
+
+# Everything a run needs to continue where it stopped: weights, optimizer slots, the next epoch
+# and the early stopping state, so a resumed run neither repeats epochs nor forgets its patience
+def make_checkpoint(model):
+    return tf.train.Checkpoint(
+        model=model,
+        optimizer=model.optimizer,
+        epoch=tf.Variable(0, dtype=tf.int64),
+        best=tf.Variable(np.nan, dtype=tf.float64),
+        wait=tf.Variable(0, dtype=tf.int64)
+    )
+
+
+# Exported models are always float32, serving converts them to its own precision at load time
+def save_model_atomic(model, path):
+    if model.dtype_policy.name != "float32":
+        model = convert_model(model, "float32")
+    root, ext = os.path.splitext(path)
+    tmp = f"{root}.tmp{ext}"
+    model.save(tmp)
+    os.replace(tmp, path)
+
+
+# Saves a checkpoint every `every` epochs and after the last one, stops after `patience` epochs
+# without improvement of `monitor` and writes the best model to best_path whenever it improves.
+# TensorFlow writes checkpoint shards under temporary names and renames them, and the index of
+# checkpoints is replaced atomically, so a crash mid-save leaves the previous checkpoint usable.
+class CheckpointCallback(tf.keras.callbacks.Callback):
+    def __init__(self, manager, monitor="val_accuracy", mode="max", patience=5, min_delta=0., every=1, best_path=None):
+        super().__init__()
+        self.manager = manager
+        self.state = manager.checkpoint
+        self.monitor = monitor
+        self.sign = 1. if mode == "max" else -1.
+        self.patience = patience
+        self.min_delta = min_delta
+        self.every = every
+        self.best_path = best_path
+
+    def improved(self, value):
+        best = float(self.state.best.numpy())
+        return np.isnan(best) or self.sign * (value - best) > self.min_delta
+
+    def on_epoch_end(self, epoch, logs=None):
+        value = logs[self.monitor]
+        if self.improved(value):
+            self.state.best.assign(value)
+            self.state.wait.assign(0)
+            if self.best_path:
+                save_model_atomic(self.model, self.best_path)
+        else:
+            self.state.wait.assign_add(1)
+        self.state.epoch.assign(epoch + 1)
+
+        stop = self.patience is not None and int(self.state.wait.numpy()) >= self.patience
+        last = epoch + 1 == self.params.get("epochs")
+        if (epoch + 1) % self.every == 0 or last or stop:
+            self.manager.save(checkpoint_number=epoch + 1)
+        if stop:
+            print(f"Early stopping: no {self.monitor} improvement for {self.patience} epochs, "
+                  f"best {float(self.state.best.numpy()):.4f}")
+            self.model.stop_training = True
+
+
+# fit() that resumes from the latest checkpoint in run_dir. A finished run (all epochs done or
+# stopped early) is not trained again. Returns the History of this call, None if nothing was left.
+# Checkpoints are written to write_dir, run_dir by default: under MultiWorkerMirroredStrategy every
+# worker has to save, so the others resume from the chief's run_dir but write to scratch directories.
+# fit_kwargs go to fit(), e.g. steps_per_epoch for datasets that repeat.
+def fit_resumable(model, train_ds, val_ds, epochs, run_dir, monitor="val_accuracy", mode="max", patience=5,
+                  min_delta=0., every=1, best_path=None, max_to_keep=2, callbacks=(), verbose="auto",
+                  write_dir=None, **fit_kwargs):
+    manager = tf.train.CheckpointManager(make_checkpoint(model), write_dir or run_dir, max_to_keep=max_to_keep)
+    state = manager.checkpoint
+    latest = tf.train.latest_checkpoint(run_dir)
+    if latest:
+        state.restore(latest)
+        print(f"Resuming from {latest} at epoch {int(state.epoch.numpy())}")
+
+    done = int(state.epoch.numpy())
+    if done >= epochs or (patience is not None and int(state.wait.numpy()) >= patience):
+        print(f"{run_dir} already finished at epoch {done}")
+        return None
+
+    checkpoint = CheckpointCallback(manager, monitor, mode, patience, min_delta, every, best_path)
+    return model.fit(train_ds, epochs=epochs, initial_epoch=done, validation_data=val_ds,
+                     callbacks=[checkpoint, *callbacks], verbose=verbose, **fit_kwargs)
+
+
+# Validation score of a saved model under the metric fit() monitored, e.g. val_accuracy -> accuracy
+def evaluate_saved(path, val_ds, monitor="val_accuracy"):
+    with tf.keras.utils.CustomObjectScope({'GlorotUniform': tf.keras.initializers.glorot_uniform}):
+        model = tf.keras.models.load_model(path, compile=False)
+    model.compile(loss="sparse_categorical_crossentropy", metrics=["accuracy"])
+    return model.evaluate(val_ds, return_dict=True, verbose=0)[monitor.removeprefix("val_")]
+
+
+# Replaces the served model with best_path, only when it scores better on val_ds than the model
+# served now. Its serving graph, if it has one, is re-exported with it: the old graph is removed
+# before the .h5 is replaced and the new one moved in after, so web.py (which prefers the graph)
+# never pairs an old graph with a new .h5. Returns whether the served model was replaced.
+def promote_model(best_path, served_path, val_ds, monitor="val_accuracy", mode="max"):
+    new = evaluate_saved(best_path, val_ds, monitor)
+    if os.path.exists(served_path):
+        try:
+            current = evaluate_saved(served_path, val_ds, monitor)
+        except Exception as e:
+            print(f"Keeping {served_path}, it cannot be evaluated on this validation data ({e})")
+            return False
+        if not (1. if mode == "max" else -1.) * (new - current) > 0:
+            print(f"Keeping {served_path}: {monitor} {current:.4f}, {best_path} {new:.4f}")
+            return False
+
+    root, ext = os.path.splitext(served_path)
+    tmp = f"{root}.tmp{ext}"
+    shutil.copyfile(best_path, tmp)
+    graph = serving_path(served_path)
+    if os.path.exists(graph):
+        tmp_graph = export_serving_model(best_path, f"{os.path.splitext(graph)[0]}.tmp{ext}")
+        os.remove(graph)
+        os.replace(tmp, served_path)
+        os.replace(tmp_graph, graph)
+    else:
+        os.replace(tmp, served_path)
+    print(f"{served_path} replaced by {best_path}, {monitor} {new:.4f}")
+    return True
+
+
+# Trains one architecture for a served test type, validating on the Valid split when there is one.
+# The best model is kept as best.h5 in the run directory; with export it then replaces the .h5
+# web.py loads for that test type if it beats the served model on the same validation data.
+def train(arch, test_type, base_dir=DATASETS_DIR, image_size=(224, 224), batch_size=32, epochs=50, patience=5,
+          monitor="val_accuracy", every=1, run_dir=None, export=True, micro_batch_size=None, precision="float32",
+          **kwargs):
+    from preprocess import get_ds_splits, process, split_dataset
+    from image_loader import list_images
+    from architectures import build_model, compile_model
+
+    ds_name = DATASET_DIRS[test_type]
+    train_ds, test_ds = get_ds_splits(ds_name, base_dir, image_size, batch_size)
+    val_ds = test_ds
+    valid_dir = os.path.join(base_dir, ds_name, "Valid")
+    if os.path.isdir(valid_dir):
+        val_ds = process(split_dataset(valid_dir, image_size=image_size, batch_size=batch_size, shuffle=False),
+                         batch_size, image_size, 1)
+
+    num_classes = len(list_images(os.path.join(base_dir, ds_name, "Train"))[2])
+    policy = set_precision(precision)
+    model = compile_model(build_model(arch, (*image_size, 3), num_classes, **kwargs),
+                          micro_batch_size=micro_batch_size)
+    run_dir = run_dir or os.path.join(RUNS_DIR, f"{arch}_{ds_name.replace(' ', '_')}_{image_size[0]}")
+    os.makedirs(run_dir, exist_ok=True)
+    with open(os.path.join(run_dir, "config.json"), "w") as f:
+        json.dump({"arch": arch, "test_type": test_type, "image_size": image_size, "batch_size": batch_size,
+                   "epochs": epochs, "patience": patience, "monitor": monitor, "policy": policy}, f)
+
+    mode = "min" if "loss" in monitor else "max"
+    best_path = os.path.join(run_dir, "best.h5")
+    fit_resumable(model, train_ds, val_ds, epochs, run_dir, monitor, mode, patience, every=every, best_path=best_path)
+    if export:
+        promote_model(best_path, MODEL_PATHS[test_type], val_ds, monitor, mode)
+    return best_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Resumable training with checkpoints, early stopping and best model export")
+    parser.add_argument('arch')
+    parser.add_argument('test_type', choices=list(DATASET_DIRS))
+    parser.add_argument('--base-dir', default=DATASETS_DIR)
+    parser.add_argument('--size', type=int, default=224)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--micro-batch-size', type=int)
+    parser.add_argument('--precision', choices=PRECISIONS, default="float32")
+    parser.add_argument('--epochs', type=int, default=50)
+    parser.add_argument('--patience', type=int, default=5)
+    parser.add_argument('--monitor', default="val_accuracy")
+    parser.add_argument('--every', type=int, default=1, help="checkpoint every N epochs")
+    parser.add_argument('--run-dir')
+    parser.add_argument('--no-export', action='store_true', help="do not replace the served model with a better one")
+    parser.add_argument('--no-imagenet', action='store_true', help="start VGG backbones from random weights")
+    args = parser.parse_args()
+
+    kwargs = {"weights": None} if args.no_imagenet and args.arch.startswith("vgg") else {}
+    path = train(args.arch, args.test_type, args.base_dir, (args.size, args.size), args.batch_size, args.epochs,
+                 args.patience, args.monitor, args.every, args.run_dir, not args.no_export, args.micro_batch_size,
+                 args.precision, **kwargs)
+    print(f"Best model: {path}")
@@ -0,0 +1,201 @@
+import os
+import json
+import time
+import argparse
+import multiprocessing as mp
+from collections import Counter, defaultdict
+
+import numpy as np
+from PIL import Image
+
+# Kept in sync with image_loader.IMAGE_EXTENSIONS / QUARANTINE_FILE / quarantine_path. Not imported
+# from there so the worker processes only load PIL, never TensorFlow.
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif')
+QUARANTINE_FILE = "quarantine.txt"
+CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache")
+SPLIT_NAMES = ("Train", "Test", "Valid")
+
+# Formats tf.image.decode_image can read, anything else crashes the tf.data loaders
+TF_FORMATS = ("JPEG", "PNG", "GIF", "BMP")
+MODES = ("RGB", "L")
+
+
+def cache_path(dataset):
+    return os.path.join(CACHE_DIR, dataset, "validation.json")
+
+
+def quarantine_path(dataset):
+    return os.path.join(CACHE_DIR, dataset, QUARANTINE_FILE)
+
+
+# Checks one file and returns its entry: header info, the problems found and the per-channel
+# pixel statistics as exact integer (count, sum, sum of squares) so entries simply add up.
+# "quarantine" problems make the file unusable for training, "warnings" are only reported.
+def check_file(path, min_size=32, max_aspect=3.):
+    st = os.stat(path)
+    entry = {"size": st.st_size, "mtime": st.st_mtime, "min_size": min_size, "quarantine": [], "warnings": []}
+    try:
+        with Image.open(path) as img:
+            img.verify()
+        with Image.open(path) as img:
+            img.load()
+            entry.update(format=img.format, mode=img.mode, width=img.width, height=img.height)
+            arr = np.asarray(img.convert("RGB"), dtype=np.uint8).reshape(-1, 3)
+    except Exception as e:
+        entry["quarantine"].append(f"undecodable: {e}")
+        return entry
+
+    if entry["format"] not in TF_FORMATS:
+        entry["quarantine"].append(f"format {entry['format']} is not readable by tf.image")
+    if entry["mode"] == "CMYK":
+        entry["quarantine"].append("CMYK")
+    elif entry["mode"] not in MODES:
+        entry["warnings"].append(f"mode {entry['mode']}")
+    if min(entry["width"], entry["height"]) < min_size:
+        entry["quarantine"].append(f"too small ({entry['width']}x{entry['height']})")
+    elif max(entry["width"], entry["height"]) / min(entry["width"], entry["height"]) > max_aspect:
+        entry["warnings"].append(f"aspect ratio ({entry['width']}x{entry['height']})")
+
+    # Per channel histograms are much cheaper than float arithmetic over every pixel
+    hist = np.stack([np.bincount(arr[:, c], minlength=256) for c in range(3)]).astype(np.int64)
+    values = np.arange(256, dtype=np.int64)
+    entry["stats"] = [len(arr), (hist @ values).tolist(), (hist @ values ** 2).tolist()]
+    return entry
+
+
+def _check(args):
+    rel, path, min_size = args
+    return rel, check_file(path, min_size)
+
+
+def merge_stats(a, b):
+    if a is None:
+        return b
+    return [a[0] + b[0], [x + y for x, y in zip(a[1], b[1])], [x + y for x, y in zip(a[2], b[2])]]
+
+
+def list_dataset(ds_path):
+    files = {}
+    for root, dirs, names in os.walk(ds_path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for name in sorted(names):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                path = os.path.join(root, name)
+                files[os.path.relpath(path, ds_path).replace(os.sep, "/")] = path
+    return files
+
+
+# Validates every image of a dataset with a process pool. Files whose size and mtime match the
+# cached entry, checked with the same min_size, are not reopened. Writes the dataset's quarantine.txt
+# under .cache/<dataset>/, which image_loader.list_images skips.
+def validate_dataset(ds_path, processes=None, min_size=32):
+    start = time.perf_counter()
+    dataset = os.path.basename(os.path.normpath(ds_path))
+    cached = {}
+    if os.path.exists(cache_path(dataset)):
+        with open(cache_path(dataset)) as f:
+            cached = json.load(f)
+
+    files = list_dataset(ds_path)
+    entries, todo = {}, []
+    for rel, path in files.items():
+        st = os.stat(path)
+        entry = cached.get(rel)
+        key = (st.st_size, st.st_mtime, min_size)
+        if entry is not None and (entry["size"], entry["mtime"], entry.get("min_size")) == key:
+            entries[rel] = entry
+        else:
+            todo.append((rel, path, min_size))
+
+    if todo:
+        with mp.get_context("spawn").Pool(processes or os.cpu_count()) as pool:
+            for rel, entry in pool.imap_unordered(_check, todo, chunksize=32):
+                entries[rel] = entry
+
+    os.makedirs(os.path.dirname(cache_path(dataset)), exist_ok=True)
+    with open(cache_path(dataset) + ".tmp", "w") as f:
+        json.dump(entries, f)
+    os.replace(cache_path(dataset) + ".tmp", cache_path(dataset))
+
+    summary = summarize(dataset, entries)
+    summary.update(checked=len(todo), seconds=time.perf_counter() - start)
+    write_quarantine(ds_path, entries)
+    return summary
+
+
+# Per split/class counts, problem counts and per-channel mean/std of the usable images
+def summarize(dataset, entries):
+    counts = defaultdict(Counter)
+    problems = Counter()
+    stats = defaultdict(lambda: None)
+    for rel, entry in sorted(entries.items()):
+        parts = rel.split("/")
+        split = parts[0] if parts[0] in SPLIT_NAMES and len(parts) > 2 else "landing"
+        class_name = parts[-2] if len(parts) > 1 else ""
+        for problem in entry["quarantine"] + entry["warnings"]:
+            problems[problem.split(":")[0].split(" (")[0]] += 1
+        if entry["quarantine"]:
+            counts[split][f"{class_name} (quarantined)"] += 1
+            continue
+        counts[split][class_name] += 1
+        stats[split] = merge_stats(stats[split], entry["stats"])
+
+    channel_stats = {}
+    for split, (n, total, squares) in stats.items():
+        mean = [t / n for t in total]
+        std = [max(q / n - m ** 2, 0.) ** .5 for q, m in zip(squares, mean)]
+        channel_stats[split] = {"mean": [m / 255 for m in mean], "std": [s / 255 for s in std]}
+    return {"dataset": dataset, "files": len(entries),
+            "quarantined": sum(1 for e in entries.values() if e["quarantine"]),
+            "counts": {split: dict(sorted(c.items())) for split, c in counts.items()},
+            "problems": dict(problems), "channel_stats": channel_stats}
+
+
+def write_quarantine(ds_path, entries):
+    dataset = os.path.basename(os.path.normpath(ds_path))
+    path = quarantine_path(dataset)
+    # Lists written into the dataset folder before it moved to .cache
+    if os.path.exists(os.path.join(ds_path, QUARANTINE_FILE)):
+        os.remove(os.path.join(ds_path, QUARANTINE_FILE))
+    bad = {rel: e["quarantine"] for rel, e in sorted(entries.items()) if e["quarantine"]}
+    if not bad:
+        if os.path.exists(path):
+            os.remove(path)
+        return None
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        f.write("# Written by Scripts/validate.py, the image loaders skip these files\n")
+        for rel, reasons in bad.items():
+            f.write(f"{rel}\t# {'; '.join(reasons)}\n")
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def print_summary(summary):
+    print(f"\n{summary['dataset']}: {summary['files']} files, {summary['quarantined']} quarantined, "
+          f"{summary['checked']} checked in {summary['seconds']:.1f}s")
+    for problem, n in sorted(summary["problems"].items()):
+        print(f"  {problem}: {n}")
+    for split, counts in summary["counts"].items():
+        print(f"  {split}: " + ", ".join(f"{c} {n}" for c, n in counts.items()))
+    for split, s in summary["channel_stats"].items():
+        print(f"  {split} mean {np.round(s['mean'], 4).tolist()} std {np.round(s['std'], 4).tolist()}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Validate dataset images and collect per-channel statistics")
+    parser.add_argument('base_dir', nargs='?', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "datasets"))
+    parser.add_argument('datasets', nargs='*', help="dataset folder names, all of them by default")
+    parser.add_argument('--processes', type=int)
+    parser.add_argument('--min-size', type=int, default=32)
+    parser.add_argument('--json', help="write the summaries to this file")
+    args = parser.parse_args()
+
+    summaries = []
+    for dataset in args.datasets or sorted(os.listdir(args.base_dir)):
+        if os.path.isdir(os.path.join(args.base_dir, dataset)):
+            summaries.append(validate_dataset(os.path.join(args.base_dir, dataset), args.processes, args.min_size))
+            print_summary(summaries[-1])
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summaries, f, indent=2)
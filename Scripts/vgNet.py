@@ -1,20 +1,23 @@
 import tensorflow as tf
-def vgNet(train_generator,test_generator):
-
-    model = tf.keras.models.Sequential([
+def build_vgnet(input_shape=(224,224,3), num_classes=1, weights="imagenet"):
+    return tf.keras.models.Sequential([
         tf.keras.applications.vgg19.VGG19(
-            weights="imagenet",
+            weights=weights,
             include_top=False,
-            input_shape=(224,224,3),
+            input_shape=input_shape,
         ),
         tf.keras.layers.Flatten(),
         tf.keras.layers.Dense(128, activation="relu"),
         tf.keras.layers.Dropout(0.2),
         tf.keras.layers.Dense(64, activation="relu"),
         tf.keras.layers.Dense(32, activation="tanh"),
-        tf.keras.layers.Dense(1, activation="softmax")
+        tf.keras.layers.Dense(num_classes, activation="softmax", dtype="float32")
     ])
 
+def vgNet(train_generator,test_generator):
+
+    model = build_vgnet()
+
     model.compile(loss="categorical_crossentropy", optimizer="adam", metrics=["accuracy"])
 
     history = model.fit(
@@ -0,0 +1,248 @@
+import os
+import struct
+import numpy as np
+from PIL import Image
+
+# NIfTI-1 datatype codes and the numpy dtypes they map to
+NIFTI_DTYPES = {
+    2: np.uint8,
+    4: np.int16,
+    8: np.int32,
+    16: np.float32,
+    64: np.float64,
+    256: np.int8,
+    512: np.uint16,
+    768: np.uint32,
+}
+
+VOLUME_EXTENSIONS = ('.nii', '.hdr', '.npy', '.raw')
+
+
+# Reads the 348 byte NIfTI-1 header and memory maps the voxel data.
+# Nothing is read from the data block until a slice is indexed.
+def open_nifti(path):
+    if path.endswith('.gz'):
+        raise ValueError(f"'{path}' is compressed and cannot be memory mapped, gunzip it first")
+
+    with open(path, 'rb') as f:
+        header = f.read(348)
+    if len(header) < 348:
+        raise ValueError(f"'{path}' is not a NIfTI-1 file (only {len(header)} header bytes)")
+
+    endian = '<'
+    if struct.unpack('<i', header[:4])[0] != 348:
+        endian = '>'
+        if struct.unpack('>i', header[:4])[0] != 348:
+            raise ValueError(f"'{path}' is not a NIfTI-1 file")
+
+    dim = struct.unpack(endian + '8h', header[40:56])
+    datatype = struct.unpack(endian + 'h', header[70:72])[0]
+    vox_offset = struct.unpack(endian + 'f', header[108:112])[0]
+    magic = header[344:348]
+
+    if datatype not in NIFTI_DTYPES:
+        raise ValueError(f"Unsupported NIfTI datatype {datatype} in '{path}'")
+    if dim[0] < 3 or any(d > 1 for d in dim[4:dim[0] + 1]):
+        raise ValueError(f"'{path}' is not a single 3D volume (dims={dim[1:dim[0] + 1]})")
+
+    data_path, offset = path, int(vox_offset)
+    if magic == b'ni1\x00':
+        # Header/image pair, the voxels live in the matching .img file
+        data_path, offset = os.path.splitext(path)[0] + '.img', 0
+
+    dtype = np.dtype(NIFTI_DTYPES[datatype]).newbyteorder(endian)
+    # NIfTI stores x fastest, so axial slices (last axis) are contiguous on disk
+    return np.memmap(data_path, dtype=dtype, mode='r', offset=offset, shape=tuple(dim[1:4]), order='F')
+
+
+# Memory maps a headerless volume, the shape and dtype have to be known up front
+def open_raw(path, shape, dtype='uint16', offset=0, order='C'):
+    return np.memmap(path, dtype=np.dtype(dtype), mode='r', offset=offset, shape=tuple(shape), order=order)
+
+
+# Opens any supported volume as a lazily read (x, y, z) array
+def open_volume(path, shape=None, dtype='uint16'):
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.nii', '.hdr', '.gz'):
+        return open_nifti(path)
+    if ext == '.npy':
+        volume = np.load(path, mmap_mode='r')
+        if volume.ndim != 3:
+            raise ValueError(f"'{path}' is not a 3D volume (shape {volume.shape})")
+        return volume
+    if shape is None:
+        raise ValueError(f"A shape is required to open the raw volume '{path}'")
+    return open_raw(path, shape, dtype)
+
+
+# Writes a volume as NIfTI-1, mostly useful to produce synthetic test volumes.
+# A .hdr path writes a header/image pair, byteorder='>' a big endian file.
+def write_nifti(path, volume, byteorder='<'):
+    volume = np.asarray(volume)
+    codes = {np.dtype(v): k for k, v in NIFTI_DTYPES.items()}
+    dtype = volume.dtype.newbyteorder(byteorder)
+    if np.dtype(volume.dtype.name) not in codes:
+        raise ValueError(f"Unsupported dtype {volume.dtype} for NIfTI")
+    pair = path.lower().endswith('.hdr')
+
+    dim = [3, *volume.shape[:3], 1, 1, 1, 1]
+    header = bytearray(348)
+    struct.pack_into(byteorder + 'i', header, 0, 348)
+    struct.pack_into(byteorder + '8h', header, 40, *dim)
+    struct.pack_into(byteorder + '2h', header, 70, codes[np.dtype(volume.dtype.name)], volume.dtype.itemsize * 8)
+    struct.pack_into(byteorder + '8f', header, 76, 1, 1, 1, 1, 1, 1, 1, 1)
+    struct.pack_into(byteorder + '3f', header, 108, 0 if pair else 352, 1, 0)
+    header[344:348] = b'ni1\x00' if pair else b'n+1\x00'
+    data = volume.astype(dtype).tobytes(order='F')
+
+    with open(path, 'wb') as f:
+        f.write(header)
+        if not pair:
+            f.write(b'\x00' * 4)
+            f.write(data)
+    if pair:
+        with open(os.path.splitext(path)[0] + '.img', 'wb') as f:
+            f.write(data)
+
+
+# Picks evenly spaced slice indices, skipping the mostly empty slabs at both ends of the scan
+def select_slices(depth, num_slices=16, margin=0.15):
+    if depth <= 0:
+        return []
+    start = int(depth * margin)
+    stop = max(depth - start, start + 1)
+    if num_slices is None or num_slices >= stop - start:
+        return list(range(start, stop))
+    return sorted(set(np.linspace(start, stop - 1, num_slices).round().astype(int).tolist()))
+
+
+# Intensity window for a volume, estimated from a strided subsample so the whole volume is never read
+def intensity_window(volume, low=1, high=99, stride=4):
+    sample = np.asarray(volume[::stride, ::stride, ::stride], dtype=np.float32)
+    lo, hi = np.percentile(sample, [low, high])
+    if hi <= lo:
+        hi = lo + 1
+    return float(lo), float(hi)
+
+
+# Windows a single slice to the 0-255 range the image models were trained on,
+# then resizes it and repeats it over the channels the model expects.
+# The resize runs on a float32 PIL image, so web workers behind a model host never load TensorFlow.
+def prepare_slice(slice_2d, window, img_size, channels=3):
+    lo, hi = window
+    img = (np.clip(np.asarray(slice_2d, dtype=np.float32), lo, hi) - lo) * (255. / (hi - lo))
+    img = Image.fromarray(np.ascontiguousarray(img.T), mode='F')  # (x, y) -> (rows, cols)
+    img = np.asarray(img.resize((img_size[1], img_size[0]), Image.BILINEAR), dtype=np.float32)[..., np.newaxis]
+    if channels > 1:
+        img = np.repeat(img, channels, axis=-1)
+    return img
+
+
+# Lazily yields (index, slice) pairs along an axis, only the selected slices are paged in
+def iter_slices(volume, img_size, channels=3, axis=2, num_slices=16, margin=0.15):
+    volume = np.moveaxis(volume, axis, 2)
+    window = intensity_window(volume)
+    for idx in select_slices(volume.shape[2], num_slices, margin):
+        yield idx, prepare_slice(volume[:, :, idx], window, img_size, channels)
+
+
+# Builds a tf.data pipeline over the slices of many volumes, labels are per volume.
+# The output matches image_dataset_from_directory (float 0-255) so it can go straight into process()
+def volume_slice_dataset(paths, labels, img_size=(224, 224), channels=3, batch_size=32,
+                         num_slices=16, shuffle=True, seed=21):
+    import tensorflow as tf
+
+    def gen():
+        order = np.arange(len(paths))
+        if shuffle:
+            np.random.default_rng(seed).shuffle(order)
+        for i in order:
+            for _, img in iter_slices(open_volume(paths[i]), img_size, channels, num_slices=num_slices):
+                yield img, labels[i]
+
+    ds = tf.data.Dataset.from_generator(
+        gen,
+        output_signature=(
+            tf.TensorSpec(shape=(img_size[0], img_size[1], channels), dtype=tf.float32),
+            tf.TensorSpec(shape=(), dtype=tf.int32),
+        )
+    )
+    if shuffle:
+        ds = ds.shuffle(batch_size * 8, seed=seed)
+    return ds.batch(batch_size)
+
+
+# Volumes that can be opened without a known shape, i.e. everything but .raw
+def is_volume(name):
+    return name.lower().endswith(VOLUME_EXTENSIONS) and not name.lower().endswith('.raw')
+
+
+# True for a <class>/<volume> split directory holding 3D volumes instead of images
+def contains_volumes(directory):
+    return any(is_volume(name) for class_name in os.listdir(directory)
+               if os.path.isdir(os.path.join(directory, class_name))
+               for name in os.listdir(os.path.join(directory, class_name)))
+
+
+# Lists the volumes of a <class>/<volume> directory with integer labels from the sorted class names
+def list_volumes(directory):
+    class_names = sorted(d for d in os.listdir(directory) if os.path.isdir(os.path.join(directory, d)))
+    paths, labels = [], []
+    for label, class_name in enumerate(class_names):
+        class_dir = os.path.join(directory, class_name)
+        for name in sorted(os.listdir(class_dir)):
+            if is_volume(name):
+                paths.append(os.path.join(class_dir, name))
+                labels.append(label)
+    return paths, labels, class_names
+
+
+# Drop in for image_loader.image_dataset over a directory of volumes, every selected slice is an
+# example labelled with its volume's class. shard=(num_shards, index) keeps every num_shards-th volume.
+def volume_dataset(directory, image_size=(256, 256), batch_size=32, channels=3, shuffle=True, seed=21, shard=None,
+                   num_slices=16):
+    paths, labels, class_names = list_volumes(directory)
+    print(f"Found {len(paths)} volumes belonging to {len(class_names)} classes.")
+    if shard is not None:
+        paths, labels = paths[shard[1]::shard[0]], labels[shard[1]::shard[0]]
+    ds = volume_slice_dataset(paths, labels, image_size, channels, batch_size, num_slices, shuffle, seed)
+    ds.class_names = class_names
+    return ds
+
+
+# Combines per slice class probabilities into one prediction for the volume.
+# mean: average probability, max: strongest slice per class, vote: share of slices per argmax
+def aggregate_slice_predictions(predictions, method='mean'):
+    predictions = np.asarray(predictions, dtype=np.float32)
+    if method == 'mean':
+        probs = predictions.mean(axis=0)
+    elif method == 'max':
+        probs = predictions.max(axis=0)
+    elif method == 'vote':
+        probs = np.bincount(predictions.argmax(axis=1), minlength=predictions.shape[1]).astype(np.float32)
+    else:
+        raise ValueError(f"Unknown aggregation method '{method}'")
+    return probs / probs.sum()
+
+
+# Runs a model over the selected slices of a volume in batches and aggregates the result
+def predict_volume(model, volume, num_slices=16, method='mean', batch_size=16):
+    if volume.ndim != 3:
+        raise ValueError(f"Expected a 3D volume, got shape {volume.shape}")
+    if volume.shape[2] == 0:
+        raise ValueError(f"Volume of shape {volume.shape} has no slices to classify")
+    img_size = tuple(model.input_shape[1:3])
+    channels = model.input_shape[-1]
+
+    indices, preds, batch = [], [], []
+    for idx, img in iter_slices(volume, img_size, channels, num_slices=num_slices):
+        indices.append(idx)
+        batch.append(img)
+        if len(batch) == batch_size:
+            preds.append(model.predict(np.stack(batch), verbose=0))
+            batch = []
+    if batch:
+        preds.append(model.predict(np.stack(batch), verbose=0))
+
+    slice_preds = np.concatenate(preds)
+    return aggregate_slice_predictions(slice_preds, method), indices, slice_preds
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Scripts/ modules import each other by bare name, same as web.py sets it up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Scripts"))
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from accumulation import _micro_step, accumulate_gradients
+
+
+def model_pair(micro_batch_size):
+    def build():
+        tf.keras.utils.set_random_seed(0)
+        model = tf.keras.Sequential([tf.keras.Input((6,)), tf.keras.layers.Dense(5, activation="tanh"),
+                                     tf.keras.layers.Dense(3, activation="softmax")])
+        # Plain SGD with lr 1, so one step moves every weight by exactly minus its gradient
+        model.compile(optimizer=tf.keras.optimizers.SGD(1.), loss="sparse_categorical_crossentropy",
+                      metrics=["accuracy"])
+        return model
+    return build(), accumulate_gradients(build(), micro_batch_size)
+
+
+def batch(n=10, weighted=False):
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=(n, 6)).astype(np.float32)
+    y = rng.integers(0, 3, n).astype(np.int32)
+    w = rng.uniform(.5, 2., n).astype(np.float32) if weighted else None
+    return x, y, w
+
+
+# 10 examples in micro-batches of 4 leave an uneven last micro-batch of 2
+@pytest.mark.parametrize("micro_batch_size", [4, 5, 10, 16])
+@pytest.mark.parametrize("weighted", [False, True])
+def test_accumulated_step_matches_the_full_batch_step(micro_batch_size, weighted):
+    full, accumulating = model_pair(micro_batch_size)
+    x, y, w = batch(weighted=weighted)
+    start = [v.copy() for v in full.get_weights()]
+
+    full_logs = full.train_on_batch(x, y, sample_weight=w, return_dict=True)
+    accumulated_logs = accumulating.train_on_batch(x, y, sample_weight=w, return_dict=True)
+
+    for before, a, b in zip(start, full.get_weights(), accumulating.get_weights()):
+        assert not np.allclose(a, before)
+        np.testing.assert_allclose(b, a, rtol=1e-5, atol=1e-6)
+    # Metrics are accumulated over the micro-batches too
+    assert accumulated_logs["loss"] == pytest.approx(full_logs["loss"], rel=1e-5)
+    assert accumulated_logs["accuracy"] == pytest.approx(full_logs["accuracy"])
+
+
+# The micro-batch gradients, each scaled by its share of the batch, sum to the mean-loss gradient
+def test_micro_batch_gradients_sum_to_the_full_batch_gradient():
+    model, _ = model_pair(None)
+    x, y, _ = batch()
+    x, y = tf.constant(x), tf.constant(y)
+    with tf.GradientTape() as tape:
+        loss = model.compute_loss(x, y, model(x, training=True))
+    expected = tape.gradient(loss, model.trainable_variables)
+
+    summed = [tf.zeros_like(v) for v in model.trainable_variables]
+    for start in range(0, 10, 4):
+        grads = _micro_step(model, x[start:start + 4], y[start:start + 4], None, 10)
+        summed = [s + g for s, g in zip(summed, grads)]
+
+    for e, s in zip(expected, summed):
+        np.testing.assert_allclose(s, e, rtol=1e-5, atol=1e-7)
+
+
+def test_micro_batch_size_none_restores_the_normal_step():
+    model = accumulate_gradients(model_pair(None)[0], 4)
+    assert "train_step" in vars(model)
+    accumulate_gradients(model, None)
+    assert "train_step" not in vars(model)
@@ -0,0 +1,37 @@
+import os
+
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+
+import distributed
+
+
+def make_dataset(base_dir):
+    rng = np.random.default_rng(0)
+    for split, n in (("Train", 16), ("Test", 4), ("Valid", 8)):
+        for class_name, value in (("Normal", 60), ("Stroke", 190)):
+            class_dir = os.path.join(base_dir, "Tiny", split, class_name)
+            os.makedirs(class_dir)
+            for i in range(n):
+                img = np.clip(rng.normal(value, 30, (40, 40, 3)), 0, 255).astype(np.uint8)
+                Image.fromarray(img).save(os.path.join(class_dir, f"{i}.png"))
+
+
+# Two local workers train, the chief checkpoints and keeps the best model, the launcher exports it,
+# and a second call resumes instead of starting over
+def test_train_checkpoints_exports_and_resumes(tmp_path, monkeypatch, capfd):
+    base_dir, run_dir, served = str(tmp_path / "datasets"), str(tmp_path / "run"), str(tmp_path / "tiny.h5")
+    make_dataset(base_dir)
+    monkeypatch.setattr(distributed, "DATASET_DIRS", {"Tiny": "Tiny"})
+    monkeypatch.setattr(distributed, "MODEL_PATHS", {"Tiny": served})
+
+    best = distributed.train(2, "ann", "Tiny", base_dir, (32, 32), batch_size=8, epochs=1, run_dir=run_dir)
+    assert best == os.path.join(run_dir, "best.h5")
+    assert tf.train.latest_checkpoint(run_dir).endswith("ckpt-1")
+    assert os.path.exists(served)
+
+    capfd.readouterr()
+    distributed.train(2, "ann", "Tiny", base_dir, (32, 32), batch_size=8, epochs=2, run_dir=run_dir, export=False)
+    assert "Epoch 1/2" not in capfd.readouterr().out
+    assert tf.train.latest_checkpoint(run_dir).endswith("ckpt-2")
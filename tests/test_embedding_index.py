@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from embedding_index import EmbeddingIndex, write_index, synthetic_vectors, normalize, top_k, default_nlist
+
+
+@pytest.fixture(scope="module")
+def data():
+    return synthetic_vectors(n=3000, queries=100)
+
+
+def build(tmp_path, vectors, **kwargs):
+    entries = [{"path": f"{i}.jpg", "label": i % 2} for i in range(len(vectors))]
+    return EmbeddingIndex(write_index(str(tmp_path / "index"), vectors, entries, ["Normal", "Stroke"], **kwargs))
+
+
+def exact(vectors, q, k):
+    scores = normalize(vectors) @ normalize(q)
+    top = top_k(scores, k)
+    return scores[top], top
+
+
+def test_flat_index_matches_exact_search(tmp_path, data):
+    vectors, queries = data
+    index = build(tmp_path, vectors, nlist=0)
+    assert index.centroids is None
+    for q in queries[:20]:
+        scores, ids = index.search(q, 5)
+        want_scores, want_ids = exact(vectors, q, 5)
+        np.testing.assert_array_equal(ids, want_ids)
+        np.testing.assert_allclose(scores, want_scores, rtol=1e-5)
+
+
+def test_ivf_is_the_default_and_keeps_recall(tmp_path, data):
+    vectors, queries = data
+    index = build(tmp_path, vectors)
+    assert index.meta["nlist"] == default_nlist(len(vectors)) == 55
+
+    recall = np.mean([len(set(index.search(q, 5)[1]) & set(exact(vectors, q, 5)[1])) / 5 for q in queries])
+    assert recall >= 0.95
+
+
+def test_probing_every_list_is_exact(tmp_path, data):
+    vectors, queries = data
+    index = build(tmp_path, vectors, nlist=16)
+    for q in queries[:20]:
+        np.testing.assert_array_equal(index.search(q, 5, nprobe=16)[1], exact(vectors, q, 5)[1])
+
+
+def test_similar_returns_entries(tmp_path, data):
+    vectors, _ = data
+    index = build(tmp_path, vectors)
+    results = index.similar(vectors[7], k=3)
+    assert results[0] == {"path": "7.jpg", "label": "Stroke", "score": pytest.approx(1.0, abs=1e-5)}
+    assert len(results) == 3
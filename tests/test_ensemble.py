@@ -0,0 +1,71 @@
+import itertools
+
+import numpy as np
+import pytest
+import tensorflow as tf
+from tensorflow.keras import layers
+
+from ensemble import build_ensemble, input_scale
+from serving import build_serving_model, image_model
+
+SHAPE = (16, 16, 3)
+
+
+def backbone(seed=0):
+    tf.keras.utils.set_random_seed(seed)
+    return tf.keras.Sequential([tf.keras.Input(SHAPE), layers.Conv2D(4, 3, activation="relu"),
+                                layers.GlobalAveragePooling2D()], name="backbone")
+
+
+def member(base, seed):
+    tf.keras.utils.set_random_seed(seed)
+    return tf.keras.Sequential([tf.keras.Input(SHAPE), base, layers.Dense(3, activation="softmax")])
+
+
+def plain(seed, shape=SHAPE):
+    tf.keras.utils.set_random_seed(seed)
+    return tf.keras.Sequential([tf.keras.Input(shape), layers.Flatten(), layers.Dense(3, activation="softmax")])
+
+
+def images(n=4):
+    return np.random.default_rng(0).uniform(0, 255, (n, *SHAPE)).astype(np.float32)
+
+
+def test_members_with_identical_backbones_share_one_pass():
+    members = [member(backbone(0), 1), member(backbone(0), 2), member(backbone(3), 4)]
+    ensemble = build_ensemble(members)
+    assert ensemble.shared_backbones == 1
+    assert sum(layer.name.startswith("backbone_") for layer in ensemble.layers) == 2
+
+    # Sharing the backbone does not change what each member predicts
+    x = images()
+    expected = np.mean([m.predict_on_batch(x / 255.) for m in members], axis=0)
+    np.testing.assert_allclose(ensemble.predict_on_batch(x), expected, rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize("method", ["mean", "vote"])
+@pytest.mark.parametrize("weights", [None, [1., 3., .5]])
+def test_combined_outputs_sum_to_one(method, weights):
+    members = [plain(0), plain(1), plain(2, (8, 8, 3))]
+    probs = build_ensemble(members, method, weights).predict_on_batch(images(8))
+    assert probs.shape == (8, 3)
+    np.testing.assert_allclose(probs.sum(axis=1), 1., rtol=1e-5)
+    if method == "vote":
+        # Every class gets the summed weight of the members voting for it
+        w = np.array(weights or [1.] * 3) / sum(weights or [1.] * 3)
+        subsets = [w[list(c)].sum() for n in range(4) for c in itertools.combinations(range(3), n)]
+        assert all(np.isclose(p, subsets, atol=1e-6).any() for p in probs.ravel())
+
+
+def test_serving_members_keep_their_own_input_scale():
+    raw, scaled = build_serving_model(plain(0), scale=1.), build_serving_model(plain(1))
+    assert input_scale(raw) == 1. and input_scale(scaled) == pytest.approx(1. / 255)
+
+    x = images()
+    for serving_model in (raw, scaled):
+        np.testing.assert_allclose(build_ensemble([serving_model]).predict_on_batch(x),
+                                   image_model(serving_model).predict_on_batch(x), rtol=1e-5, atol=1e-6)
+    # A bare classifier trained on 0-255 pixels takes the ensemble's scale
+    bare = plain(0)
+    np.testing.assert_allclose(build_ensemble([bare], scale=1.).predict_on_batch(x), bare.predict_on_batch(x),
+                               rtol=1e-5, atol=1e-6)
@@ -0,0 +1,64 @@
+import io
+
+import numpy as np
+import pytest
+import tensorflow as tf
+from PIL import Image
+from tensorflow.keras import layers
+
+from architectures import build_model
+from explain import Explainer, image_hash, overlay
+from serving import build_serving_model
+
+
+def serving_cnn():
+    tf.keras.utils.set_random_seed(0)
+    return build_serving_model(tf.keras.Sequential([
+        tf.keras.Input((32, 32, 3)), layers.Conv2D(4, 3, activation="relu"), layers.MaxPooling2D(),
+        layers.Conv2D(8, 3, activation="relu"), layers.Flatten(), layers.Dense(2, activation="softmax")]))
+
+
+def png(seed):
+    img = np.random.default_rng(seed).integers(0, 255, (40, 40, 3), dtype=np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(img).save(buf, "PNG")
+    return buf.getvalue()
+
+
+def test_heatmaps_are_0_to_1_at_feature_map_resolution(tmp_path):
+    model = serving_cnn()
+    images = [png(i) for i in range(3)]
+    results = Explainer(model, cache_dir=str(tmp_path)).explain(images)
+
+    expected = model.predict_on_batch(tf.constant(images))
+    for (cam, probs), p in zip(results, expected):
+        assert cam.shape == (13, 13)
+        assert cam.min() >= 0 and cam.max() <= 1 + 1e-6
+        np.testing.assert_allclose(probs, p, rtol=1e-5, atol=1e-6)
+    assert overlay(images[0], results[0][0], max_size=24).shape == (24, 24, 3)
+
+
+def test_repeated_images_come_from_the_cache(tmp_path, monkeypatch):
+    model = serving_cnn()
+    explainer = Explainer(model, cache_dir=str(tmp_path))
+    first = explainer.explain([png(0), png(1)])
+    assert (tmp_path / explainer.fingerprint / f"{image_hash(png(0))}.npz").exists()
+
+    def no_recompute(images):
+        raise AssertionError("recomputed a cached image")
+
+    # Held in memory, and on disk for a fresh explainer over the same weights
+    monkeypatch.setattr(explainer, "_batch", no_recompute)
+    again = explainer.explain([png(1), png(0)])
+    assert again[0] is first[1] and again[1] is first[0]
+
+    fresh = Explainer(model, cache_dir=str(tmp_path))
+    monkeypatch.setattr(fresh, "_batch", no_recompute)
+    cam, probs = fresh.explain([png(0)])[0]
+    np.testing.assert_allclose(cam, first[0][0], atol=1e-3)
+    np.testing.assert_allclose(probs, first[0][1])
+
+
+def test_models_without_a_conv_layer_are_rejected():
+    with pytest.raises(ValueError, match="no convolutional layer"):
+        Explainer(build_serving_model(build_model("ann", (32, 32, 3), 2)), cache_dir=None)
@@ -0,0 +1,135 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import decoded_cache
+import ingest
+
+IMG_SIZE = (16, 16)
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(decoded_cache, "CACHE_DIR", str(tmp_path / "cache"))
+
+
+def write_png(path, value, mtime=None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.fromarray(np.full((20, 20), value, np.uint8)).save(path)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+# A structured dataset whose landing folders still hold the original files
+@pytest.fixture
+def dataset(tmp_path):
+    ds = tmp_path / "Scans"
+    for i in range(4):
+        write_png(str(ds / "Stroke" / f"{i}.png"), 10 * i)
+    for i, split in ((0, "Train"), (1, "Train"), (2, "Test"), (3, "Test")):
+        os.makedirs(ds / split / "Stroke", exist_ok=True)
+        shutil.copy2(ds / "Stroke" / f"{i}.png", ds / split / "Stroke")
+    return str(ds)
+
+
+def split_files(ds):
+    return sorted(os.path.relpath(os.path.join(root, f), ds) for split in ("Train", "Test", "Valid")
+                  for root, _, files in os.walk(os.path.join(ds, split)) for f in files)
+
+
+def cached(ds, rel):
+    return np.load(decoded_cache.entry_path(os.path.basename(ds), IMG_SIZE, 1, rel))
+
+
+def test_first_run_adopts_the_existing_split(dataset):
+    before = split_files(dataset)
+    added, changed, removed = ingest.ingest_dataset(dataset)
+    assert (added, changed, removed) == ([], [], [])
+    assert split_files(dataset) == before
+
+    manifest = ingest.load_manifest("Scans")
+    assert manifest["Stroke/0.png"]["split"] == "Train" and manifest["Stroke/3.png"]["split"] == "Test"
+    # Nothing changed, nothing is hashed or copied again
+    assert ingest.ingest_dataset(dataset) == ([], [], [])
+
+
+def test_new_files_get_a_stable_split(dataset):
+    ingest.ingest_dataset(dataset)
+    write_png(os.path.join(dataset, "Stroke", "new.png"), 200)
+
+    added, changed, removed = ingest.ingest_dataset(dataset)
+    split = ingest.assign_split("Stroke/new.png", ingest.SPLITS)
+    assert added == [f"{split}/Stroke/new.png"] and not changed and not removed
+    assert os.path.exists(os.path.join(dataset, split, "Stroke", "new.png"))
+    assert ingest.load_manifest("Scans")["Stroke/new.png"]["split"] == split
+
+
+def test_changed_file_is_recopied_and_its_cache_entry_patched(dataset):
+    decoded_cache.load_split(dataset, "Train", IMG_SIZE, 1)
+    ingest.ingest_dataset(dataset)
+    assert cached(dataset, "Train/Stroke/1.png").max() == 10
+
+    # Replaced in place with an older mtime, like a file restored from a backup
+    write_png(os.path.join(dataset, "Stroke", "1.png"), 250, mtime=1e9)
+    added, changed, removed = ingest.ingest_dataset(dataset)
+    assert changed == ["Train/Stroke/1.png"] and not added and not removed
+
+    assert np.asarray(Image.open(os.path.join(dataset, "Train", "Stroke", "1.png"))).max() == 250
+    assert cached(dataset, "Train/Stroke/1.png").max() == 250
+    images, labels, _ = decoded_cache.load_split(dataset, "Train", IMG_SIZE, 1)
+    assert sorted(images.reshape(len(images), -1).max(axis=1).tolist()) == [0, 250]
+
+    # Touched but identical: not reported as changed
+    os.utime(os.path.join(dataset, "Stroke", "1.png"), (2e9, 2e9))
+    assert ingest.ingest_dataset(dataset) == ([], [], [])
+
+
+def test_cleared_landing_folder_keeps_the_splits(dataset):
+    ingest.ingest_dataset(dataset)
+    before = split_files(dataset)
+    # What structure_datasets() does after splitting
+    shutil.rmtree(os.path.join(dataset, "Stroke"))
+
+    assert ingest.ingest_dataset(dataset) == ([], [], [])
+    assert split_files(dataset) == before
+    assert len(ingest.load_manifest("Scans")) == 4
+
+    # The files come back unchanged: nothing to do
+    os.makedirs(os.path.join(dataset, "Stroke"))
+    for i in range(4):
+        shutil.copy2(os.path.join(dataset, "Train" if i < 2 else "Test", "Stroke", f"{i}.png"),
+                     os.path.join(dataset, "Stroke"))
+    assert ingest.ingest_dataset(dataset) == ([], [], [])
+
+
+def test_prune_deletes_removed_files_and_their_cache_entries(dataset):
+    decoded_cache.load_split(dataset, "Test", IMG_SIZE, 1)
+    ingest.ingest_dataset(dataset)
+    os.remove(os.path.join(dataset, "Stroke", "2.png"))
+
+    added, changed, removed = ingest.ingest_dataset(dataset, prune=True)
+    assert removed == ["Test/Stroke/2.png"] and not added and not changed
+    assert not os.path.exists(os.path.join(dataset, "Test", "Stroke", "2.png"))
+    assert not os.path.exists(decoded_cache.entry_path("Scans", IMG_SIZE, 1, "Test/Stroke/2.png"))
+    assert "Stroke/2.png" not in ingest.load_manifest("Scans")
+
+
+def test_dry_run_changes_nothing(dataset):
+    ingest.ingest_dataset(dataset)
+    write_png(os.path.join(dataset, "Stroke", "new.png"), 200)
+    os.remove(os.path.join(dataset, "Stroke", "0.png"))
+    before = split_files(dataset)
+
+    added, _, removed = ingest.ingest_dataset(dataset, dry_run=True, prune=True)
+    assert len(added) == 1 and removed == ["Train/Stroke/0.png"]
+    assert split_files(dataset) == before
+    assert "Stroke/new.png" not in ingest.load_manifest("Scans")
+
+
+def test_splits_without_valid_match_structure_datasets():
+    assert dict(ingest.SPLITS) == {"Train": .6, "Test": .4}
+    with_valid = dict(ingest.SPLITS_WITH_VALID)
+    assert with_valid["Train"] == .6 and with_valid["Test"] + with_valid["Valid"] == pytest.approx(.4)
@@ -0,0 +1,170 @@
+import io
+import time
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import job_queue
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = job_queue.connect(str(tmp_path / "jobs.sqlite"))
+    yield conn
+    conn.close()
+
+
+def jpeg(seed=0, size=(40, 32)):
+    buf = io.BytesIO()
+    Image.fromarray(np.random.default_rng(seed).integers(0, 255, (*size, 3), dtype=np.uint8)).save(buf, "JPEG")
+    return buf.getvalue()
+
+
+def statuses(conn):
+    return {row["id"]: row["status"] for row in conn.execute("SELECT id, status FROM jobs")}
+
+
+def test_claim_batch_takes_oldest_jobs_of_one_model(conn):
+    ids = [job_queue.enqueue(conn, test_type, b"x") for test_type in ("Tumor", "Brain Stroke", "Tumor", "Tumor")]
+
+    test_type, rows = job_queue.claim_batch(conn, "w1", limit=2)
+    assert test_type == "Tumor"
+    assert [row["id"] for row in rows] == [ids[0], ids[2]]
+    assert statuses(conn) == {ids[0]: "running", ids[1]: "queued", ids[2]: "running", ids[3]: "queued"}
+    assert job_queue.get_job(conn, ids[0])["status"] == "running"
+
+    # The oldest queued job is now the stroke one
+    test_type, rows = job_queue.claim_batch(conn, "w2", limit=8)
+    assert test_type == "Brain Stroke" and [row["id"] for row in rows] == [ids[1]]
+    assert job_queue.queue_position(conn, ids[3]) == 0
+
+    assert job_queue.claim_batch(conn, "w1", limit=8)[1][0]["id"] == ids[3]
+    assert job_queue.claim_batch(conn, "w1", limit=8) == (None, [])
+
+
+def test_concurrent_claims_never_share_a_job(tmp_path):
+    path = str(tmp_path / "jobs.sqlite")
+    conns = [job_queue.connect(path) for _ in range(3)]
+    ids = {job_queue.enqueue(conns[0], "Tumor", b"x") for _ in range(20)}
+
+    claimed = []
+    while True:
+        batches = [job_queue.claim_batch(c, f"w{i}", limit=3)[1] for i, c in enumerate(conns)]
+        if not any(batches):
+            break
+        claimed.extend(row["id"] for rows in batches for row in rows)
+    assert sorted(claimed) == sorted(ids)
+
+
+def test_recover_jobs_requeues_only_dead_workers(conn):
+    ids = [job_queue.enqueue(conn, "Tumor", b"x") for _ in range(3)]
+    job_queue.register_worker(conn, "alive")
+    job_queue.register_worker(conn, "dead")
+    conn.execute("UPDATE workers SET heartbeat = ? WHERE name = 'dead'", (time.time() - 3600,))
+
+    job_queue.claim_batch(conn, "alive", limit=1)
+    job_queue.claim_batch(conn, "dead", limit=1)
+    job_queue.claim_batch(conn, "never-registered", limit=1)
+
+    assert job_queue.recover_jobs(conn) == 2
+    assert statuses(conn) == {ids[0]: "running", ids[1]: "queued", ids[2]: "queued"}
+    requeued = job_queue.get_job(conn, ids[1])
+    assert requeued["started"] is None
+    assert job_queue.workers_alive(conn) == 1
+
+    # Requeued jobs go to the next claim with their image intact
+    _, rows = job_queue.claim_batch(conn, "alive", limit=8)
+    assert [row["id"] for row in rows] == ids[1:] and bytes(rows[0]["image"]) == b"x"
+
+
+def image_size(conn, job_id):
+    return conn.execute("SELECT length(image) FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+
+
+def test_finished_jobs_drop_their_image(conn):
+    done, failed, queued = (job_queue.enqueue(conn, "Tumor", b"image bytes") for _ in range(3))
+    job_queue.complete(conn, [(done, [.25, .75])])
+    job_queue.fail(conn, [failed], "ValueError: bad")
+
+    assert job_queue.get_job(conn, done)["result"] == [.25, .75]
+    assert job_queue.get_job(conn, failed)["error"] == "ValueError: bad"
+    assert image_size(conn, done) == 0 and image_size(conn, failed) == 0
+    assert image_size(conn, queued) == len(b"image bytes")
+
+    conn.execute("UPDATE jobs SET status = 'done', image = ? WHERE id = ?", (b"left over", queued))
+    assert job_queue.clear_finished_images(conn) == 1
+    assert image_size(conn, queued) == 0
+
+
+@pytest.fixture(scope="module")
+def serving_model():
+    import tensorflow as tf
+    from serving import build_serving_model
+
+    tf.keras.utils.set_random_seed(0)
+    model = tf.keras.Sequential([
+        tf.keras.Input((16, 16, 3)),
+        tf.keras.layers.GlobalAveragePooling2D(),
+        tf.keras.layers.Dense(2, activation="softmax"),
+    ])
+    return build_serving_model(model)
+
+
+def test_corrupt_upload_only_fails_its_own_job(conn, serving_model):
+    good = [job_queue.enqueue(conn, "Tumor", jpeg(i)) for i in range(2)]
+    bad = job_queue.enqueue(conn, "Tumor", b"garbage")
+    good.append(job_queue.enqueue(conn, "Tumor", jpeg(2)))
+    job_queue.register_worker(conn, "w")
+
+    assert job_queue.process_batch(conn, "w", {"Tumor": serving_model}, batch_size=8) == 4
+    assert statuses(conn) == {**{i: "done" for i in good}, bad: "failed"}
+    assert "InvalidArgumentError" in job_queue.get_job(conn, bad)["error"]
+
+    expected = serving_model.predict(np.array([jpeg(i) for i in range(3)], dtype=object), verbose=0)
+    results = np.array([job_queue.get_job(conn, i)["result"] for i in good])
+    np.testing.assert_allclose(results, expected, rtol=1e-5, atol=1e-6)
+    assert all(image_size(conn, i) == 0 for i in good + [bad])
+
+    worker = conn.execute("SELECT jobs_done FROM workers WHERE name = 'w'").fetchone()
+    assert worker["jobs_done"] == 4
+
+
+def test_jobs_for_a_missing_model_fail(conn, serving_model):
+    job_id = job_queue.enqueue(conn, "Alzheimer's", jpeg())
+    job_queue.register_worker(conn, "w")
+    assert job_queue.process_batch(conn, "w", {"Tumor": serving_model}) == 1
+    assert "not loaded" in job_queue.get_job(conn, job_id)["error"]
+    assert job_queue.process_batch(conn, "w", {"Tumor": serving_model}) == 0
+
+
+# Stands in for a model whose batch outlasts the heartbeat timeout, and looks at the queue from
+# another connection while it runs, the way the pool's recover_jobs and web.py would
+class SlowModel:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.seen = []
+
+    def predict(self, images, batch_size=None, verbose=0):
+        time.sleep(0.5)
+        other = job_queue.connect(self.db_path)
+        self.seen.append((job_queue.recover_jobs(other, timeout=0.2), job_queue.workers_alive(other, timeout=0.2)))
+        other.close()
+        return np.full((len(images), 2), 0.5)
+
+
+def test_worker_stays_alive_through_a_slow_batch(tmp_path):
+    path = str(tmp_path / "jobs.sqlite")
+    conn = job_queue.connect(path)
+    ids = [job_queue.enqueue(conn, "Tumor", b"x") for _ in range(2)]
+    job_queue.register_worker(conn, "w")
+    stop = job_queue.start_heartbeat(path, "w", interval=0.05)
+    model = SlowModel(path)
+    try:
+        assert job_queue.process_batch(conn, "w", {"Tumor": model}) == 2
+    finally:
+        stop.set()
+
+    # Nothing was requeued while the batch ran and the worker never looked dead
+    assert model.seen == [(0, 1)]
+    assert statuses(conn) == {ids[0]: "done", ids[1]: "done"}
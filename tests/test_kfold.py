@@ -0,0 +1,90 @@
+import os
+import json
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import decoded_cache
+import image_loader
+import kfold
+
+IMG_SIZE = (16, 16)
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(decoded_cache, "CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(image_loader, "CACHE_DIR", str(tmp_path / "cache"))
+
+
+def write_png(path, value, mtime):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.fromarray(np.full((20, 20), value, np.uint8)).save(path)
+    os.utime(path, (mtime, mtime))
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    ds = tmp_path / "Scans"
+    for split in ("Train", "Test"):
+        for label, class_name in enumerate(("Normal", "Stroke")):
+            for i in range(2):
+                write_png(str(ds / split / class_name / f"{i}.png"), 100 * label + 10 * i, 1_000_000)
+    return str(ds)
+
+
+def build(ds):
+    images_path, labels_path, meta = kfold.build_shared_cache(ds, IMG_SIZE, 1)
+    return np.load(images_path), np.load(labels_path), meta
+
+
+def test_unchanged_dataset_reuses_the_shared_cache(dataset):
+    _, _, first = build(dataset)
+    _, _, second = build(dataset)
+    assert second == first
+
+
+def test_file_replaced_in_place_with_an_older_mtime_is_redecoded(dataset):
+    images, _, _ = build(dataset)
+    path = os.path.join(dataset, "Train", "Stroke", "0.png")
+    assert images[2].max() == 100
+
+    # What ingest.py does for a changed scan: copy2 over the old path, keeping the source's older mtime.
+    # The class directory mtime does not change.
+    class_dir = os.path.dirname(path)
+    dir_mtime = os.stat(class_dir).st_mtime_ns
+    write_png(path, 200, 500_000)
+    os.utime(class_dir, ns=(dir_mtime, dir_mtime))
+
+    images, _, _ = build(dataset)
+    assert images[2].max() == 200
+
+
+def test_quarantined_files_leave_the_shared_cache(dataset):
+    images, labels, _ = build(dataset)
+    assert len(images) == 8
+
+    os.makedirs(os.path.dirname(image_loader.quarantine_path("Scans")), exist_ok=True)
+    with open(image_loader.quarantine_path("Scans"), "w") as f:
+        f.write("Test/Stroke/1.png\tcorrupt\n")
+    images, labels, meta = build(dataset)
+    assert len(images) == len(labels) == 7
+    with open(os.path.join(decoded_cache.cache_dir("Scans", IMG_SIZE, 1), "kfold_meta.json")) as f:
+        assert json.load(f) == meta
+
+
+def test_cache_of_selected_splits_leaves_the_others_out(dataset):
+    for class_name in ("Normal", "Stroke"):
+        for i in range(2):
+            write_png(os.path.join(dataset, "Test", class_name, f"{i}.png"), 250, 1_000_000)
+            write_png(os.path.join(dataset, "Valid", class_name, f"{i}.png"), 150, 1_000_000)
+    all_path, _, all_meta = kfold.build_shared_cache(dataset, IMG_SIZE, 1)
+    sweep_path, labels_path, meta = kfold.build_shared_cache(dataset, IMG_SIZE, 1, splits=("Train", "Valid"))
+
+    assert sweep_path != all_path
+    assert all_meta["splits"] == ["Train", "Test", "Valid"] and meta["splits"] == ["Train", "Valid"]
+    assert 250 in np.load(all_path).max(axis=(1, 2, 3))
+    images = np.load(sweep_path)
+    assert len(images) == len(np.load(labels_path)) == 8
+    assert 250 not in images.max(axis=(1, 2, 3))
@@ -0,0 +1,47 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import model_host
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(model_host.__file__))
+
+# What a web worker behind a model host runs for a volume upload: memory map it, slice it and send
+# the pixels to the host (a numpy stand in here). None of it may load TensorFlow.
+WEB_WORKER = """
+import sys, tempfile, os
+import numpy as np
+import job_queue, reports, model_host, explain, embedding_index
+from volumes import write_nifti, open_volume, predict_volume
+
+class PixelModel:
+    input_shape = (None, 32, 32, 3)
+    def predict(self, images, verbose=0):
+        assert images.shape[1:] == (32, 32, 3) and images.dtype == np.float32
+        return np.tile([[.25, .75]], (len(images), 1))
+
+path = os.path.join(tempfile.mkdtemp(), "scan.nii")
+write_nifti(path, np.random.default_rng(0).integers(0, 900, (40, 36, 20)).astype(np.int16))
+probs, indices, _ = predict_volume(PixelModel(), open_volume(path))
+assert len(indices) > 0 and abs(probs[1] - .75) < 1e-6
+print('tensorflow' in sys.modules)
+"""
+
+
+def test_web_worker_path_does_not_import_tensorflow():
+    out = subprocess.run([sys.executable, "-c", WEB_WORKER], cwd=SCRIPTS_DIR, capture_output=True, text=True,
+                         check=True).stdout
+    assert out.strip() == "False"
+
+
+def test_authkey_has_no_default(monkeypatch):
+    monkeypatch.delenv(model_host.KEY_ENV, raising=False)
+    with pytest.raises(RuntimeError, match=model_host.KEY_ENV):
+        model_host.authkey()
+    with pytest.raises(RuntimeError):
+        model_host.connect_models("127.0.0.1:1", retries=1)
+
+    monkeypatch.setenv(model_host.KEY_ENV, "s3cret")
+    assert model_host.authkey() == b"s3cret"
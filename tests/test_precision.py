@@ -0,0 +1,70 @@
+from io import BytesIO
+
+import numpy as np
+import pytest
+import tensorflow as tf
+from PIL import Image
+from tensorflow.keras import layers
+
+import precision
+from serving import build_serving_model
+
+
+@pytest.fixture(autouse=True)
+def bf16(monkeypatch):
+    # Converts to bf16 whatever the CPU, it is only slower where oneDNN emulates it
+    monkeypatch.setattr(precision, "bf16_supported", lambda: True)
+
+
+def classifier(activation="softmax", num_classes=3):
+    tf.keras.utils.set_random_seed(0)
+    return tf.keras.Sequential([
+        tf.keras.Input((16, 16, 3)), layers.Conv2D(8, 3, activation="relu"), layers.GlobalAveragePooling2D(),
+        layers.Dense(16, activation="relu"), layers.Dense(num_classes, activation=activation)])
+
+
+def images(n=8):
+    return np.random.default_rng(0).uniform(0, 1, (n, 16, 16, 3)).astype(np.float32)
+
+
+def policies(model):
+    return [layer.dtype_policy.name for layer in model.layers]
+
+
+@pytest.mark.parametrize("activation,num_classes", [("softmax", 3), ("sigmoid", 1)])
+def test_outputs_stay_float32_and_predict_like_float32(activation, num_classes):
+    model = classifier(activation, num_classes)
+    converted = precision.convert_model(model, "mixed_bfloat16")
+
+    assert policies(converted) == ["mixed_bfloat16"] * 3 + ["float32"]
+    assert converted.output.dtype == tf.float32
+    assert tf.keras.mixed_precision.global_policy().name == "float32"
+
+    x = images()
+    np.testing.assert_allclose(converted.predict_on_batch(x), model.predict_on_batch(x), atol=2e-2)
+
+
+def test_softmax_layer_and_nested_serving_classifier_stay_float32():
+    tf.keras.utils.set_random_seed(0)
+    model = tf.keras.Sequential([tf.keras.Input((16, 16, 3)), layers.Conv2D(4, 3), layers.Flatten(),
+                                 layers.Dense(2), layers.Softmax()])
+    serving_model = build_serving_model(model)
+    converted = precision.convert_model(serving_model, "mixed_bfloat16")
+
+    assert policies(converted.layers[-1]) == ["mixed_bfloat16"] * 3 + ["float32"]
+    assert converted.output.dtype == tf.float32
+
+    encoded = []
+    for img in (images(4) * 255).astype(np.uint8):
+        buf = BytesIO()
+        Image.fromarray(img).save(buf, "PNG")
+        encoded.append(buf.getvalue())
+    np.testing.assert_allclose(converted.predict_on_batch(tf.constant(encoded)),
+                               serving_model.predict_on_batch(tf.constant(encoded)), atol=2e-2)
+
+
+def test_float32_conversion_is_exact():
+    model = classifier()
+    converted = precision.convert_model(model, "float32")
+    assert set(policies(converted)) == {"float32"}
+    np.testing.assert_array_equal(converted.predict_on_batch(images()), model.predict_on_batch(images()))
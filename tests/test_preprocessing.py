@@ -0,0 +1,51 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from image_loader import decode_image, image_dataset
+from preprocess import process
+from serving import check_preprocessing_parity, serving_preprocessor
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+# RGB JPEG, grayscale JPEG large enough for the reduced ratio decode, RGBA PNG
+IMAGES = [os.path.join(DATA_DIR, name) for name in ("scan_rgb.jpg", "scan_gray.jpg", "scan_rgba.png")]
+SIZES = [((224, 224), 3), ((124, 124), 1), ((320, 320), 3)]
+
+
+def serve(paths, img_size, channels):
+    inputs, x = serving_preprocessor(img_size, channels)
+    return tf.keras.Model(inputs, x).predict(tf.constant([open(p, "rb").read() for p in paths]), verbose=0)
+
+
+@pytest.mark.parametrize("img_size,channels", SIZES)
+def test_check_preprocessing_parity(img_size, channels):
+    assert check_preprocessing_parity(IMAGES, img_size, channels)
+
+
+# The training input pipeline as get_ds_splits() builds it, against the serving graph
+@pytest.mark.parametrize("img_size,channels", SIZES)
+def test_training_pipeline_matches_serving(tmp_path, img_size, channels):
+    class_dir = tmp_path / "Train" / "scans"
+    class_dir.mkdir(parents=True)
+    for path in IMAGES:
+        shutil.copy(path, class_dir)
+
+    ds = image_dataset(str(tmp_path / "Train"), img_size, batch_size=len(IMAGES), channels=channels, shuffle=False)
+    train_x, _ = next(iter(process(ds, len(IMAGES), img_size, mode=1)))
+    serve_x = serve(sorted(str(class_dir / os.path.basename(p)) for p in IMAGES), img_size, channels)
+
+    assert train_x.shape == (len(IMAGES), *img_size, channels)
+    np.testing.assert_array_equal(train_x.numpy(), serve_x)
+
+
+# The decoded caches store uint8, so they may only differ from serving by rounding
+@pytest.mark.parametrize("img_size,channels", SIZES)
+def test_cached_decode_matches_serving(img_size, channels):
+    cached = np.stack([decode_image(p, img_size, channels) for p in IMAGES])
+    serve_x = serve(IMAGES, img_size, channels) * 255.
+
+    assert cached.dtype == np.uint8 and cached.shape == serve_x.shape
+    assert np.abs(cached - serve_x).max() <= 0.5 + 1e-3
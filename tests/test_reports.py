@@ -0,0 +1,61 @@
+import os
+import csv
+import json
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+import reports
+from model_catalog import CLASS_NAMES, NEGATIVE_CLASS
+from reports import summarize, format_report
+
+
+@pytest.mark.parametrize("test_type", list(CLASS_NAMES))
+def test_condition_follows_the_negative_class(test_type):
+    names = CLASS_NAMES[test_type]
+    for top, name in enumerate(names):
+        probs = [.9 if i == top else .1 / (len(names) - 1) for i in range(len(names))]
+        _, _, prediction, condition, confidence = summarize({"test_type": test_type, "probabilities": probs})
+        assert prediction == name and confidence == pytest.approx(.9)
+        assert condition == ("Condition Negative" if name == NEGATIVE_CLASS[test_type] else "Condition Positive")
+
+
+def test_glioma_is_positive():
+    report = format_report({"patient_name": "A", "patient_age": "40", "test_type": "Tumor",
+                            "probabilities": [.7, .1, .1, .1]})
+    assert "Prediction: Condition Positive (glioma, 70.0%)" in report
+    assert "Patient ID" not in report
+
+
+# web.py imports reports, workers behind a model host must not load TensorFlow through it
+def test_reports_does_not_import_tensorflow():
+    code = "import sys, reports; print('tensorflow' in sys.modules)"
+    out = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(reports.__file__),
+                         capture_output=True, text=True, check=True).stdout
+    assert out.strip() == "False"
+
+
+@pytest.mark.parametrize("probs", [[.1, .2, .6, .05, .05], [.3, .7]])
+def test_output_width_that_does_not_match_the_classes_gets_index_labels(probs):
+    names, _, prediction, condition, confidence = summarize({"test_type": "Tumor", "probabilities": probs})
+    assert names == [str(i) for i in range(len(probs))]
+    assert prediction == str(int(np.argmax(probs))) and confidence == max(probs)
+    assert condition == "Condition Unknown"
+    assert "Prediction: Condition Unknown" in format_report({"test_type": "Tumor", "probabilities": probs})
+
+
+def test_bulk_reports_with_an_unexpected_output_width(tmp_path):
+    records = [{"patient_id": "1", "test_type": "Tumor", "probabilities": [.7, .1, .1, .1]},
+               {"patient_id": "2", "test_type": "Tumor", "probabilities": [.1, .1, .1, .1, .6]}]
+    reports.write_bulk_reports(iter(records), str(tmp_path), bundle=False)
+
+    with open(tmp_path / "results.csv") as f:
+        rows = list(csv.DictReader(f))
+    assert [row["prediction"] for row in rows] == ["glioma", "4"]
+    assert rows[0]["p_glioma"] == "0.7" and rows[1]["p_glioma"] == ""
+    with open(tmp_path / "results.jsonl") as f:
+        lines = [json.loads(line) for line in f]
+    assert lines[1]["probabilities"] == {"0": .1, "1": .1, "2": .1, "3": .1, "4": .6}
+    assert not any(key.startswith("p_") for line in lines for key in line)
@@ -0,0 +1,28 @@
+import json
+
+import pytest
+
+import sweep
+
+
+SETTINGS = {"arch": "cnn", "dataset": "Brain Stroke", "space": sweep.DEFAULT_SPACE, "rungs": [1, 3, 9], "eta": 3,
+            "seed": 43, "weights": None, "batch_size": 32, "splits": list(sweep.SWEEP_SPLITS)}
+
+
+def test_sweeps_never_see_the_test_split():
+    assert "Test" not in sweep.SWEEP_SPLITS
+
+
+def test_study_from_before_the_split_change_is_not_resumed(tmp_path):
+    conn = sweep.connect(str(tmp_path))
+    old = {k: v for k, v in SETTINGS.items() if k != "splits"}
+    conn.executemany("INSERT INTO study (key, value) VALUES (?, ?)", [(k, json.dumps(v)) for k, v in old.items()])
+
+    with pytest.raises(ValueError, match="splits"):
+        sweep.init_study(conn, SETTINGS)
+
+
+def test_study_resumes_with_the_same_settings(tmp_path):
+    conn = sweep.connect(str(tmp_path))
+    sweep.init_study(conn, SETTINGS)
+    assert sweep.init_study(conn, dict(SETTINGS, batch_size=64)) == SETTINGS
@@ -0,0 +1,84 @@
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from serving import export_serving_model, serving_path
+from training import fit_resumable, promote_model, evaluate_saved
+
+
+def tiny_model():
+    model = tf.keras.Sequential([tf.keras.Input((4,)), tf.keras.layers.Dense(2, activation="softmax")])
+    model.compile(optimizer="adam", loss="sparse_categorical_crossentropy", metrics=["accuracy"])
+    return model
+
+
+def datasets():
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(32, 4)).astype(np.float32)
+    y = (x[:, 0] > 0).astype(np.int32)
+    ds = tf.data.Dataset.from_tensor_slices((x, y)).batch(8)
+    return ds, ds
+
+
+def test_last_epoch_is_checkpointed_when_it_is_not_a_multiple_of_every(tmp_path):
+    run_dir = str(tmp_path / "run")
+    train_ds, val_ds = datasets()
+    fit_resumable(tiny_model(), train_ds, val_ds, 4, run_dir, patience=None, every=3, verbose=0)
+
+    assert tf.train.latest_checkpoint(run_dir).endswith("ckpt-4")
+    # A restart finds the run finished instead of training the last epoch again
+    assert fit_resumable(tiny_model(), train_ds, val_ds, 4, run_dir, patience=None, every=3, verbose=0) is None
+
+
+def image_model(weights=None):
+    model = tf.keras.Sequential([tf.keras.Input((8, 8, 1)), tf.keras.layers.Flatten(),
+                                 tf.keras.layers.Dense(2, activation="softmax")])
+    if weights is not None:
+        model.set_weights(weights)
+    return model
+
+
+# Bright images are class 1. The good model reads that off the mean pixel, the bad one the opposite.
+def brightness_data():
+    rng = np.random.default_rng(0)
+    y = np.arange(32) % 2
+    x = (rng.uniform(0, .5, (32, 8, 8, 1)) + .5 * y[:, None, None, None]).astype(np.float32)
+    return tf.data.Dataset.from_tensor_slices((x, y)).batch(8)
+
+
+def saved(path, sign):
+    kernel = np.zeros((64, 2), np.float32)
+    kernel[:, 1], kernel[:, 0] = sign, -sign
+    image_model([kernel, np.array([32., -32.], np.float32) * sign]).save(path)
+    return path
+
+
+def test_better_model_replaces_the_served_model_and_its_graph(tmp_path):
+    served = saved(str(tmp_path / "tumor.h5"), -1.)
+    export_serving_model(served)
+    best = saved(str(tmp_path / "best.h5"), 1.)
+
+    assert promote_model(best, served, brightness_data())
+    assert evaluate_saved(served, brightness_data()) == 1.
+    graph = tf.keras.models.load_model(serving_path(served), compile=False)
+    x = np.full((1, 8, 8, 1), .9, np.float32)
+    np.testing.assert_allclose(graph.layers[-1].predict(x, verbose=0),
+                               tf.keras.models.load_model(best).predict(x, verbose=0), rtol=1e-6)
+    assert not [f for f in os.listdir(tmp_path) if ".tmp" in f]
+
+
+def test_worse_model_leaves_the_served_model_alone(tmp_path):
+    served = saved(str(tmp_path / "tumor.h5"), 1.)
+    before = open(served, "rb").read()
+    best = saved(str(tmp_path / "best.h5"), -1.)
+
+    assert not promote_model(best, served, brightness_data())
+    assert open(served, "rb").read() == before
+    assert not os.path.exists(serving_path(served))
+
+
+def test_first_model_is_promoted(tmp_path):
+    served = str(tmp_path / "tumor.h5")
+    assert promote_model(saved(str(tmp_path / "best.h5"), 1.), served, brightness_data())
+    assert os.path.exists(served) and not os.path.exists(serving_path(served))
@@ -0,0 +1,75 @@
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import image_loader
+import validate
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(validate, "CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(image_loader, "CACHE_DIR", str(tmp_path / "cache"))
+
+
+def write_jpeg(path, size=(64, 64)):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.fromarray(np.random.default_rng(0).integers(0, 255, (*size, 3), dtype=np.uint8)).save(path, "JPEG")
+    return path
+
+
+def test_check_file_accepts_a_good_image(tmp_path):
+    entry = validate.check_file(write_jpeg(str(tmp_path / "ok.jpg")))
+    assert entry["quarantine"] == [] and entry["warnings"] == []
+    assert (entry["format"], entry["mode"], entry["width"], entry["height"]) == ("JPEG", "RGB", 64, 64)
+    assert entry["stats"][0] == 64 * 64
+
+
+def test_check_file_quarantines_truncated_images(tmp_path):
+    path = write_jpeg(str(tmp_path / "cut.jpg"))
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(path, "wb") as f:
+        f.write(data[:len(data) // 2])
+    assert validate.check_file(path)["quarantine"][0].startswith("undecodable")
+
+
+def test_check_file_quarantines_empty_files(tmp_path):
+    path = str(tmp_path / "empty.jpg")
+    open(path, "wb").close()
+    entry = validate.check_file(path)
+    assert entry["size"] == 0 and entry["quarantine"][0].startswith("undecodable")
+
+
+def test_check_file_quarantines_images_below_min_size(tmp_path):
+    path = write_jpeg(str(tmp_path / "small.jpg"), (20, 64))
+    assert validate.check_file(path)["quarantine"] == ["too small (64x20)"]
+    assert validate.check_file(path, min_size=16)["quarantine"] == []
+
+
+def test_quarantine_round_trip(tmp_path):
+    ds = tmp_path / "Scans"
+    paths = [write_jpeg(str(ds / "Train" / "Stroke" / f"{i}.jpg")) for i in range(3)]
+    entries = {"Train/Stroke/1.jpg": {"quarantine": ["CMYK"]}, "Train/Stroke/0.jpg": {"quarantine": []}}
+
+    path = validate.write_quarantine(str(ds), entries)
+    assert path == image_loader.quarantine_path("Scans") and not os.path.exists(ds / "quarantine.txt")
+    assert image_loader.load_quarantine(str(ds)) == {os.path.normpath(paths[1])}
+    # A split directory finds its dataset's list too
+    assert image_loader.list_images(str(ds / "Train"))[0] == [paths[0], paths[2]]
+
+    # Nothing left to quarantine removes the list
+    assert validate.write_quarantine(str(ds), {"Train/Stroke/1.jpg": {"quarantine": []}}) is None
+    assert image_loader.load_quarantine(str(ds)) == set()
+
+
+def test_rerun_with_another_min_size_rechecks_files(tmp_path):
+    ds = tmp_path / "Scans"
+    write_jpeg(str(ds / "Train" / "Stroke" / "0.jpg"), (48, 48))
+    assert validate.validate_dataset(str(ds), processes=1, min_size=32)["quarantined"] == 0
+
+    summary = validate.validate_dataset(str(ds), processes=1, min_size=64)
+    assert summary["checked"] == 1 and summary["quarantined"] == 1
+    assert validate.validate_dataset(str(ds), processes=1, min_size=64)["checked"] == 0
@@ -0,0 +1,186 @@
+import os
+
+import numpy as np
+import pytest
+
+from volumes import (write_nifti, open_volume, select_slices, iter_slices, aggregate_slice_predictions,
+                     predict_volume, list_volumes, volume_dataset)
+
+
+def synthetic_volume(shape=(20, 16, 12), dtype=np.int16, seed=0):
+    return np.random.default_rng(seed).integers(0, 1000, shape).astype(dtype)
+
+
+@pytest.mark.parametrize("byteorder", ["<", ">"])
+@pytest.mark.parametrize("ext", [".nii", ".hdr"])
+@pytest.mark.parametrize("dtype", [np.uint8, np.int16, np.uint16, np.float32])
+def test_nifti_round_trip(tmp_path, byteorder, ext, dtype):
+    volume = synthetic_volume(dtype=dtype)
+    path = str(tmp_path / f"scan{ext}")
+    write_nifti(path, volume, byteorder)
+    if ext == ".hdr":
+        assert (tmp_path / "scan.img").stat().st_size == volume.nbytes
+
+    loaded = open_volume(path)
+    assert isinstance(loaded, np.memmap)
+    assert loaded.shape == volume.shape
+    assert loaded.dtype.byteorder in (byteorder, "=", "|") or loaded.dtype.itemsize == 1
+    np.testing.assert_array_equal(loaded, volume)
+    np.testing.assert_array_equal(loaded[:, :, 5], volume[:, :, 5])
+
+
+def test_open_volume_npy(tmp_path):
+    volume = synthetic_volume()
+    np.save(tmp_path / "scan.npy", volume)
+    np.testing.assert_array_equal(open_volume(str(tmp_path / "scan.npy")), volume)
+
+
+def test_open_volume_rejects_bad_files(tmp_path):
+    (tmp_path / "junk.nii").write_bytes(b"\x00" * 400)
+    with pytest.raises(ValueError, match="not a NIfTI-1"):
+        open_volume(str(tmp_path / "junk.nii"))
+    with pytest.raises(ValueError, match="compressed"):
+        open_volume(str(tmp_path / "scan.nii.gz"))
+    with pytest.raises(ValueError, match="shape is required"):
+        open_volume(str(tmp_path / "scan.raw"))
+    (tmp_path / "short.nii").write_bytes(b"\x5c\x01\x00\x00")
+    with pytest.raises(ValueError, match="not a NIfTI-1"):
+        open_volume(str(tmp_path / "short.nii"))
+
+
+@pytest.mark.parametrize("shape", [(16, 16), (4, 4, 4, 2)])
+def test_open_volume_rejects_npy_that_is_not_3d(tmp_path, shape):
+    np.save(tmp_path / "scan.npy", np.zeros(shape, np.uint8))
+    with pytest.raises(ValueError, match="not a 3D volume"):
+        open_volume(str(tmp_path / "scan.npy"))
+
+
+@pytest.mark.parametrize("depth,num_slices,margin", [
+    (100, 16, .15), (100, None, .15), (100, 200, .15), (100, 1, .15), (10, 16, .15),
+    (5, 3, .15), (3, 16, .5), (1, 16, .15), (40, 16, 0.),
+])
+def test_select_slices(depth, num_slices, margin):
+    indices = select_slices(depth, num_slices, margin)
+    assert indices, "at least one slice is always selected"
+    assert indices == sorted(set(indices))
+    assert all(0 <= i < depth for i in indices)
+    if num_slices is not None:
+        assert len(indices) <= num_slices
+    if num_slices is None or num_slices >= depth:
+        # Everything between the margins
+        assert indices == list(range(int(depth * margin), max(depth - int(depth * margin), int(depth * margin) + 1)))
+
+
+def test_select_slices_skips_margins_and_spreads_evenly():
+    indices = select_slices(100, 5, .2)
+    assert indices == [20, 35, 50, 64, 79]
+
+
+def test_select_slices_empty_volume():
+    assert select_slices(0) == []
+
+
+def test_aggregate_slice_predictions():
+    preds = np.array([[.9, .1], [.6, .4], [.2, .8]])
+    np.testing.assert_allclose(aggregate_slice_predictions(preds, "mean"), [1.7 / 3, 1.3 / 3], rtol=1e-6)
+    np.testing.assert_allclose(aggregate_slice_predictions(preds, "max"), [.9 / 1.7, .8 / 1.7], rtol=1e-6)
+    np.testing.assert_allclose(aggregate_slice_predictions(preds, "vote"), [2 / 3, 1 / 3], rtol=1e-6)
+    for method in ("mean", "max", "vote"):
+        assert aggregate_slice_predictions(preds, method).sum() == pytest.approx(1.)
+    with pytest.raises(ValueError, match="Unknown aggregation"):
+        aggregate_slice_predictions(preds, "median")
+
+
+def test_aggregate_vote_counts_classes_without_votes():
+    preds = np.array([[.1, .2, .7], [.3, .1, .6]])
+    np.testing.assert_array_equal(aggregate_slice_predictions(preds, "vote"), [0, 0, 1])
+
+
+def tiny_model(input_shape=(8, 8, 3), num_classes=2):
+    import tensorflow as tf
+    tf.keras.utils.set_random_seed(0)
+    return tf.keras.Sequential([
+        tf.keras.Input(input_shape),
+        tf.keras.layers.Rescaling(1. / 255),
+        tf.keras.layers.Conv2D(4, 3, activation="relu"),
+        tf.keras.layers.GlobalAveragePooling2D(),
+        tf.keras.layers.Dense(num_classes, activation="softmax"),
+    ])
+
+
+def test_predict_volume(tmp_path):
+    volume = synthetic_volume((20, 16, 30), np.uint16)
+    write_nifti(str(tmp_path / "scan.nii"), volume)
+    model = tiny_model()
+
+    probs, indices, slice_preds = predict_volume(model, open_volume(str(tmp_path / "scan.nii")), num_slices=7,
+                                                 batch_size=3)
+    assert indices == select_slices(30, 7)
+    assert slice_preds.shape == (len(indices), 2)
+    assert probs.shape == (2,) and probs.sum() == pytest.approx(1.)
+
+    expected = model.predict(np.stack([img for _, img in iter_slices(volume, (8, 8), 3, num_slices=7)]), verbose=0)
+    np.testing.assert_allclose(slice_preds, expected, rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(probs, aggregate_slice_predictions(expected), rtol=1e-5)
+
+    # Batching does not change the result
+    same, _, _ = predict_volume(model, volume, num_slices=7, batch_size=16)
+    np.testing.assert_allclose(same, probs, rtol=1e-5)
+
+
+def test_predict_volume_grayscale_model():
+    model = tiny_model((8, 8, 1), 3)
+    probs, indices, slice_preds = predict_volume(model, synthetic_volume(), num_slices=4, method="vote")
+    assert slice_preds.shape == (len(indices), 3)
+    assert probs.sum() == pytest.approx(1.)
+
+
+def test_predict_volume_without_slices():
+    with pytest.raises(ValueError, match="no slices"):
+        predict_volume(tiny_model(), np.zeros((8, 8, 0), np.uint8))
+    with pytest.raises(ValueError, match="3D volume"):
+        predict_volume(tiny_model(), np.zeros((8, 8), np.uint8))
+
+
+# Train/<class>/<volume> layout with three volumes per class, Stroke volumes are brighter
+def volume_split(root, depth=10):
+    for label, class_name in enumerate(("Normal", "Stroke")):
+        (root / class_name).mkdir(parents=True)
+        for i in range(3):
+            volume = synthetic_volume((20, 16, depth), np.uint16, seed=i) + 1000 * label
+            if i == 0:
+                write_nifti(str(root / class_name / f"{i}.nii"), volume)
+            else:
+                np.save(root / class_name / f"{i}.npy", volume)
+    (root / "Normal" / "notes.txt").write_text("not a volume")
+    return str(root)
+
+
+def test_volume_dataset_yields_labelled_slices(tmp_path):
+    directory = volume_split(tmp_path / "Train")
+    paths, labels, class_names = list_volumes(directory)
+    assert class_names == ["Normal", "Stroke"] and labels == [0, 0, 0, 1, 1, 1]
+    assert [os.path.basename(p) for p in paths] == ["0.nii", "1.npy", "2.npy"] * 2
+
+    ds = volume_dataset(directory, (8, 8), batch_size=4, num_slices=5, shuffle=False)
+    assert ds.class_names == class_names
+    x = np.concatenate([b[0].numpy() for b in ds])
+    y = np.concatenate([b[1].numpy() for b in ds])
+    per_volume = len(select_slices(10, 5))
+    assert x.shape == (6 * per_volume, 8, 8, 3) and x.dtype == np.float32
+    assert 0 <= x.min() and x.max() <= 255
+    np.testing.assert_array_equal(y, np.repeat([0, 0, 0, 1, 1, 1], per_volume))
+
+    shard = volume_dataset(directory, (8, 8), batch_size=4, num_slices=5, shuffle=False, shard=(2, 1))
+    np.testing.assert_array_equal(np.concatenate([b[1].numpy() for b in shard]), np.repeat([0, 1, 1], per_volume))
+
+
+def test_get_ds_splits_reads_volume_datasets(tmp_path):
+    from preprocess import get_ds_splits
+
+    volume_split(tmp_path / "Scans" / "Train")
+    volume_split(tmp_path / "Scans" / "Test")
+    train_ds, test_ds = get_ds_splits("Scans", str(tmp_path), (8, 8), batch_size=4)
+    x, y = next(iter(test_ds))
+    assert x.shape[1:] == (8, 8, 3) and float(x.numpy().max()) <= 1.
+    assert sum(len(b[1]) for b in train_ds) == 6 * len(select_slices(10))
@@ -1,31 +1,42 @@
 import os
+import sys
+import tempfile
+import time
 import streamlit as st
-import tensorflow as tf
-from keras.utils import CustomObjectScope
-from keras.initializers import glorot_uniform
-from PIL import Image
 import numpy as np
 
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "Scripts"))
+import job_queue
+from reports import summarize, format_report
+
+# Queue database shared with the workers started by Scripts/job_queue.py
+JOB_DB = os.environ.get("BRAIN_JOB_DB", job_queue.DEFAULT_DB)
+
+# Address of a Scripts/model_host.py process that holds the models for every web worker, if any
+MODEL_HOST = os.environ.get("BRAIN_MODEL_HOST")
+
 # Set page configuration
 st.set_page_config(layout="wide")
 
-# Define the path to the models
-MODEL_PATHS = {
-    "Brain Stroke": os.path.join(os.path.dirname(__file__), "brain_stroke.h5"),
-    "Alzheimer's": os.path.join(os.path.dirname(__file__), "alzheimer.h5"),
-    "Tumor": os.path.join(os.path.dirname(__file__), "tumor.h5")
-}
+# Connection to the job queue shared by every session. Only opened once the worker pool has created
+# the queue database, so a server without workers never creates or holds it.
+@st.cache_resource
+def get_queue_connection(db_path):
+    return job_queue.connect(db_path, check_same_thread=False)
 
-# Function to load and return the models
+def queue_connection():
+    return get_queue_connection(JOB_DB) if os.path.exists(JOB_DB) else None
+
+# Function to load and return the models, once per server process rather than on every rerun
+@st.cache_resource
 def load_models():
-    models = {}
-    for name, path in MODEL_PATHS.items():
-        try:
-            with CustomObjectScope({'GlorotUniform': glorot_uniform}):
-                models[name] = tf.keras.models.load_model(path)
-        except Exception as e:
-            st.error(f"Error loading model '{name}': {e}")
-    return models
+    # With a model host this worker only keeps proxies and never imports TensorFlow
+    if MODEL_HOST:
+        from model_host import connect_models
+        return connect_models(MODEL_HOST)
+
+    from serving import load_serving_models
+    return load_serving_models(on_error=lambda name, e: st.error(f"Error loading model '{name}': {e}"))
 
 # Load the models at the start
 MODELS = load_models()
@@ -58,27 +69,143 @@ def main():
     elif st.session_state.page == "About Brain Diseases":
         render_about_page()
 
-# Function to load image and preprocess it
+# Function to load an uploaded image as a batch of encoded bytes,
+# decoding, resizing and rescaling all happen inside the serving graph
 def load_image(image_file):
-    image = Image.open(image_file)
-    image = image.resize((124, 124))  # Resize the image if your model expects a different size
-    image = np.array(image)
-    image = np.expand_dims(image, axis=0)  # Add batch dimension
-    return image
-
-# Function to generate report
-def generate_report(patient_name, patient_age, test_type, prediction_label):
-    report_text = f"""
-    Medical Report
-    --------------
-    Patient Name: {patient_name}
-    Patient Age: {patient_age}
-    Test Type: {test_type}
-    Prediction: {'Condition Positive' if prediction_label[0] == 1 else 'Condition Negative'}
-
-    Note: This is a preliminary assessment and not a definitive diagnosis.
-    """
-    return report_text
+    return np.array([image_file.getvalue()], dtype=object)
+
+# Pixel input view of a served model for volume slices, built once per model
+@st.cache_resource
+def get_pixel_model(test_type):
+    from serving import image_model
+    return image_model(MODELS[test_type])
+
+# Function to classify an uploaded 3D volume slice by slice, None (with the reason shown) for
+# uploads that are not a readable 3D volume.
+# The upload is spilled to a temporary file so the volume can be memory mapped instead of read whole.
+def classify_volume(uploaded_file, test_type):
+    from volumes import open_volume, predict_volume
+
+    suffix = os.path.splitext(uploaded_file.name)[1]
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as tmp:
+        tmp.write(uploaded_file.getbuffer())
+    try:
+        volume = open_volume(tmp.name)
+        if volume.ndim != 3:
+            raise ValueError(f"Expected a 3D volume, got shape {volume.shape}")
+        pixel_model = MODELS[test_type].pixel_view() if MODEL_HOST else get_pixel_model(test_type)
+        probs, indices, _ = predict_volume(pixel_model, volume)
+        middle = np.asarray(volume[:, :, volume.shape[2] // 2], dtype=np.float32).T
+        middle = (middle - middle.min()) / max(float(middle.max() - middle.min()), 1e-6)
+        del volume
+    except (ValueError, IndexError, OSError) as e:
+        st.error(f"Could not read '{uploaded_file.name}' as a 3D volume: {e}")
+        return None
+    finally:
+        os.remove(tmp.name)
+    return probs, indices, middle
+
+# Function to classify an image through the background job queue.
+# The job id is kept in the session so reruns of the script poll the same job instead of enqueueing it again.
+def classify_queued(conn, uploaded_file, test_type, timeout=120):
+    key = (uploaded_file.name, uploaded_file.size, test_type)
+    jobs = st.session_state.setdefault('jobs', {})
+    if key not in jobs:
+        jobs[key] = job_queue.enqueue(conn, test_type, uploaded_file.getvalue())
+    job_id = jobs[key]
+
+    status = st.empty()
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = job_queue.get_job(conn, job_id)
+        if job['status'] == 'done':
+            status.empty()
+            return np.array([job['result']])
+        if job['status'] == 'failed':
+            del jobs[key]
+            status.error(f"Analysis failed: {job['error']}")
+            return None
+        ahead = job_queue.queue_position(conn, job_id)
+        status.info(f"Analyzing the MRI scan... ({ahead} scans ahead in the queue)" if ahead else "Analyzing the MRI scan...")
+        time.sleep(0.5)
+
+    status.warning("The scan is still queued, the result will show up here once it is processed. Refresh the page to check again.")
+    return None
+
+# Similar case index built by Scripts/embedding_index.py, None if there is none. Cached per index
+# version (the mtime of its meta.json), so an index built or rebuilt while the app runs is picked up.
+@st.cache_resource
+def get_index(test_type, version):
+    from embedding_index import load_index
+    return load_index(test_type)
+
+# Function to get the similar case index of a model, without reloading it on every rerun
+def similar_case_index(test_type):
+    from embedding_index import index_path
+    meta = os.path.join(index_path(test_type), "meta.json")
+    return get_index(test_type, os.path.getmtime(meta) if os.path.exists(meta) else None)
+
+# Embedding model querying the index, shared by every session
+@st.cache_resource
+def get_embedder(test_type):
+    from embedding_index import embedding_model
+    return embedding_model(MODELS[test_type])
+
+# Function to embed an uploaded image with the penultimate layer of the selected model
+def embed_image(image, test_type):
+    if MODEL_HOST:
+        return MODELS[test_type].embed(image)
+    return get_embedder(test_type).predict(image, verbose=0)
+
+# Grad-CAM explainer of a served model, shared by every session
+@st.cache_resource
+def get_explainer(test_type):
+    from explain import Explainer
+    return Explainer(MODELS[test_type])
+
+# Function to get the Grad-CAM heatmap of an uploaded image, None for models without convolutional layers
+def explain_image(image, test_type):
+    try:
+        if MODEL_HOST:
+            return MODELS[test_type].explain(image)[0][0]
+        return get_explainer(test_type).explain(image)[0][0]
+    except ValueError:
+        return None
+
+# Function to show which regions of the scan drove the prediction
+def render_explanation(uploaded_file, test_type):
+    cam = explain_image(load_image(uploaded_file), test_type)
+    if cam is not None:
+        from explain import overlay
+        st.image(overlay(uploaded_file.getvalue(), cam), caption='Grad-CAM: regions that drove the prediction.')
+
+# Function to show the most similar labelled training scans, if an index was built for the selected model
+def render_similar_cases(image, test_type, k=5):
+    index = similar_case_index(test_type)
+    if index is None:
+        return
+
+    results = [r for r in index.similar(embed_image(image, test_type)[0], k) if os.path.exists(r['path'])]
+    if results:
+        st.subheader("Similar labelled cases")
+        for col, result in zip(st.columns(len(results)), results):
+            with col:
+                st.image(result['path'], caption=f"{result['label']} (similarity {result['score']:.2f})", use_column_width=True)
+
+# Function to generate report, the same report (and verdict) the bulk report generator writes
+def generate_report(patient_name, patient_age, test_type, probabilities):
+    return format_report({"patient_name": patient_name, "patient_age": patient_age, "test_type": test_type,
+                          "probabilities": probabilities})
+
+# Function to show the verdict and the report of a prediction
+def render_prediction(patient_name, patient_age, test_type, probabilities):
+    _, _, prediction, condition, confidence = summarize({"test_type": test_type, "probabilities": probabilities})
+    st.write(f"Prediction: {condition} ({prediction}, {confidence:.1%})")
+
+    report = generate_report(patient_name, patient_age, test_type, probabilities)
+    st.write(report)
+
+    st.download_button(label="Download Report", data=report, file_name="medical_report.txt", mime='text/plain')
 
 # Function to render the home page
 def render_home_page():
@@ -135,23 +262,45 @@ def render_classify_page():
         ("Alzheimer's", "Brain Stroke", "Tumor")
     )
 
-    uploaded_file = st.file_uploader("Upload your MRI scan image", type=['jpg', 'jpeg', 'png'])
-
-    if uploaded_file is not None and patient_name and patient_age:
-        st.image(uploaded_file, caption='Uploaded MRI scan.', use_column_width=True)
-        image = load_image(uploaded_file)
+    uploaded_file = st.file_uploader(
+        "Upload your MRI scan image or volume",
+        type=['jpg', 'jpeg', 'png', 'nii', 'npy']
+    )
 
-        with st.spinner('Analyzing the MRI scan...'):
-            model = MODELS[test_type]
-            prediction = model.predict(image)
-            prediction_label = np.argmax(prediction, axis=1)
+    if uploaded_file is not None and patient_name and patient_age and uploaded_file.name.lower().endswith(('.nii', '.npy')):
+        with st.spinner('Analyzing the MRI volume...'):
+            result = classify_volume(uploaded_file, test_type)
+        if result is None:
+            return
+        probs, indices, middle = result
 
-        st.write(f"Prediction: {'Condition Positive' if prediction_label[0] == 1 else 'Condition Negative'}")
+        st.image(middle, caption=f'Middle slice of the uploaded volume ({len(indices)} slices analyzed).', use_column_width=True)
+        render_prediction(patient_name, patient_age, test_type, probs)
 
-        report = generate_report(patient_name, patient_age, test_type, prediction_label)
-        st.write(report)
+    elif uploaded_file is not None and patient_name and patient_age:
+        st.image(uploaded_file, caption='Uploaded MRI scan.', use_column_width=True)
 
-        st.download_button(label="Download Report", data=report, file_name="medical_report.txt", mime='text/plain')
+        # Hand the scan to the worker pool when it is running, otherwise classify in this process
+        conn = queue_connection()
+        queued = conn is not None and job_queue.workers_alive(conn)
+        if queued:
+            prediction = classify_queued(conn, uploaded_file, test_type)
+            if prediction is None:
+                return
+        else:
+            image = load_image(uploaded_file)
+            with st.spinner('Analyzing the MRI scan...'):
+                model = MODELS[test_type]
+                prediction = model.predict(image)
+        render_prediction(patient_name, patient_age, test_type, prediction[0])
+
+        # Grad-CAM and similar cases run a model too. With the worker pool they only go through the
+        # model host, running them here would put the load the queue takes off this process back on it
+        if queued and not MODEL_HOST:
+            st.caption("Grad-CAM and similar cases are not shown while scans are classified by the worker pool.")
+            return
+        render_explanation(uploaded_file, test_type)
+        render_similar_cases(load_image(uploaded_file), test_type)
 
 # Function to render the about page
 def render_about_page():